@@ -0,0 +1,126 @@
+import base64
+
+# Admin data access: keyset pagination over (created_at, short_code) and
+# headline totals read from aggregate tables that triggers keep in sync with
+# every write to urls (bulk inserts, click flushes, updates, deletes).
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_urls_created ON urls(created_at, short_code)",
+    "CREATE INDEX IF NOT EXISTS idx_urls_campaign_created ON urls(campaign, created_at, short_code)",
+    """
+    CREATE TABLE IF NOT EXISTS url_totals (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        urls INTEGER NOT NULL,
+        clicks INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS campaign_stats (
+        campaign TEXT PRIMARY KEY,
+        urls INTEGER NOT NULL,
+        clicks INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_insert_totals AFTER INSERT ON urls BEGIN
+        UPDATE url_totals SET urls = urls + 1, clicks = clicks + NEW.clicks WHERE id = 1;
+        INSERT INTO campaign_stats (campaign, urls, clicks)
+            SELECT NEW.campaign, 1, NEW.clicks WHERE NEW.campaign IS NOT NULL
+            ON CONFLICT(campaign) DO UPDATE SET urls = urls + 1, clicks = clicks + excluded.clicks;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_delete_totals AFTER DELETE ON urls BEGIN
+        UPDATE url_totals SET urls = urls - 1, clicks = clicks - OLD.clicks WHERE id = 1;
+        UPDATE campaign_stats SET urls = urls - 1, clicks = clicks - OLD.clicks
+            WHERE campaign = OLD.campaign;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_update_totals
+    AFTER UPDATE OF clicks, campaign ON urls BEGIN
+        UPDATE url_totals SET clicks = clicks + NEW.clicks - OLD.clicks WHERE id = 1;
+        UPDATE campaign_stats SET urls = urls - 1, clicks = clicks - OLD.clicks
+            WHERE campaign = OLD.campaign;
+        INSERT INTO campaign_stats (campaign, urls, clicks)
+            SELECT NEW.campaign, 1, NEW.clicks WHERE NEW.campaign IS NOT NULL
+            ON CONFLICT(campaign) DO UPDATE SET urls = urls + 1, clicks = clicks + excluded.clicks;
+    END
+    """,
+]
+
+
+def ensure_schema(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(urls)")}
+    for column in ("custom_name", "campaign"):
+        if column not in columns:
+            conn.execute("ALTER TABLE urls ADD COLUMN %s TEXT" % column)
+    backfill = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'url_totals'"
+    ).fetchone() is None
+    for statement in SCHEMA:
+        conn.execute(statement)
+    if backfill:
+        # One full scan when the aggregates are first created; triggers maintain them after
+        conn.execute("""
+            INSERT INTO url_totals (id, urls, clicks)
+            SELECT 1, COUNT(*), COALESCE(SUM(clicks), 0) FROM urls
+        """)
+        conn.execute("""
+            INSERT INTO campaign_stats (campaign, urls, clicks)
+            SELECT campaign, COUNT(*), COALESCE(SUM(clicks), 0) FROM urls
+            WHERE campaign IS NOT NULL GROUP BY campaign
+        """)
+
+
+def encode_cursor(created_at, short_code):
+    return base64.urlsafe_b64encode(("%s\n%s" % (created_at, short_code)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, short_code = base64.urlsafe_b64decode(cursor.encode()).decode().split("\n", 1)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+    return created_at, short_code
+
+
+def list_urls(conn, limit=DEFAULT_PAGE_SIZE, cursor=None, campaign=None):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    where, params = [], []
+    if campaign:
+        where.append("campaign = ?")
+        params.append(campaign)
+    if cursor:
+        where.append("(created_at, short_code) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+    sql = "SELECT short_code, original_url, created_at, clicks, custom_name, campaign FROM urls"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, short_code DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = [dict(row) for row in conn.execute(sql, params)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["short_code"])
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def summary(conn, campaign_limit=100):
+    totals = conn.execute("SELECT urls, clicks FROM url_totals WHERE id = 1").fetchone()
+    campaigns = conn.execute(
+        "SELECT campaign, urls, clicks FROM campaign_stats WHERE urls > 0 ORDER BY clicks DESC LIMIT ?",
+        (campaign_limit,),
+    ).fetchall()
+    campaign_count = conn.execute("SELECT COUNT(*) FROM campaign_stats WHERE urls > 0").fetchone()[0]
+    return {
+        "total_urls": totals[0] if totals else 0,
+        "total_clicks": totals[1] if totals else 0,
+        "campaign_count": campaign_count,
+        "campaigns": [dict(row) for row in campaigns],
+    }
@@ -0,0 +1,218 @@
+import random
+import string
+import threading
+
+from metrics import Counter
+
+# Short-code allocation engines.
+#
+# Neither engine probes the urls table before handing out a code: the UNIQUE
+# index on urls.short_code is the single source of truth, and a collision is
+# handled by retrying the INSERT with a fresh code (see bulk.bulk_insert).
+
+BASE62 = string.digits + string.ascii_letters
+
+CODE_RETRIES = Counter("short_code_retries_total", "Minted short codes that collided and were re-minted.")
+BLOCKS_RESERVED = Counter("short_code_blocks_reserved_total", "Id blocks leased from code_allocator.")
+
+
+def encode_base62(n, length):
+    chars = []
+    while n:
+        n, rem = divmod(n, 62)
+        chars.append(BASE62[rem])
+    if len(chars) > length:
+        raise ValueError("value does not fit in %d base62 digits" % length)
+    return ''.join(reversed(chars)).rjust(length, BASE62[0])
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS code_allocator (
+            name TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_urls_short_code ON urls(short_code)")
+
+
+# Public; see CounterAllocator
+DEFAULT_KEY = 0x5EED
+
+
+class CodeSpaceExhausted(Exception):
+    pass
+
+
+class RandomAllocator:
+    """Random codes; uniqueness is enforced at insert time, never probed."""
+
+    name = "random"
+
+    def __init__(self, length=6, rng=None):
+        self.length = length
+        self._rng = rng or random.SystemRandom()
+
+    def next_code(self, conn=None):
+        return ''.join(self._rng.choices(BASE62, k=self.length))
+
+    def allocate(self, conn, n):
+        return [self.next_code() for _ in range(n)]
+
+    def prefetch(self, conn, n):
+        pass
+
+
+class CounterAllocator:
+    """Counter-based codes handed out from blocks reserved in the database.
+
+    Each process leases ``block_size`` ids at a time from the code_allocator
+    row, in a transaction of its own. Minting a code costs no database round
+    trip except once per block.
+
+    A lease taken inside the caller's transaction could still be rolled back,
+    so it is never kept for later calls. Callers that mint inside a
+    transaction should mint, or ``prefetch``, before it begins.
+
+    Ids are optionally passed through a bijection over the code space, so
+    consecutive links do not get guessable, consecutive codes:
+
+    * ``scramble=None``      -- plain base62 of the counter
+    * ``scramble="shuffle"`` -- affine permutation ``(a * id + b) mod 62**length``
+    * ``scramble="feistel"`` -- keyed Feistel network with cycle walking
+
+    The permutation is only as secret as ``key``: the default is public and
+    fit for tests and benchmarks, so the app passes SHORT_CODE_KEY. Keep the
+    key stable; a new one still mints unique codes, but old and new codes can
+    collide and take the insert retry path.
+    """
+
+    name = "counter"
+
+    def __init__(self, length=6, block_size=1000, scramble="feistel", key=DEFAULT_KEY, sequence="default"):
+        self.length = length
+        self.block_size = block_size
+        self.scramble = scramble
+        self.sequence = sequence
+        self.space = 62 ** length
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+        rng = random.Random(key)
+        # Affine shuffle: any multiplier coprime with 62**length is a bijection.
+        multiplier = rng.randrange(self.space // 3, self.space) | 1
+        while multiplier % 31 == 0:
+            multiplier += 2
+        self._mul = multiplier
+        self._add = rng.randrange(self.space)
+
+        # Feistel network over the smallest even bit width covering the space.
+        bits = (self.space - 1).bit_length()
+        bits += bits & 1
+        self._half = bits // 2
+        self._half_mask = (1 << self._half) - 1
+        self._round_keys = [rng.getrandbits(32) | 1 for _ in range(4)]
+
+        if scramble not in (None, "shuffle", "feistel"):
+            raise ValueError("unknown scramble mode: %r" % (scramble,))
+
+    def reserve_block(self, conn, size=None):
+        """Lease ``size`` ids (default: a block); returns the ``(start, end)`` range.
+
+        Outside a transaction the lease is committed on its own. Inside one it
+        rolls back with the caller's transaction, so ``_take`` never keeps
+        such a range for later calls.
+        """
+        size = size or self.block_size
+        own = not conn.in_transaction
+        if own:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO code_allocator (name, next_id) VALUES (?, 0)",
+                (self.sequence,),
+            )
+            conn.execute(
+                "UPDATE code_allocator SET next_id = next_id + ? WHERE name = ?",
+                (size, self.sequence),
+            )
+            end = conn.execute(
+                "SELECT next_id FROM code_allocator WHERE name = ?", (self.sequence,)
+            ).fetchone()[0]
+            if end - size >= self.space:
+                raise CodeSpaceExhausted("短縮コードの空き領域がありません")
+            if own:
+                conn.commit()
+        except BaseException:
+            if own:
+                conn.rollback()
+            raise
+        BLOCKS_RESERVED.inc()
+        return end - size, min(end, self.space)
+
+    def _feistel(self, value):
+        left, right = value >> self._half, value & self._half_mask
+        for k in self._round_keys:
+            f = (((right ^ k) * 0x9E3779B1) >> 7) & self._half_mask
+            left, right = right, left ^ f
+        return (left << self._half) | right
+
+    def permute(self, value):
+        if self.scramble == "shuffle":
+            return (value * self._mul + self._add) % self.space
+        if self.scramble == "feistel":
+            # Cycle walking keeps the permutation inside [0, space).
+            value = self._feistel(value)
+            while value >= self.space:
+                value = self._feistel(value)
+            return value
+        return value
+
+    def _take(self, conn, n):
+        ids = []
+        with self._lock:
+            while len(ids) < n:
+                if self._next >= self._end:
+                    if conn.in_transaction:
+                        # Lease just what is missing: the caller may still roll
+                        # the lease back, so none of it is kept for later
+                        start, end = self.reserve_block(conn, n - len(ids))
+                        ids.extend(range(start, end))
+                        continue
+                    self._next, self._end = self.reserve_block(conn, max(self.block_size, n - len(ids)))
+                count = min(n - len(ids), self._end - self._next)
+                ids.extend(range(self._next, self._next + count))
+                self._next += count
+        return ids
+
+    def prefetch(self, conn, n):
+        """Make sure the next ``n`` ids are leased, so minting them inside a
+        transaction that starts after this costs no round trip."""
+        if conn.in_transaction:
+            return
+        with self._lock:
+            if self._end - self._next < n:
+                # What is left of the old block becomes a gap in the sequence
+                self._next, self._end = self.reserve_block(conn, max(self.block_size, n))
+
+    def next_code(self, conn):
+        return self.allocate(conn, 1)[0]
+
+    def allocate(self, conn, n):
+        return [encode_base62(self.permute(i), self.length) for i in self._take(conn, n)]
+
+
+ENGINES = {
+    RandomAllocator.name: RandomAllocator,
+    CounterAllocator.name: CounterAllocator,
+}
+
+
+def make_allocator(engine="counter", **options):
+    try:
+        cls = ENGINES[engine]
+    except KeyError:
+        raise ValueError("unknown short code engine: %r" % (engine,))
+    return cls(**options)
+
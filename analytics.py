@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+
+# Time-bucketed click analytics. Raw events in `clicks` are folded, by rowid
+# watermark, into per-minute / per-hour / per-day rollups for each short code
+# and each campaign. Queries only ever read the rollups; raw events older than
+# the retention window are compacted away once folded.
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+FOLD_BATCH = 200000
+RAW_RETENTION = 2 * 86400
+MINUTE_RETENTION = 7 * 86400
+MAX_POINTS = 2000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS click_rollups (
+        short_code TEXT NOT NULL,
+        granularity INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        PRIMARY KEY (short_code, granularity, bucket)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS campaign_rollups (
+        campaign TEXT NOT NULL,
+        granularity INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        PRIMARY KEY (campaign, granularity, bucket)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name TEXT PRIMARY KEY,
+        last_rowid INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO rollup_state (name, last_rowid) VALUES ('clicks', 0)",
+]
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def fold(conn, batch=FOLD_BATCH):
+    """Fold up to ``batch`` new raw events into the rollups; returns events folded."""
+    # The watermark is read under the write lock, so concurrent folds (another
+    # worker, the archiver) never claim the same range of events
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        start = conn.execute("SELECT last_rowid FROM rollup_state WHERE name = 'clicks'").fetchone()[0]
+        row = conn.execute(
+            "SELECT MAX(rowid), COUNT(*) FROM (SELECT rowid FROM clicks WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+            (start, batch),
+        ).fetchone()
+        end, count = row[0], row[1]
+        if not count:
+            conn.commit()
+            return 0
+
+        for width in GRANULARITIES.values():
+            conn.execute("""
+                INSERT INTO click_rollups (short_code, granularity, bucket, clicks)
+                SELECT short_code, ?, clicked_at / ? * ?, COUNT(*)
+                FROM clicks WHERE rowid > ? AND rowid <= ?
+                GROUP BY short_code, clicked_at / ?
+                ON CONFLICT (short_code, granularity, bucket) DO UPDATE SET clicks = clicks + excluded.clicks
+            """, (width, width, width, start, end, width))
+            conn.execute("""
+                INSERT INTO campaign_rollups (campaign, granularity, bucket, clicks)
+                SELECT u.campaign, ?, c.clicked_at / ? * ?, COUNT(*)
+                FROM clicks c JOIN urls u ON u.short_code = c.short_code
+                WHERE c.rowid > ? AND c.rowid <= ? AND u.campaign IS NOT NULL
+                GROUP BY u.campaign, c.clicked_at / ?
+                ON CONFLICT (campaign, granularity, bucket) DO UPDATE SET clicks = clicks + excluded.clicks
+            """, (width, width, width, start, end, width))
+        conn.execute("UPDATE rollup_state SET last_rowid = ? WHERE name = 'clicks'", (end,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
+
+
+def compact(conn, now=None, raw_retention=RAW_RETENTION, minute_retention=MINUTE_RETENTION):
+    """Drop folded raw events and minute buckets past their retention window."""
+    now = int(now if now is not None else time.time())
+    watermark = conn.execute("SELECT last_rowid FROM rollup_state WHERE name = 'clicks'").fetchone()[0]
+    deleted = conn.execute(
+        "DELETE FROM clicks WHERE rowid <= ? AND clicked_at < ?", (watermark, now - raw_retention)
+    ).rowcount
+    for table in ("click_rollups", "campaign_rollups"):
+        conn.execute(
+            "DELETE FROM %s WHERE granularity = ? AND bucket < ?" % table,
+            (GRANULARITIES["minute"], now - minute_retention),
+        )
+    conn.commit()
+    return deleted
+
+
+def pick_granularity(seconds):
+    if seconds <= 6 * 3600:
+        return "minute"
+    if seconds <= 14 * 86400:
+        return "hour"
+    return "day"
+
+
+def _series(conn, table, key_column, key, granularity, since, until):
+    width = GRANULARITIES[granularity]
+    first, last = since // width * width, until // width * width
+    if (last - first) // width + 1 > MAX_POINTS:
+        raise ValueError("range too large for granularity")
+    rows = conn.execute(
+        "SELECT bucket, clicks FROM %s WHERE %s = ? AND granularity = ? AND bucket BETWEEN ? AND ?"
+        % (table, key_column),
+        (key, width, first, last),
+    ).fetchall()
+    counts = dict(rows)
+    points = [[bucket, counts.get(bucket, 0)] for bucket in range(first, last + 1, width)]
+    return {
+        "granularity": granularity,
+        "since": first,
+        "until": last + width,
+        "total": sum(counts.values()),
+        "points": points,
+    }
+
+
+def link_series(conn, short_code, granularity, since, until):
+    return _series(conn, "click_rollups", "short_code", short_code, granularity, since, until)
+
+
+def campaign_series(conn, campaign, granularity, since, until):
+    return _series(conn, "campaign_rollups", "campaign", campaign, granularity, since, until)
+
+
+def link_info(conn, short_code):
+    row = conn.execute(
+        "SELECT short_code, original_url, created_at, clicks, custom_name, campaign FROM urls WHERE short_code = ?",
+        (short_code,),
+    ).fetchone()
+    if row is None:
+        # Archived links keep their page; looking at it does not restore them
+        row = conn.execute(
+            "SELECT short_code, original_url, created_at, clicks, custom_name, campaign FROM urls_archive "
+            "WHERE short_code = ?", (short_code,),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def fold_all(conn):
+    total = 0
+    while True:
+        folded = fold(conn)
+        total += folded
+        if folded < FOLD_BATCH:
+            return total
+
+
+class RollupWorker:
+    """Periodically folds new click events and compacts old ones."""
+
+    def __init__(self, storage, interval=60.0):
+        self.storage = storage
+        self.interval = interval
+        self._task = None
+        self.folded = 0
+        self.compacted = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self):
+        folded, compacted = await self.storage.fold_rollups()
+        self.folded += folded
+        self.compacted += compacted
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("click rollup failed")
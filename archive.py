@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+
+import analytics
+from metrics import Counter
+
+# Hot/cold tiering. Links can expire (urls.expires_at, unix seconds); expired
+# links stop redirecting. A background task moves expired links, and links
+# with no clicks for ``cold_after`` seconds, out of `urls` into
+# `urls_archive`, so the hot table and its indexes only hold links that are
+# still being used. A redirect to an archived (cold, not expired) link moves
+# it back into `urls` in one transaction and carries on as usual.
+#
+# Archived codes stay reserved: a trigger rejects inserting a code that is in
+# the archive, so minted and custom codes collide with them exactly like with
+# live ones. Archived links still count in the admin totals.
+#
+# "No clicks" is read from the daily click rollups, which are never
+# compacted; each run folds pending click events first.
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH = 5000
+COLD_AFTER = 30 * 86400
+DAY = analytics.GRANULARITIES["day"]
+
+COLUMNS = "short_code, original_url, created_at, clicks, custom_name, campaign, url_hash, expires_at"
+
+ARCHIVED = Counter("links_archived_total", "Links moved to the archive, by reason.", ("reason",))
+RESTORED = Counter("links_restored_total", "Archived links moved back on a redirect.")
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS urls_archive (
+        short_code TEXT PRIMARY KEY,
+        original_url TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        clicks INTEGER NOT NULL DEFAULT 0,
+        custom_name TEXT,
+        campaign TEXT,
+        url_hash INTEGER,
+        expires_at INTEGER,
+        archived_at INTEGER NOT NULL,
+        reason TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_urls_expires ON urls(expires_at) WHERE expires_at IS NOT NULL",
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_insert_archived BEFORE INSERT ON urls
+    WHEN EXISTS (SELECT 1 FROM urls_archive WHERE short_code = NEW.short_code) BEGIN
+        SELECT RAISE(ABORT, 'UNIQUE constraint failed: urls.short_code');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_archive_insert_totals AFTER INSERT ON urls_archive BEGIN
+        UPDATE url_totals SET urls = urls + 1, clicks = clicks + NEW.clicks WHERE id = 1;
+        INSERT INTO campaign_stats (campaign, urls, clicks)
+            SELECT NEW.campaign, 1, NEW.clicks WHERE NEW.campaign IS NOT NULL
+            ON CONFLICT(campaign) DO UPDATE SET urls = urls + 1, clicks = clicks + excluded.clicks;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_archive_delete_totals AFTER DELETE ON urls_archive BEGIN
+        UPDATE url_totals SET urls = urls - 1, clicks = clicks - OLD.clicks WHERE id = 1;
+        UPDATE campaign_stats SET urls = urls - 1, clicks = clicks - OLD.clicks
+            WHERE campaign = OLD.campaign;
+    END
+    """,
+]
+
+
+def ensure_schema(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(urls)")}
+    if "expires_at" not in columns:
+        conn.execute("ALTER TABLE urls ADD COLUMN expires_at INTEGER")
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def expired(expires_at, now=None):
+    return expires_at is not None and expires_at <= (now if now is not None else time.time())
+
+
+def restore(conn, short_code, now=None):
+    """Move an archived, unexpired link back into urls; returns (url, expires_at) or None."""
+    row = conn.execute("SELECT %s FROM urls_archive WHERE short_code = ?" % COLUMNS, (short_code,)).fetchone()
+    if row is None or expired(row["expires_at"], now):
+        return None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another connection may have restored it since the read
+        if conn.execute("DELETE FROM urls_archive WHERE short_code = ?", (short_code,)).rowcount:
+            conn.execute("INSERT INTO urls (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % COLUMNS, tuple(row))
+            RESTORED.inc()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return row["original_url"], row["expires_at"]
+
+
+def _move(conn, codes, now, reason):
+    doc = json.dumps(codes)
+    conn.execute("""
+        INSERT INTO urls_archive (%s, archived_at, reason)
+        SELECT %s, ?, ? FROM urls WHERE short_code IN (SELECT value FROM json_each(?))
+    """ % (COLUMNS, COLUMNS), (now, reason, doc))
+    conn.execute("DELETE FROM urls WHERE short_code IN (SELECT value FROM json_each(?))", (doc,))
+    ARCHIVED.inc(reason, amount=len(codes))
+
+
+def archive_expired(conn, now, batch=ARCHIVE_BATCH):
+    """Move up to ``batch`` expired links; returns their codes."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        codes = [row[0] for row in conn.execute(
+            "SELECT short_code FROM urls WHERE expires_at <= ? LIMIT ?", (now, batch),
+        )]
+        if codes:
+            _move(conn, codes, now, "expired")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return codes
+
+
+def archive_cold(conn, now, cold_after, after=("", ""), batch=ARCHIVE_BATCH):
+    """Scan up to ``batch`` links created before the cutoff, past ``after``
+    in (created_at, short_code) order, and move those without clicks since.
+
+    Returns (moved codes, position to continue from, or None when done).
+    """
+    cutoff = int(now - cold_after)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("""
+            SELECT created_at, short_code, EXISTS (
+                SELECT 1 FROM click_rollups r
+                WHERE r.short_code = u.short_code AND r.granularity = ? AND r.bucket >= ?
+            ) AS warm
+            FROM urls u
+            WHERE created_at < ? AND (created_at, short_code) > (?, ?)
+            ORDER BY created_at, short_code LIMIT ?
+        """, (DAY, cutoff // DAY * DAY, datetime.fromtimestamp(cutoff).isoformat()) + tuple(after)
+            + (batch,)).fetchall()
+        codes = [row["short_code"] for row in rows if not row["warm"]]
+        if codes:
+            _move(conn, codes, now, "cold")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    position = (rows[-1]["created_at"], rows[-1]["short_code"]) if len(rows) == batch else None
+    return codes, position
+
+
+def archive_links(conn, now=None, cold_after=COLD_AFTER, batch=ARCHIVE_BATCH):
+    """Move every expired link, and every cold one if ``cold_after``; returns
+    the moved codes as (expired, cold).
+
+    Each batch is its own transaction, so writers wait at most one batch.
+    """
+    now = int(now if now is not None else time.time())
+    # Clicks waiting to be folded count as recent
+    analytics.fold_all(conn)
+    expired = []
+    while True:
+        moved = archive_expired(conn, now, batch)
+        expired.extend(moved)
+        if len(moved) < batch:
+            break
+    cold = []
+    position = ("", "")
+    while cold_after and position is not None:
+        moved, position = archive_cold(conn, now, cold_after, position, batch)
+        cold.extend(moved)
+    return expired, cold
+
+
+class ArchiveWorker:
+    """Periodically moves expired and cold links to the archive.
+
+    ``await on_archive(codes)`` gets the codes moved by each run that moved any.
+    """
+
+    def __init__(self, storage, interval=3600.0, cold_after=COLD_AFTER, on_archive=None):
+        self.storage = storage
+        self.interval = interval
+        self.cold_after = cold_after
+        self.on_archive = on_archive
+        self._task = None
+        self.runs = 0
+        self.expired = 0
+        self.cold = 0
+        self.last_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self):
+        start = time.perf_counter()
+        expired, cold = await self.storage.archive_links(self.cold_after)
+        self.runs += 1
+        self.expired += len(expired)
+        self.cold += len(cold)
+        self.last_seconds = time.perf_counter() - start
+        if expired or cold:
+            logger.info("archived %d expired and %d cold links in %.1fs", len(expired), len(cold), self.last_seconds)
+            if self.on_archive is not None:
+                # Cached redirects of moved codes would skip the restore
+                await self.on_archive(expired + cold)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("link archiving failed")
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "cold_after": self.cold_after,
+            "runs": self.runs,
+            "expired": self.expired,
+            "cold": self.cold,
+            "last_seconds": round(self.last_seconds, 3),
+        }
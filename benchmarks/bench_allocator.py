@@ -0,0 +1,75 @@
+"""Per-code mint + insert cost as the urls table grows.
+
+    python benchmarks/bench_allocator.py --sizes 10000 100000 1000000 10000000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import CodeSpaceExhausted, encode_base62, make_allocator  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+def insert_url(conn, allocator, code, original_url, created_at, max_attempts=10):
+    # One row per INSERT, retried with a fresh code on a UNIQUE violation
+    for _ in range(max_attempts):
+        try:
+            conn.execute(
+                "INSERT INTO urls (short_code, original_url, created_at) VALUES (?, ?, ?)",
+                (code, original_url, created_at),
+            )
+            return code
+        except sqlite3.IntegrityError:
+            code = allocator.next_code(conn)
+    raise CodeSpaceExhausted("短縮コード生成に失敗しました")
+
+
+def seed(conn, rows, batch=50000):
+    # Seed with a disjoint code space (7 chars) so measurement codes never collide.
+    now = datetime.now().isoformat()
+    for start in range(0, rows, batch):
+        conn.executemany(
+            "INSERT INTO urls (short_code, original_url, created_at) VALUES (?, ?, ?)",
+            ((encode_base62(i, 7), "https://example.com/%d" % i, now)
+             for i in range(start, min(rows, start + batch))),
+        )
+    conn.commit()
+
+
+def measure(conn, allocator, n):
+    now = datetime.now().isoformat()
+    start = time.perf_counter()
+    # Minted before the inserts open their transaction, as bulk.bulk_insert does
+    codes = allocator.allocate(conn, n)
+    for i, code in enumerate(codes):
+        insert_url(conn, allocator, code, "https://bench.example/%d" % i, now)
+    conn.commit()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--codes", type=int, default=10000)
+    args = parser.parse_args()
+
+    print("%-10s %12s %12s" % ("rows", "engine", "us/code"))
+    for engine in ("counter", "random"):
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+                migrate(conn)
+                seed(conn, size)
+                us = measure(conn, make_allocator(engine), args.codes)
+                print("%-10d %12s %12.2f" % (size, engine, us))
+                conn.close()
+
+
+if __name__ == "__main__":
+    main()
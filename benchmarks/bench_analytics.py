@@ -0,0 +1,68 @@
+"""90-day chart query for one heavily clicked link: rollups vs. raw event scan.
+
+    python benchmarks/bench_analytics.py --clicks 1000000 10000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+RAW_SQL = """
+    SELECT clicked_at / 86400 * 86400, COUNT(*) FROM clicks
+    WHERE short_code = ? AND clicked_at >= ? GROUP BY 1
+"""
+
+
+def seed(conn, clicks, now, batch=200000):
+    migrate(conn)
+    conn.executemany("INSERT INTO urls (short_code, original_url, created_at, campaign) VALUES (?, ?, ?, ?)",
+                     [("hot", "https://example.com", "2024-01-01", "spring"),
+                      ("cold", "https://example.org", "2024-01-01", None)])
+    rng = random.Random(7)
+    for start in range(0, clicks, batch):
+        n = min(batch, clicks - start)
+        conn.executemany("INSERT INTO clicks VALUES (?, ?)",
+                         (("hot" if rng.random() < 0.9 else "cold", now - rng.randrange(90 * 86400))
+                          for _ in range(n)))
+    conn.commit()
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clicks", type=int, nargs="+", default=[1000000])
+    args = parser.parse_args()
+
+    print("%-10s %10s %12s %12s" % ("clicks", "fold s", "rollup ms", "raw ms"))
+    for clicks in args.clicks:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+            now = int(time.time())
+            seed(conn, clicks, now)
+            start = time.perf_counter()
+            analytics.fold_all(conn)
+            fold_s = time.perf_counter() - start
+            rollup_ms = timed(lambda: analytics.link_series(conn, "hot", "day", now - 90 * 86400, now))
+            raw_ms = timed(lambda: conn.execute(RAW_SQL, ("hot", now - 90 * 86400)).fetchall(), repeat=1)
+            print("%-10d %10.2f %12.3f %12.1f" % (clicks, fold_s, rollup_ms, raw_ms))
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Hot table size before and after archiving cold links, and the redirect lookup cost.
+
+Creates N links dated 90 days back, gives a share of them clicks in the last
+week and runs archive.archive_links. Reports the bytes held by urls and its
+indexes (what redirects and the admin listing page through) before and after,
+the time the run took, and get_original_url for a hot link, for an archived
+one (fault back in) and for that link again once it is hot.
+
+    python benchmarks/bench_archive.py --links 500000 --hot 0.1
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive  # noqa: E402
+from allocator import make_allocator  # noqa: E402
+from bulk import bulk_insert  # noqa: E402
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+from storage import get_original_url  # noqa: E402
+
+
+def hot_bytes(conn):
+    return conn.execute("""
+        SELECT SUM(pgsize) FROM dbstat
+        WHERE name = 'urls' OR name IN (SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'urls')
+    """).fetchone()[0]
+
+
+def timed(conn, codes):
+    start = time.perf_counter()
+    for code in codes:
+        if get_original_url(conn, code) is None:
+            raise SystemExit("lookup failed for %s" % code)
+    return (time.perf_counter() - start) / len(codes) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=500000)
+    parser.add_argument("--hot", type=float, default=0.1)
+    parser.add_argument("--probes", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        # WAL and synchronous=NORMAL like the app's pool: a restore is one small commit
+        conn = connect(os.path.join(tmp, "bench.db"))
+        migrate(conn)
+        allocator = make_allocator("counter")
+        codes = []
+        for start in range(0, args.links, 10000):
+            rows = bulk_insert(conn, allocator, [
+                {"url": "https://example.com/landing/%d" % i, "campaign": "spring-%d" % (i % 50)}
+                for i in range(start, min(start + 10000, args.links))
+            ])
+            codes.extend(row["short_code"] for row in rows)
+        conn.execute("UPDATE urls SET created_at = ?", (datetime.fromtimestamp(now - 90 * 86400).isoformat(),))
+        hot = rng.sample(codes, int(len(codes) * args.hot))
+        day = archive.DAY
+        conn.executemany(
+            "INSERT INTO click_rollups (short_code, granularity, bucket, clicks) VALUES (?, ?, ?, 1)",
+            ((code, day, (now - rng.randrange(7) * day) // day * day) for code in hot),
+        )
+        conn.commit()
+        hot_set = set(hot)
+        cold = [code for code in rng.sample(codes, min(len(codes), args.probes * 4)) if code not in hot_set]
+        cold = cold[:args.probes]
+
+        before = hot_bytes(conn)
+        start = time.perf_counter()
+        moved = len(archive.archive_links(conn, now)[1])
+        seconds = time.perf_counter() - start
+        after = hot_bytes(conn)
+        print("%d links, %d hot: archived %d cold links in %.2fs (%.0f links/s)" % (
+            args.links, len(hot), moved, seconds, moved / seconds if seconds else 0))
+        print("urls + indexes: %.1f MiB -> %.1f MiB (freed pages are reused by new rows)" % (
+            before / 2 ** 20, after / 2 ** 20))
+
+        probes = rng.sample(hot, min(len(hot), args.probes))
+        print("%-22s %10s" % ("lookup", "us"))
+        print("%-22s %10.1f" % ("hot", timed(conn, probes)))
+        print("%-22s %10.1f" % ("archived (restore)", timed(conn, cold)))
+        print("%-22s %10.1f" % ("restored, again", timed(conn, cold)))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
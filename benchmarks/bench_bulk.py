@@ -0,0 +1,73 @@
+"""Bulk insert throughput: legacy per-row loop vs. the batched bulk engine.
+
+    python benchmarks/bench_bulk.py --sizes 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import make_allocator  # noqa: E402
+from bulk import bulk_insert, validate_url  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+def open_db(path):
+    conn = sqlite3.connect(path)
+    # WAL so the legacy probe connection is not blocked by the open write transaction
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+    return conn
+
+
+def legacy(path, url_list):
+    # The pre-allocator code path: one connection + SELECT probe per code.
+    chars = string.ascii_letters + string.digits
+    conn = sqlite3.connect(path)
+    for url in url_list:
+        if validate_url(url):
+            probe = sqlite3.connect(path)
+            while True:
+                code = ''.join(random.choices(chars, k=6))
+                if not probe.execute("SELECT 1 FROM urls WHERE short_code = ?", (code,)).fetchone():
+                    break
+            probe.close()
+            conn.execute("INSERT INTO urls (short_code, original_url, created_at) VALUES (?, ?, ?)",
+                         (code, url, datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+
+def batched(path, url_list):
+    conn = sqlite3.connect(path)
+    bulk_insert(conn, make_allocator("counter"), url_list)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print("%-8s %10s %12s %14s" % ("urls", "engine", "seconds", "urls/s"))
+    for size in args.sizes:
+        url_list = ["https://example.com/campaign/%d" % i for i in range(size)]
+        for name, fn in (("legacy", legacy), ("bulk", batched)):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "bench.db")
+                open_db(path).close()
+                start = time.perf_counter()
+                fn(path, url_list)
+                elapsed = time.perf_counter() - start
+                print("%-8d %10s %12.3f %14.0f" % (size, name, elapsed, size / elapsed))
+
+
+if __name__ == "__main__":
+    main()
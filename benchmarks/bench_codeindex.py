@@ -0,0 +1,56 @@
+"""Code index: memory, build rate and lookup cost against a SQLite miss.
+
+Fills a Bloom filter with N codes for a few error rates and reports the
+memory it takes, adds per second, the measured false-positive rate on codes
+that were never added, and the cost of a lookup next to the indexed
+SELECT a 404 used to cost.
+
+    python benchmarks/bench_codeindex.py --codes 1000000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import encode_base62, make_allocator  # noqa: E402
+from codeindex import BloomFilter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codes", type=int, default=1000000)
+    parser.add_argument("--probes", type=int, default=100000)
+    args = parser.parse_args()
+
+    allocator = make_allocator("counter")
+    codes = [encode_base62(allocator.permute(i), 6) for i in range(args.codes)]
+    unknown = ["x" + encode_base62(i, 6) for i in range(args.probes)]
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE urls (short_code TEXT NOT NULL, original_url TEXT NOT NULL)")
+    conn.execute("CREATE UNIQUE INDEX idx_urls_short_code ON urls(short_code)")
+    conn.executemany("INSERT INTO urls VALUES (?, 'https://example.com/')", ((c,) for c in codes))
+    start = time.perf_counter()
+    for code in unknown:
+        conn.execute("SELECT original_url FROM urls WHERE short_code = ?", (code,)).fetchone()
+    sqlite_us = (time.perf_counter() - start) / len(unknown) * 1e6
+
+    print("%d codes; sqlite miss (in-process, no executor hop): %.2f us" % (args.codes, sqlite_us))
+    print("%-10s %10s %8s %12s %12s %10s" % ("error", "MiB", "hashes", "adds/s", "lookup us", "measured"))
+    for error_rate in (0.01, 0.001, 0.0001):
+        bloom = BloomFilter(args.codes, error_rate)
+        start = time.perf_counter()
+        bloom.add_many(codes)
+        adds = args.codes / (time.perf_counter() - start)
+        start = time.perf_counter()
+        hits = sum(1 for code in unknown if code in bloom)
+        lookup_us = (time.perf_counter() - start) / len(unknown) * 1e6
+        print("%-10g %10.1f %8d %12.0f %12.2f %10.5f" % (
+            error_rate, bloom.memory_bytes / 2 ** 20, bloom.hashes, adds, lookup_us, hits / len(unknown)))
+
+
+if __name__ == "__main__":
+    main()
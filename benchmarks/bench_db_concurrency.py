@@ -0,0 +1,95 @@
+"""p50/p99 latency of DB-backed async handlers under many parallel clients.
+
+"before" opens a blocking sqlite3 connection inside the coroutine (the old
+get_db_connection pattern); "after" goes through db.Database, whose pool and
+executor keep SQLite off the event loop.
+
+    python benchmarks/bench_db_concurrency.py --clients 200 --requests 20
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database  # noqa: E402
+
+LOOKUP_SQL = "SELECT original_url FROM urls WHERE short_code = ?"
+
+
+def seed(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE urls (short_code TEXT UNIQUE, original_url TEXT, created_at TEXT)")
+    now = datetime.now().isoformat()
+    conn.executemany("INSERT INTO urls VALUES (?, ?, ?)",
+                     (("c%d" % i, "https://example.com/%d" % i, now) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def lookup(conn, code):
+    return conn.execute(LOOKUP_SQL, (code,)).fetchone()
+
+
+async def before(path, code):
+    conn = sqlite3.connect(path)
+    try:
+        return lookup(conn, code)
+    finally:
+        conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def drive(handler, clients, requests, rows):
+    latencies = []
+
+    async def client(n):
+        for i in range(requests):
+            # The request "arrives" now but is only served once the loop gets to it
+            start = time.perf_counter()
+            await asyncio.sleep(0)
+            await handler("c%d" % ((n * requests + i) % rows))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    return latencies, time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        seed(path, args.rows)
+
+        db = Database(path)
+        db.open()
+
+        async def after(code):
+            return await db.run(lookup, code)
+
+        print("%-8s %10s %10s %10s" % ("mode", "req/s", "p50 ms", "p99 ms"))
+        for name, handler in (("before", lambda code: before(path, code)), ("after", after)):
+            latencies, elapsed = await drive(handler, args.clients, args.requests, args.rows)
+            print("%-8s %10.0f %10.2f %10.2f" % (
+                name, len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+        db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
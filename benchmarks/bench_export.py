@@ -0,0 +1,65 @@
+"""Streaming export: rows/s and memory growth per format.
+
+Seeds a database with N links (as benchmarks/suite.py does), then exports the
+links dataset as CSV, NDJSON and Parquet, each in a fresh child process so its
+peak RSS is its own. The output is written to /dev/null chunk by chunk, like a
+client reading the response. Peak RSS growth should stay flat as N grows.
+
+    python benchmarks/bench_export.py --links 10000000
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export  # noqa: E402
+from suite import seed  # noqa: E402
+
+
+def run(path, fmt, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    written = 0
+    start = time.perf_counter()
+    with open(os.devnull, "wb") as out:
+        for data in export.export_stream([path], "links", fmt, base_url="https://sho.rt/"):
+            written += len(data)
+            out.write(data)
+    seconds = time.perf_counter() - start
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    queue.put((seconds, written, growth))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=1000000)
+    parser.add_argument("--formats", default="csv,ndjson,parquet")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        start = time.perf_counter()
+        seed(path, args.links)
+        print("seeded %d links in %.1fs" % (args.links, time.perf_counter() - start))
+        print("%-8s %10s %12s %10s %14s" % ("format", "seconds", "rows/s", "MiB out", "peak RSS +MiB"))
+        for fmt in args.formats.split(","):
+            if fmt == "parquet" and export.pyarrow is None:
+                print("%-8s %10s" % (fmt, "skipped (no pyarrow)"))
+                continue
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=run, args=(path, fmt, queue))
+            child.start()
+            child.join()
+            if child.exitcode:
+                raise SystemExit("%s export failed" % fmt)
+            seconds, written, growth = queue.get()
+            print("%-8s %10.1f %12.0f %10.1f %14.1f" % (
+                fmt, seconds, args.links / seconds, written / 2 ** 20, growth / 1024))
+
+
+if __name__ == "__main__":
+    main()
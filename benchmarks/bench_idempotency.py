@@ -0,0 +1,79 @@
+"""Idempotency-Key: cost of a replay next to running the bulk insert again.
+
+Sends bulk inserts of --rows URLs through IdempotencyCache on SQLite storage,
+each under a fresh key, then replays every key: from the in-process cache,
+and from the database (a fresh cache, as another worker would see it). Also
+fires --duplicates concurrent requests with one key and counts how many of
+them reached the write path.
+
+    python benchmarks/bench_idempotency.py --rows 1000 --requests 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import make_allocator  # noqa: E402
+from idempotency import IdempotencyCache, fingerprint  # noqa: E402
+from serialize import BulkEncoder  # noqa: E402
+from storage import make_storage  # noqa: E402
+
+encoder = BulkEncoder("https://sho.rt/")
+
+
+async def timed(cache, keys, execute):
+    start = time.perf_counter()
+    for key, urls in keys:
+        await cache.run(key, fingerprint("\n".join(urls)), lambda: execute(urls))
+    return (time.perf_counter() - start) / len(keys) * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--duplicates", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = make_storage("sqlite", make_allocator("counter"), path=os.path.join(tmp, "bench.db"))
+        storage.open()
+        await storage.migrate()
+        executions = 0
+
+        async def execute(urls):
+            nonlocal executions
+            executions += 1
+            rows = await storage.insert_urls(urls)
+            return 200, "application/json", encoder.body(rows)
+
+        keys = [("bench %d" % n, ["https://example.com/%d/%d" % (n, i) for i in range(args.rows)])
+                for n in range(args.requests)]
+        cache = IdempotencyCache(storage)
+        first = await timed(cache, keys, execute)
+        memory = await timed(cache, keys, execute)
+        database = await timed(IdempotencyCache(storage), keys, execute)
+        if executions != args.requests:
+            raise SystemExit("replays reached the write path")
+
+        print("%d requests of %d rows" % (args.requests, args.rows))
+        print("%-22s %10s" % ("request", "ms"))
+        print("%-22s %10.3f" % ("first (insert)", first))
+        print("%-22s %10.3f" % ("replay, memory", memory))
+        print("%-22s %10.3f" % ("replay, database", database))
+
+        executions = 0
+        urls = ["https://example.com/dup/%d" % i for i in range(args.rows)]
+        await asyncio.gather(*[
+            cache.run("dup", fingerprint("\n".join(urls)), lambda: execute(urls)) for _ in range(args.duplicates)
+        ])
+        print("%d concurrent duplicates: %d execution(s)" % (args.duplicates, executions))
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
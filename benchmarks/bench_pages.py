@@ -0,0 +1,64 @@
+"""Per-view cost and bytes on the wire for the /bulk page shell.
+
+"rebuild" is the old path: encode the page string on every hit (what
+HTMLResponse does), and gzip it per response when the client accepts it.
+"static" is pages.StaticPage picking a precompressed variant, and "304" is a
+revalidation with a matching If-None-Match.
+
+    python benchmarks/bench_pages.py --views 20000
+"""
+import argparse
+import ast
+import gzip
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pages  # noqa: E402
+
+
+def bulk_html():
+    # Read the literal from the source so the benchmark runs without FastAPI installed
+    with open(os.path.join(ROOT, "main.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) == "BULK_HTML":
+            return ast.literal_eval(node.value)
+    raise SystemExit("BULK_HTML not found in main.py")
+
+
+def timed(fn, views):
+    start = time.perf_counter()
+    for _ in range(views):
+        result = fn()
+    return (time.perf_counter() - start) / views, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--views", type=int, default=20000)
+    args = parser.parse_args()
+
+    html = bulk_html()
+    page = pages.StaticPage(html)
+    etag = page.select("gzip, br")[2]["ETag"]
+
+    print("brotli: %s" % ("yes" if pages.brotli else "not installed"))
+    print("%-18s %12s %12s" % ("mode", "us/view", "bytes"))
+    cases = (
+        ("rebuild", lambda: html.encode("utf-8"), args.views),
+        ("rebuild+gzip", lambda: gzip.compress(html.encode("utf-8"), 6), args.views // 20),
+        ("static", lambda: page.select("gzip, deflate, br")[1], args.views),
+        ("static identity", lambda: page.select(None)[1], args.views),
+        ("304", lambda: page.select("gzip, deflate, br", etag)[1], args.views),
+    )
+    for name, fn, views in cases:
+        seconds, body = timed(fn, max(1, views))
+        print("%-18s %12.2f %12d" % (name, seconds * 1e6, len(body)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Cost of one rate-limiter decision, with many distinct clients.
+
+    python benchmarks/bench_ratelimit.py --decisions 1000000 --clients 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import RateLimiter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decisions", type=int, default=1000000)
+    parser.add_argument("--clients", type=int, default=100000)
+    parser.add_argument("--maxsize", type=int, default=50000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    keys = ["ip:10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255) for n in range(args.clients)]
+    traffic = [keys[rng.randrange(args.clients)] for _ in range(args.decisions)]
+    limiter = RateLimiter(rate=5, burst=20, maxsize=args.maxsize)
+
+    take = limiter.take
+    start = time.perf_counter()
+    for key in traffic:
+        take(key)
+    elapsed = time.perf_counter() - start
+
+    print("ns/decision: %.0f" % (elapsed / args.decisions * 1e9))
+    print("stats: %s" % limiter.stats())
+
+
+if __name__ == "__main__":
+    main()
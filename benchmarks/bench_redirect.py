@@ -0,0 +1,105 @@
+"""Redirect throughput through the real app, driven in-process over ASGI.
+
+With --workers N, N processes each run their own app instance against the
+same database file (as `WORKERS=N python main.py` does) and rates are summed.
+
+    python benchmarks/bench_redirect.py --rows 100000 --requests 200000 --hot 10000
+    python benchmarks/bench_redirect.py --workers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(path, rows):
+    from migrations import migrate
+
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    now = datetime.now().isoformat()
+    conn.executemany("INSERT INTO urls (short_code, original_url, created_at) VALUES (?, ?, ?)",
+                     (("c%d" % i, "https://example.com/%d" % i, now) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+async def get(app, path):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "headers": [],
+        "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def drive(requests, rows, hot, unknown, seed_value):
+    import main as app_module
+    app = app_module.app
+    async with app.router.lifespan_context(app):
+        rng = random.Random(seed_value)
+        paths = ["/zz%d" % rng.randrange(1000) if rng.random() < unknown
+                 else "/c%d" % rng.randrange(min(hot, rows))
+                 for _ in range(requests)]
+
+        start = time.perf_counter()
+        for path in paths:
+            await get(app, path)
+        elapsed = time.perf_counter() - start
+        return requests / elapsed, app_module.redirect_cache.stats()
+
+
+def worker(job):
+    # One process per worker, each with its own app, cache and pool (as under `WORKERS=N`)
+    return asyncio.run(drive(*job))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=200000, help="per worker")
+    parser.add_argument("--hot", type=int, default=10000, help="distinct codes in the traffic mix")
+    parser.add_argument("--unknown", type=float, default=0.05, help="share of requests for unknown codes")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_PATH"] = os.path.join(tmp, "bench.db")
+        os.environ["WORKERS"] = str(args.workers)
+        seed(os.environ["DATABASE_PATH"], args.rows)
+
+        jobs = [(args.requests, args.rows, args.hot, args.unknown, n + 1) for n in range(args.workers)]
+        if args.workers == 1:
+            results = [worker(jobs[0])]
+        else:
+            with multiprocessing.Pool(args.workers) as pool:
+                results = pool.map(worker, jobs)
+
+        rates = [rate for rate, _ in results]
+        print("workers: %d" % args.workers)
+        print("redirects/s: %.0f (per worker: %s)" % (sum(rates), ", ".join("%.0f" % r for r in rates)))
+        print("cache: %s" % results[0][1])
+
+
+if __name__ == "__main__":
+    main()
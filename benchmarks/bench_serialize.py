@@ -0,0 +1,76 @@
+"""Time and peak memory to serialize a bulk response of N results.
+
+"dicts" is the old path: one response dict per row, then JSONResponse's
+json.dumps. "encoder" is serialize.BulkEncoder writing rows straight to bytes
+(orjson when installed, stdlib json otherwise).
+
+    python benchmarks/bench_serialize.py --rows 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialize  # noqa: E402
+from serialize import BulkEncoder  # noqa: E402
+
+BASE_URL = "https://url-shortener-mvp.onrender.com/"
+
+
+def make_rows(n):
+    rows = []
+    for i in range(n):
+        if i % 50 == 0:
+            rows.append({"url": "not-a-url-%d" % i, "success": False, "error": "無効なURL"})
+        else:
+            rows.append({"url": "https://example.com/path/%d?utm_source=x" % i, "success": True,
+                         "short_code": "c%05d" % i})
+    return rows
+
+
+def dicts(rows):
+    results = []
+    for row in rows:
+        if row["success"]:
+            results.append({"url": row["url"], "short_url": f"{BASE_URL}{row['short_code']}", "success": True})
+        else:
+            results.append({"url": row["url"], "success": False, "error": row["error"]})
+    return json.dumps({"results": results}, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def measure(fn, rows):
+    tracemalloc.start()
+    start = time.perf_counter()
+    body = fn(rows)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Timing without tracemalloc overhead
+    start = time.perf_counter()
+    fn(rows)
+    return time.perf_counter() - start, elapsed, peak, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    encoder = BulkEncoder(BASE_URL)
+    assert json.loads(dicts(rows)) == json.loads(encoder.body(rows))
+
+    print("json backend: %s" % ("orjson" if serialize.orjson else "stdlib"))
+    print("%-8s %10s %14s %10s" % ("mode", "ms", "peak MiB", "body MiB"))
+    for name, fn in (("dicts", dicts), ("encoder", encoder.body)):
+        seconds, _, peak, size = measure(fn, rows)
+        print("%-8s %10.1f %14.1f %10.1f" % (name, seconds * 1000, peak / 2 ** 20, size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
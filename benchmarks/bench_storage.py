@@ -0,0 +1,69 @@
+"""Bulk insert throughput with concurrent writers, and lookup rate, per storage engine.
+
+Each writer inserts batches of --batch URLs; with one file every batch waits
+on the same writer lock, with the sharded engine a batch is split across N
+files and written in parallel.
+
+    python benchmarks/bench_storage.py --writers 8 --batches 20 --batch 1000 --shards 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import make_allocator  # noqa: E402
+from storage import make_storage  # noqa: E402
+
+
+async def run(storage, writers, batches, batch):
+    storage.open()
+    await storage.migrate()
+
+    codes = []
+
+    async def writer(n):
+        for b in range(batches):
+            urls = ["https://example.com/%d/%d/%d" % (n, b, i) for i in range(batch)]
+            rows = await storage.insert_urls(urls)
+            codes.extend(row["short_code"] for row in rows if row["success"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(n) for n in range(writers)))
+    insert_elapsed = time.perf_counter() - start
+
+    sample = codes[::max(1, len(codes) // 20000)]
+    start = time.perf_counter()
+    await asyncio.gather(*(storage.get_url(code) for code in sample))
+    lookup_elapsed = time.perf_counter() - start
+
+    await storage.close()
+    return len(codes) / insert_elapsed, len(sample) / lookup_elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engines = [
+            ("memory", {}),
+            ("sqlite", {"path": os.path.join(tmp, "single.db")}),
+            ("sharded", {"directory": os.path.join(tmp, "shards"), "shards": args.shards}),
+        ]
+        print("%-8s %12s %12s" % ("engine", "inserts/s", "lookups/s"))
+        for engine, options in engines:
+            storage = make_storage(engine, make_allocator("counter"), **options)
+            inserts, lookups = await run(storage, args.writers, args.batches, args.batch)
+            print("%-8s %12.0f %12.0f" % (engine, inserts, lookups))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
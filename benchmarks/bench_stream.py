@@ -0,0 +1,69 @@
+"""Peak Python memory of the streaming bulk pipeline as the upload grows.
+
+    python benchmarks/bench_stream.py --rows 10000 100000 1000000
+
+Timings include tracemalloc overhead; use bench_bulk.py for throughput.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import make_allocator  # noqa: E402
+from bulk import bulk_insert, iter_batches, iter_upload_rows  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+def write_upload(path, rows, fmt):
+    with open(path, "w") as f:
+        if fmt == "csv":
+            f.write("url,custom_name\n")
+        for i in range(rows):
+            if fmt == "csv":
+                f.write("https://example.com/item/%d,item%d\n" % (i, i))
+            else:
+                f.write(json.dumps({"url": "https://example.com/item/%d" % i}) + "\n")
+
+
+def run(tmp, rows, fmt):
+    upload = os.path.join(tmp, "upload." + fmt)
+    write_upload(upload, rows, fmt)
+    conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+    migrate(conn)
+    allocator = make_allocator("counter")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    written = 0
+    with open(upload, "rb") as f:
+        for batch in iter_batches(iter_upload_rows(f, fmt)):
+            chunk = ''.join(json.dumps(row) + '\n' for row in bulk_insert(conn, allocator, batch))
+            written += len(chunk)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    conn.close()
+    return elapsed, peak, written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="ndjson")
+    args = parser.parse_args()
+
+    print("%-10s %10s %12s %14s" % ("rows", "seconds", "rows/s", "peak KiB"))
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            elapsed, peak, _ = run(tmp, rows, args.format)
+            print("%-10d %10.2f %12.0f %14.0f" % (rows, elapsed, rows / elapsed, peak / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""URL validation cost per row at 100k rows, and what gets rejected.
+
+"prefix" is the old per-row check (startswith http:// or https://). "urlsplit"
+is the obvious strict per-row version: urlsplit, IDNA-encode the host, check
+it. "batch" is urlcheck.check_urls (regex fast path, urlsplit only for the
+rest, blocklist trie), and "processes" the same fanned out to worker
+processes. The input is mostly ordinary links with some upper-case hosts,
+internationalized names and junk.
+
+    python benchmarks/bench_urlcheck.py --rows 100000 --processes 2
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import urlcheck  # noqa: E402
+
+JUNK = ["https://", "https://exa mple.com/", "ftp://files.example.com/", "not a url", "https://user:pw@example.com/",
+        "https://example.com:99999/", "https://localhost/", "https://a..b.com/", "javascript:alert(1)",
+        "https://phish.example.net/login"]
+
+
+def make_urls(n, rng):
+    urls = []
+    for i in range(n):
+        roll = rng.random()
+        if roll < 0.85:
+            urls.append("https://www.example%d.com/path/%d?utm_source=news&id=%d" % (i % 5000, i, i))
+        elif roll < 0.92:
+            urls.append("HTTPS://Shop%d.Example.COM/Item/%d" % (i % 100, i))
+        elif roll < 0.95:
+            urls.append("https://例え%d.jp/ページ/%d" % (i % 100, i))
+        else:
+            urls.append(rng.choice(JUNK))
+    return urls
+
+
+def prefix(urls):
+    return [(url if url.startswith(("http://", "https://")) else None) for url in urls]
+
+
+def per_row_urlsplit(urls):
+    results = []
+    for url in urls:
+        try:
+            parts = urlsplit(url)
+            host = parts.hostname
+            if parts.scheme not in ("http", "https") or not host or " " in url:
+                results.append(None)
+                continue
+            host.encode("idna")
+            parts.port
+            results.append(url)
+        except (ValueError, UnicodeError):
+            results.append(None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--processes", type=int, default=2)
+    args = parser.parse_args()
+
+    urls = make_urls(args.rows, random.Random(1))
+    blocklist = urlcheck.DomainTrie(["phish.example.net", "malware.example.org"]
+                                    + ["blocked%d.example.com" % i for i in range(10000)])
+
+    print("%-10s %10s %10s" % ("mode", "us/row", "rejected"))
+    for name, fn in (("prefix", prefix), ("urlsplit", per_row_urlsplit),
+                     ("batch", lambda u: [r[0] for r in urlcheck.check_urls(u, blocklist)])):
+        start = time.perf_counter()
+        results = fn(urls)
+        elapsed = time.perf_counter() - start
+        print("%-10s %10.2f %10d" % (name, elapsed / len(urls) * 1e6, sum(1 for r in results if r is None)))
+
+    if args.processes > 1:
+        # Fan-out uses the module blocklist (URL_BLOCKLIST), here empty
+        urlcheck.PROCESSES = args.processes
+        urlcheck.check_urls(urls[:urlcheck.FANOUT_MIN_ROWS])  # start the pool outside the timing
+        start = time.perf_counter()
+        results = urlcheck.check_urls(urls)
+        elapsed = time.perf_counter() - start
+        print("%-10s %10.2f %10d  (%d processes, %d CPUs)" % (
+            "processes", elapsed / len(urls) * 1e6, sum(1 for r in results if r[0] is None),
+            args.processes, os.cpu_count()))
+
+    print("errors: %s" % dict(Counter(code for _, code in urlcheck.check_urls(urls, blocklist) if code)))
+
+
+if __name__ == "__main__":
+    main()
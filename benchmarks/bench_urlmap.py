@@ -0,0 +1,72 @@
+"""URL map: export time and size, load time, and lookup cost next to SQLite.
+
+Fills a database with N links, exports the map and compares a lookup in the
+mapped file (hit and miss) with the indexed SELECT a cold redirect runs. The
+SELECT is timed in-process; through the app it also pays the executor hop.
+
+    python benchmarks/bench_urlmap.py --links 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import encode_base62, make_allocator  # noqa: E402
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+from storage import get_original_url  # noqa: E402
+from urlmap import MapFile, export_map  # noqa: E402
+
+
+def timed(fn, codes):
+    start = time.perf_counter()
+    for code in codes:
+        fn(code)
+    return (time.perf_counter() - start) / len(codes) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=1000000)
+    parser.add_argument("--probes", type=int, default=100000)
+    args = parser.parse_args()
+
+    allocator = make_allocator("counter")
+    codes = [encode_base62(allocator.permute(i), 6) for i in range(args.links)]
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        conn = connect(path)
+        migrate(conn)
+        conn.executemany(
+            "INSERT INTO urls (short_code, original_url, created_at) VALUES (?, ?, '2026-01-01T00:00:00')",
+            ((code, "https://example.com/campaign/%d?utm_source=news" % i) for i, code in enumerate(codes)),
+        )
+        conn.commit()
+
+        out = path + ".map"
+        start = time.perf_counter()
+        export_map([path], out)
+        export_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        mapped = MapFile(out)
+        load_ms = (time.perf_counter() - start) * 1000
+        print("%d links: export %.1fs, %.1f MiB (%.1f bytes/link), load %.2f ms" % (
+            args.links, export_seconds, mapped.size / 2 ** 20, mapped.size / args.links, load_ms))
+
+        hits = rng.sample(codes, min(args.probes, len(codes)))
+        misses = ["x" + code[1:] for code in hits]
+        print("%-20s %10s" % ("lookup", "us"))
+        print("%-20s %10.2f" % ("map hit", timed(mapped.find, hits)))
+        print("%-20s %10.2f" % ("map miss", timed(mapped.find, misses)))
+        print("%-20s %10.2f" % ("sqlite hit", timed(lambda code: get_original_url(conn, code), hits)))
+        mapped.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+"""Reproducible benchmark suite for the redirect, bulk, admin and allocation paths.
+
+Seeds deterministic synthetic databases (cached in --data-dir and copied
+before each run), runs every scenario against the app either in-process over
+ASGI or over a local uvicorn it starts itself, and writes all results, with
+the environment they were measured in, as one JSON document.
+
+    python benchmarks/suite.py --sizes 10k,1m --out results.json
+    python benchmarks/suite.py --sizes 10m --transport uvicorn --scenarios redirect,admin
+    python benchmarks/suite.py --compare before.json after.json
+
+Scenarios:
+    redirect    GET /{code} over a hot set (plus unknown codes): req/s, p50/p90/p99
+    bulk        POST /api/bulk-rows at several batch sizes: rows/s, p50/p99 per request
+    admin       /api/admin/urls first page, deep cursor pages, campaign filter, summary
+    allocation  code minting and bulk_insert cost per row, counter vs random engine
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import admin  # noqa: E402
+import migrations  # noqa: E402
+from allocator import CODE_RETRIES, encode_base62, make_allocator  # noqa: E402
+from bulk import bulk_insert, url_hash  # noqa: E402
+
+SCENARIOS = ("redirect", "bulk", "admin", "allocation")
+CAMPAIGNS = 50
+EPOCH = 1700000000
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = {"k": 10 ** 3, "m": 10 ** 6}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def latency_summary(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def code_retries():
+    return sum(sample[3] for sample in CODE_RETRIES.samples())
+
+
+def seed_code(allocator, n):
+    return encode_base62(allocator.permute(n), allocator.length)
+
+
+# -- seeding ---------------------------------------------------------------
+
+def seed(path, rows):
+    """Fill a fresh database with ``rows`` links minted as the counter engine would."""
+    allocator = make_allocator("counter")
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.create_function("seed_code", 1, lambda n: seed_code(allocator, n), deterministic=True)
+    conn.create_function("seed_hash", 1, url_hash, deterministic=True)
+    # Totals are recomputed once at the end instead of by a trigger per row
+    conn.execute("DROP TRIGGER trg_urls_insert_totals")
+    conn.execute("""
+        WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n + 1 < ?)
+        INSERT INTO urls (short_code, original_url, created_at, campaign, url_hash)
+        SELECT seed_code(n), 'https://example.com/p/' || n,
+               strftime('%Y-%m-%dT%H:%M:%S', ? + n, 'unixepoch'),
+               'campaign-' || (n % ?), seed_hash('https://example.com/p/' || n)
+        FROM seq
+    """, (rows, EPOCH, CAMPAIGNS))
+    for statement in admin.SCHEMA:
+        conn.execute(statement)
+    conn.execute("DELETE FROM url_totals")
+    conn.execute("DELETE FROM campaign_stats")
+    conn.execute("INSERT INTO url_totals (id, urls, clicks) SELECT 1, COUNT(*), 0 FROM urls")
+    conn.execute("""
+        INSERT INTO campaign_stats (campaign, urls, clicks)
+        SELECT campaign, COUNT(*), 0 FROM urls GROUP BY campaign
+    """)
+    conn.execute("INSERT OR REPLACE INTO code_allocator (name, next_id) VALUES ('default', ?)", (rows,))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+
+
+def seeded_copy(data_dir, rows):
+    """Path of a fresh working copy of the cached seed database for ``rows``."""
+    os.makedirs(data_dir, exist_ok=True)
+    cached = os.path.join(data_dir, "seed-%d.db" % rows)
+    if not os.path.exists(cached):
+        start = time.perf_counter()
+        seed(cached + ".tmp", rows)
+        os.replace(cached + ".tmp", cached)
+        print("seeded %d rows in %.1fs" % (rows, time.perf_counter() - start), file=sys.stderr)
+    work = os.path.join(data_dir, "work-%d.db" % rows)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(work + suffix):
+            os.remove(work + suffix)
+    shutil.copyfile(cached, work)
+    return work
+
+
+# -- transports ------------------------------------------------------------
+
+class AsgiClient:
+    """Calls the ASGI app directly; one instance serves every concurrent client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def connection(self):
+        return self
+
+    async def close(self):
+        pass
+
+    async def request(self, method, path, body=b"", headers=()):
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+            "root_path": "", "query_string": query.encode(),
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers]
+                       + [(b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+        }
+        status, chunks, sent = [0], [], [False]
+
+        async def receive():
+            if sent[0]:
+                await asyncio.sleep(3600)
+            sent[0] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return status[0], b"".join(chunks)
+
+
+class HttpConnection:
+    """Minimal HTTP/1.1 keep-alive client (Content-Length bodies only)."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def close(self):
+        self.writer.close()
+
+    async def request(self, method, path, body=b"", headers=()):
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s:%d" % (self.host, self.port),
+                 "Content-Length: %d" % len(body)]
+        lines.extend("%s: %s" % header for header in headers)
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+            elif name.lower() == "transfer-encoding":
+                raise RuntimeError("chunked responses are not supported")
+        return status, await self.reader.readexactly(length)
+
+
+class HttpClient:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    async def connection(self):
+        return await HttpConnection(self.host, self.port).open()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(env, port, timeout=60):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited with %s" % server.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("uvicorn did not start within %ds" % timeout)
+
+
+# -- scenarios -------------------------------------------------------------
+
+async def drive(client, jobs, concurrency):
+    """Run ``jobs`` (list of (method, path, body, headers)) over ``concurrency`` connections."""
+    latencies, errors = [], 0
+    queue = list(reversed(jobs))
+
+    async def worker():
+        nonlocal errors
+        conn = await client.connection()
+        try:
+            while queue:
+                method, path, body, headers = queue.pop()
+                start = time.perf_counter()
+                status, _ = await conn.request(method, path, body, headers)
+                latencies.append(time.perf_counter() - start)
+                if status >= 400 and not path.startswith("/zz"):
+                    errors += 1
+        finally:
+            await conn.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start, errors
+
+
+async def scenario_redirect(client, rows, args):
+    allocator = make_allocator("counter")
+    rng = random.Random(args.seed)
+    hot = [seed_code(allocator, rng.randrange(rows)) for _ in range(min(args.hot, rows))]
+    jobs = [("GET", "/zz%d" % rng.randrange(1000) if rng.random() < args.unknown else "/" + rng.choice(hot),
+             b"", ()) for _ in range(args.requests)]
+    # Warm-up pass fills the redirect cache the way steady traffic would
+    await drive(client, jobs[: len(jobs) // 10], args.concurrency)
+    latencies, elapsed, errors = await drive(client, jobs, args.concurrency)
+    return [dict(latency_summary(latencies, elapsed), scenario="redirect", concurrency=args.concurrency,
+                 hot=len(hot), unknown=args.unknown, errors=errors)]
+
+
+async def scenario_bulk(client, rows, args):
+    results = []
+    headers = (("Content-Type", "application/json"),)
+    for batch in args.batch_sizes:
+        count = max(1, args.bulk_rows // batch)
+        jobs = []
+        for r in range(count):
+            body = json.dumps({"rows": [{"url": "https://bench.example/%d/%d/%d" % (batch, r, i)}
+                                        for i in range(batch)]}).encode()
+            jobs.append(("POST", "/api/bulk-rows", body, headers))
+        latencies, elapsed, errors = await drive(client, jobs, 1)
+        summary = latency_summary(latencies, elapsed)
+        results.append(dict(summary, scenario="bulk", batch=batch, rows_per_s=round(batch * count / elapsed, 1),
+                            errors=errors))
+    return results
+
+
+async def scenario_admin(client, rows, args):
+    results = []
+    conn = await client.connection()
+
+    async def timed(variant, paths):
+        latencies = []
+        start = time.perf_counter()
+        for path in paths:
+            t = time.perf_counter()
+            status, body = await conn.request("GET", path)
+            latencies.append(time.perf_counter() - t)
+            if status != 200:
+                raise RuntimeError("%s -> %d" % (path, status))
+        results.append(dict(latency_summary(latencies, time.perf_counter() - start), scenario="admin",
+                            variant=variant))
+        return body
+
+    await timed("first_page", ["/api/admin/urls?limit=50"] * args.admin_requests)
+    await timed("campaign_page", ["/api/admin/urls?limit=50&campaign=campaign-7"] * args.admin_requests)
+    await timed("summary", ["/api/admin/summary"] * args.admin_requests)
+
+    # Deep pagination: follow the cursor page after page
+    latencies, cursor = [], None
+    start = time.perf_counter()
+    for _ in range(args.admin_requests):
+        path = "/api/admin/urls?limit=50" + ("&cursor=" + cursor if cursor else "")
+        t = time.perf_counter()
+        status, body = await conn.request("GET", path)
+        latencies.append(time.perf_counter() - t)
+        cursor = json.loads(body)["next_cursor"]
+        if not cursor:
+            break
+    results.append(dict(latency_summary(latencies, time.perf_counter() - start), scenario="admin",
+                        variant="cursor_walk"))
+    await conn.close()
+    return results
+
+
+def scenario_allocation(path, rows, args):
+    """Per-row cost of minting codes and of bulk inserts on a table of ``rows`` links."""
+    results = []
+    conn = sqlite3.connect(path)
+    # Whole batches of 1000; main() rejects --alloc-rows below one batch
+    batches = args.alloc_rows // 1000
+    count = batches * 1000
+    for engine in ("counter", "random"):
+        allocator = make_allocator(engine)
+        start = time.perf_counter()
+        for _ in range(batches):
+            allocator.allocate(conn, 1000)
+        conn.commit()
+        mint = (time.perf_counter() - start) / count
+
+        retries = code_retries()
+        start = time.perf_counter()
+        for b in range(batches):
+            bulk_insert(conn, allocator, ["https://alloc.example/%s/%d/%d" % (engine, b, i) for i in range(1000)])
+        insert = (time.perf_counter() - start) / count
+        retried = code_retries() - retries
+        results.append({"scenario": "allocation", "engine": engine, "rows": count,
+                        "mint_us_per_code": round(mint * 1e6, 3),
+                        "insert_us_per_row": round(insert * 1e6, 3), "retries": retried})
+    conn.close()
+    return results
+
+
+# -- runner ----------------------------------------------------------------
+
+def bench_env(path):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_PATH": path,
+        "STORAGE_ENGINE": "sqlite",
+        "RATE_LIMIT_RPS": "0",
+        "BULK_ROWS_PER_SECOND": "0",
+        "WORKERS": "1",
+    })
+    return env
+
+
+async def run_app_scenarios(rows, path, args, scenarios):
+    env = bench_env(path)
+    results = []
+    runners = {"redirect": scenario_redirect, "bulk": scenario_bulk, "admin": scenario_admin}
+    if args.transport == "uvicorn":
+        port = free_port()
+        server = start_uvicorn(env, port)
+        try:
+            client = HttpClient("127.0.0.1", port)
+            for name in scenarios:
+                results.extend(await runners[name](client, rows, args))
+        finally:
+            server.terminate()
+            server.wait()
+        return results
+
+    # main.py opens templates/ relative to the working directory
+    os.chdir(ROOT)
+    os.environ.update(env)
+    import main as app_module
+    app = app_module.app
+    async with app.router.lifespan_context(app):
+        client = AsgiClient(app)
+        for name in scenarios:
+            results.extend(await runners[name](client, rows, args))
+    return results
+
+
+def run_size(rows, args, out):
+    # Runs in its own process: the app reads its configuration at import time
+    path = seeded_copy(args.data_dir, rows)
+    results = []
+    app_scenarios = [name for name in args.scenarios if name != "allocation"]
+    if app_scenarios:
+        results.extend(asyncio.run(run_app_scenarios(rows, path, args, app_scenarios)))
+    if "allocation" in args.scenarios:
+        results.extend(scenario_allocation(path, rows, args))
+    for result in results:
+        result["size"] = rows
+        result["transport"] = args.transport if result["scenario"] != "allocation" else "direct"
+    out.put(results)
+
+
+def child_results(child, out, poll=5):
+    # Results are read before join (a large put blocks until read); a child
+    # that died without putting them must not leave us waiting forever
+    while True:
+        try:
+            return out.get(timeout=poll)
+        except queue.Empty:
+            if child.is_alive():
+                continue
+        try:
+            return out.get(timeout=1)
+        except queue.Empty:
+            sys.exit("benchmark child exited with code %s and no results" % child.exitcode)
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def result_key(result):
+    return tuple((k, result[k]) for k in ("scenario", "size", "transport", "batch", "variant", "engine")
+                 if k in result)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {result_key(r): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    metrics = ("rps", "rows_per_s", "p50_ms", "p99_ms", "mint_us_per_code", "insert_us_per_row")
+    for result in after:
+        old = before.get(result_key(result))
+        if old is None:
+            continue
+        label = " ".join(str(v) for _, v in result_key(result))
+        for metric in metrics:
+            if metric in result and old.get(metric):
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                print("%-40s %-18s %12s -> %12s  %+6.1f%%" % (label, metric, old[metric], result[metric], change))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10k,1m,10m")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--transport", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "benchmarks", "data"))
+    parser.add_argument("--out", default=None, help="JSON results file (default: stdout)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=20000, help="redirect requests")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--hot", type=int, default=10000)
+    parser.add_argument("--unknown", type=float, default=0.05)
+    parser.add_argument("--batch-sizes", default="10,100,1000,10000")
+    parser.add_argument("--bulk-rows", type=int, default=20000, help="rows per batch size")
+    parser.add_argument("--admin-requests", type=int, default=200)
+    parser.add_argument("--alloc-rows", type=int, default=20000)
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    if "allocation" in args.scenarios and args.alloc_rows < 1000:
+        parser.error("--alloc-rows must be at least 1000 (one batch)")
+    # The scenario children chdir to the repository root
+    args.data_dir = os.path.abspath(args.data_dir)
+
+    results = []
+    for rows in [parse_size(size) for size in args.sizes.split(",")]:
+        out = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_size, args=(rows, args, out))
+        child.start()
+        results.extend(child_results(child, out))
+        child.join()
+        if child.exitcode:
+            sys.exit("benchmark for %d rows failed" % rows)
+
+    document = {"environment": environment(), "parameters": {
+        k: v for k, v in vars(args).items() if k not in ("compare", "out", "data_dir")
+    }, "results": results}
+    text = json.dumps(document, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import codecs
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+
+from allocator import CODE_RETRIES, CodeSpaceExhausted
+from metrics import SIZE_BUCKETS, Counter, Histogram
+from urlcheck import MESSAGES as URL_ERRORS, check_url, check_urls
+
+# Bulk insert engine: validate the whole list, mint every code in one call to
+# the allocator and write all rows with a single executemany inside one
+# explicit transaction. Custom codes are checked against the UNIQUE index with
+# one set-based query. Collisions of minted codes (rare: legacy random codes)
+# fall back to row-by-row inserts for the affected batch only.
+
+INSERT_URL_SQL = """
+    INSERT INTO urls (short_code, original_url, created_at, custom_name, campaign, url_hash, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Lifetime of new links without their own expires_at; 0 keeps them forever
+LINK_TTL = float(os.environ.get("LINK_TTL_DAYS", "0")) * 86400
+
+CUSTOM_CODE_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# First path segments taken by the app's own routes
+RESERVED_CODES = {"admin", "analytics", "api", "bulk", "docs", "metrics", "redoc", "openapi.json", "favicon.ico"}
+
+BULK_ROWS = Histogram("bulk_batch_rows", "Rows per bulk insert call.", buckets=SIZE_BUCKETS)
+BULK_FALLBACKS = Counter("bulk_slow_path_total", "Bulk batches that fell back to row-by-row inserts.")
+
+# Failed rows carry a stable ``error_code`` next to the message shown to users
+ERRORS = dict(
+    URL_ERRORS,
+    invalid_custom_code="無効なカスタムコード",
+    duplicate_custom_code="カスタムコードが重複しています",
+    custom_code_taken="カスタムコードは既に使用されています",
+    code_collision="短縮コード重複",
+    code_space_exhausted="短縮コード生成に失敗しました",
+    invalid_expiry="無効な有効期限",
+)
+
+
+def failure(url, code, message=None):
+    return {"url": url, "success": False, "error": message or ERRORS[code], "error_code": code}
+
+
+def validate_url(url):
+    return check_url(url)[1] is None
+
+
+def parse_expiry(value, now):
+    """Unix seconds from an ISO 8601 date/time or a unix timestamp; None without a value.
+
+    Raises ValueError for anything else and for times not in the future.
+    """
+    if value is None:
+        return int(now + LINK_TTL) if LINK_TTL else None
+    value = str(value)
+    if value.isdigit():
+        expires_at = int(value)
+    else:
+        expires_at = int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+    if expires_at <= now:
+        raise ValueError("expiry in the past")
+    return expires_at
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+# scheme://host/path?query#fragment without port, userinfo or IPv6 literal
+SIMPLE_URL_RE = re.compile(r"([A-Za-z][A-Za-z0-9+.-]*)://([^/?#:@\[\]]*)((?:/[^?#]*)?)([?#].*)?", re.S)
+
+
+def normalize_url(url):
+    """Canonical form used for dedupe: lower-case scheme/host, no default port or trailing slash."""
+    match = SIMPLE_URL_RE.fullmatch(url.strip())
+    if match:
+        scheme, host, path, rest = match.groups()
+        return "%s://%s%s%s" % (scheme.lower(), host.lower(), path.rstrip("/"), rest or "")
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = "[%s]" % host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = "%s:%d" % (host, port)
+    if parts.username is not None:
+        userinfo = parts.username + (":" + parts.password if parts.password is not None else "")
+        host = userinfo + "@" + host
+    return urlunsplit((scheme, host, parts.path.rstrip("/"), parts.query, parts.fragment))
+
+
+def url_hash(url):
+    digest = hashlib.sha1(normalize_url(url).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def ensure_schema(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(urls)")}
+    if "url_hash" not in columns:
+        conn.execute("ALTER TABLE urls ADD COLUMN url_hash INTEGER")
+        rows = conn.execute("SELECT rowid, original_url FROM urls").fetchall()
+        conn.executemany(
+            "UPDATE urls SET url_hash = ? WHERE rowid = ?",
+            ((url_hash(row[1]), row[0]) for row in rows),
+        )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_url_hash ON urls(url_hash)")
+
+
+def find_existing(conn, keys):
+    """Map (url_hash, campaign) -> short_code for links that already exist; one query."""
+    if not keys:
+        return {}
+    rows = conn.execute("""
+        SELECT url_hash, campaign, short_code, original_url FROM urls
+        WHERE url_hash IN (SELECT value FROM json_each(?))
+            AND (expires_at IS NULL OR expires_at > ?)
+        GROUP BY url_hash, campaign
+    """, (json.dumps(sorted({h for h, _ in keys})), int(time.time())))
+    found = {}
+    for row in rows:
+        key = (row[0], row[1])
+        if key in keys and normalize_url(row[3]) == keys[key]:
+            found[key] = row[2]
+    return found
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def normalize_row(item):
+    """Accept a bare URL string or a dict row from the bulk page / uploads."""
+    if isinstance(item, str):
+        return {"url": item.strip(), "custom_code": None, "custom_name": None, "campaign": None, "expires_at": None}
+    return {
+        "url": _clean(item.get("url") or item.get("original_url")) or "",
+        "custom_code": _clean(item.get("custom_code") or item.get("custom_slug")),
+        "custom_name": _clean(item.get("custom_name")),
+        "campaign": _clean(item.get("campaign") or item.get("campaign_name")),
+        "expires_at": _clean(item.get("expires_at")),
+    }
+
+
+def taken_codes(conn, codes):
+    # Archived links keep their codes (see archive.py)
+    if not codes:
+        return set()
+    rows = conn.execute("""
+        SELECT short_code FROM urls WHERE short_code IN (SELECT value FROM json_each(?1))
+        UNION ALL
+        SELECT short_code FROM urls_archive WHERE short_code IN (SELECT value FROM json_each(?1))
+    """, (json.dumps(list(codes)),))
+    return {row[0] for row in rows}
+
+
+def _insert_rows_slow(conn, allocator, rows, custom, max_attempts):
+    # rows: list of [code, url, created_at, name, campaign, hash, expires_at]; returns {index: error code}
+    errors = {}
+    for i, row in enumerate(rows):
+        for _ in range(1 if i in custom else max_attempts):
+            try:
+                conn.execute(INSERT_URL_SQL, row)
+                break
+            except sqlite3.IntegrityError:
+                if i not in custom:
+                    CODE_RETRIES.inc()
+                    row[0] = allocator.next_code(conn)
+        else:
+            errors[i] = "custom_code_taken" if i in custom else "code_collision"
+    return errors
+
+
+def validate_rows(items):
+    """Check normalized rows; returns (results, pending indices, {custom_code: index}).
+
+    URLs are checked as one batch (see urlcheck); every pending row gets its
+    normalized URL as ``item["target"]``, which is what gets stored, and its
+    expiry in unix seconds as ``item["expires"]``.
+    """
+    results = [None] * len(items)
+    pending = []
+    requested = {}
+    now = time.time()
+    checked = check_urls([item["url"] for item in items])
+    for i, (item, (target, error)) in enumerate(zip(items, checked)):
+        code = item["custom_code"]
+        if error is None:
+            try:
+                item["expires"] = parse_expiry(item["expires_at"], now)
+            except (ValueError, OverflowError, OSError):
+                error = "invalid_expiry"
+        if error is not None:
+            results[i] = failure(item["url"], error)
+        elif code is not None and (not CUSTOM_CODE_RE.match(code) or code.lower() in RESERVED_CODES):
+            results[i] = failure(item["url"], "invalid_custom_code")
+        elif code is not None and code in requested:
+            results[i] = failure(item["url"], "duplicate_custom_code")
+        else:
+            if code is not None:
+                requested[code] = i
+            item["target"] = target
+            pending.append(i)
+    return results, pending, requested
+
+
+def dedupe_keys(items, hashes):
+    """(url_hash, campaign) -> normalized URL for the rows in ``hashes`` without a custom code."""
+    keys = {}
+    for i, h in hashes.items():
+        if items[i]["custom_code"] is None:
+            keys[(h, items[i]["campaign"])] = normalize_url(items[i]["target"])
+    return keys
+
+
+def plan_reuse(items, pending, hashes, existing):
+    """Map row index -> existing short code, or the index of the first copy in this batch."""
+    reuse, first = {}, {}
+    for i in pending:
+        if items[i]["custom_code"] is not None:
+            continue
+        key = (hashes[i], items[i]["campaign"])
+        if key in existing:
+            reuse[i] = existing[key]
+        elif key in first:
+            reuse[i] = first[key]
+        else:
+            first[key] = i
+    return reuse
+
+
+def apply_reuse(results, items, reuse):
+    for i, target in reuse.items():
+        if isinstance(target, int):
+            results[i] = dict(results[target], url=items[i]["url"])
+            if results[i]["success"]:
+                results[i]["reused"] = True
+        else:
+            results[i] = {"url": items[i]["url"], "success": True, "short_code": target, "reused": True}
+
+
+def bulk_insert(conn, allocator, items, dedupe=False, might_exist=None, validated=False, max_attempts=10):
+    """Insert ``items`` (URL strings or row dicts) in one transaction.
+
+    Returns one dict per input row, in order: ``{"url", "success", "short_code"}``
+    on success and ``{"url", "success", "error"}`` on failure. With ``dedupe``,
+    rows without a custom code reuse an existing link for the same normalized
+    URL and campaign (``"reused": True``) instead of creating a new one.
+    ``might_exist(code)`` (a membership filter) can rule custom codes out of
+    the taken-code lookup. ``validated`` items already went through
+    validate_rows (sharded storage checks a batch once, before splitting it).
+    """
+    if validated:
+        results, pending = [None] * len(items), list(range(len(items)))
+        requested = {item["custom_code"]: i for i, item in enumerate(items) if item["custom_code"] is not None}
+    else:
+        items = [normalize_row(item) for item in items]
+        results, pending, requested = validate_rows(items)
+    BULK_ROWS.observe(len(items))
+    if not pending:
+        return results
+
+    created_at = datetime.now().isoformat()
+    reuse = {}
+    premint = None
+    if not conn.in_transaction:
+        # Codes are leased before the insert transaction, so a block the
+        # allocator leases is committed on its own and a rollback below cannot
+        # hand it out twice. With dedupe the count is only known inside, so
+        # enough ids for every row are leased and minted from there.
+        auto = sum(1 for i in pending if items[i]["custom_code"] is None)
+        try:
+            if dedupe:
+                allocator.prefetch(conn, auto)
+            else:
+                premint = allocator.allocate(conn, auto)
+        except CodeSpaceExhausted as e:
+            for i in pending:
+                results[i] = failure(items[i]["url"], "code_space_exhausted", str(e))
+            return results
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Custom codes: one set-based lookup, consistent because we hold the write lock
+        maybe = requested if might_exist is None else [code for code in requested if might_exist(code)]
+        for code in taken_codes(conn, maybe):
+            i = requested.pop(code)
+            results[i] = failure(items[i]["url"], "custom_code_taken")
+        pending = [i for i in pending if results[i] is None]
+
+        hashes = {i: url_hash(items[i]["target"]) for i in pending}
+        if dedupe:
+            existing = find_existing(conn, dedupe_keys(items, hashes))
+            reuse = plan_reuse(items, pending, hashes, existing)
+            pending = [i for i in pending if i not in reuse]
+
+        auto = [i for i in pending if items[i]["custom_code"] is None]
+        minted = iter(premint if premint is not None else allocator.allocate(conn, len(auto)))
+        rows, custom = [], set()
+        for n, i in enumerate(pending):
+            item = items[i]
+            if item["custom_code"] is not None:
+                custom.add(n)
+                code = item["custom_code"]
+            else:
+                code = next(minted)
+            rows.append([code, item["target"], created_at, item["custom_name"], item["campaign"], hashes[i],
+                         item["expires"]])
+
+        conn.execute("SAVEPOINT bulk_insert")
+        try:
+            conn.executemany(INSERT_URL_SQL, rows)
+            errors = {}
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK TO bulk_insert")
+            BULK_FALLBACKS.inc()
+            errors = _insert_rows_slow(conn, allocator, rows, custom, max_attempts)
+        conn.execute("RELEASE bulk_insert")
+        conn.commit()
+    except CodeSpaceExhausted as e:
+        conn.rollback()
+        for i in pending:
+            results[i] = failure(items[i]["url"], "code_space_exhausted", str(e))
+        pending, rows, errors = [], [], {}
+    except Exception:
+        conn.rollback()
+        raise
+
+    for n, (i, row) in enumerate(zip(pending, rows)):
+        if n in errors:
+            results[i] = failure(items[i]["url"], errors[n])
+        else:
+            results[i] = {"url": items[i]["url"], "success": True, "short_code": row[0]}
+    # Reused rows point at an existing code or at the first copy in this batch
+    apply_reuse(results, items, reuse)
+    return results
+
+
+def dedupe_summary(results):
+    reused = sum(1 for row in results if row.get("reused"))
+    created = sum(1 for row in results if row["success"] and not row.get("reused"))
+    return {"created": created, "reused": reused}
+
+
+# Streaming ingestion: uploads are read in fixed-size chunks and processed in
+# fixed-size batches, so memory stays flat regardless of upload size.
+
+STREAM_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def detect_format(filename, content_type):
+    name = (filename or "").lower()
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in (content_type or ""):
+        return "ndjson"
+    return "csv"
+
+
+def iter_lines(fileobj, chunk_size=READ_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        lines = (tail + decoder.decode(chunk, final=not chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if not chunk:
+            break
+    if tail:
+        yield tail
+
+
+CSV_COLUMNS = {
+    "url": "url", "original_url": "url",
+    "custom_code": "custom_code", "custom_slug": "custom_code",
+    "custom_name": "custom_name",
+    "campaign": "campaign", "campaign_name": "campaign",
+    "expires_at": "expires_at",
+}
+
+
+def iter_csv_rows(lines):
+    columns = None
+    for n, row in enumerate(csv.reader(lines)):
+        if not row:
+            continue
+        if n == 0:
+            header = [CSV_COLUMNS.get(cell.strip().lower()) for cell in row]
+            if "url" in header:
+                columns = header
+                continue
+        if columns is None:
+            if row[0].strip():
+                yield row[0].strip()
+            continue
+        item = {name: value for name, value in zip(columns, row) if name}
+        if any(item.values()):
+            yield item
+
+
+def iter_ndjson_rows(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield line
+            continue
+        yield item if isinstance(item, dict) else str(item)
+
+
+def iter_upload_rows(fileobj, fmt):
+    lines = iter_lines(fileobj)
+    if fmt == "ndjson":
+        return iter_ndjson_rows(lines)
+    return iter_csv_rows(lines)
+
+
+def iter_batches(items, size=STREAM_BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+# In-process LRU/TTL cache for the redirect hot path: short_code -> original_url.
+# Unknown codes are cached as negatives (with a shorter TTL) so scanners hitting
+# random codes do not reach the database.
+
+MISS = object()
+
+
+class RedirectCache:
+    def __init__(self, maxsize=100000, ttl=300, negative_ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, code):
+        """Return the cached URL, None for a cached negative, or MISS."""
+        with self._lock:
+            entry = self._data.get(code)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            url, expires = entry
+            if expires < self._clock():
+                del self._data[code]
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(code)
+            if url is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return url
+
+    def put(self, code, url, expires_at=None):
+        """Cache ``url`` (None: negative); ``expires_at`` (unix seconds) caps the entry's lifetime."""
+        ttl = self.ttl if url is not None else self.negative_ttl
+        if expires_at is not None:
+            # The link's expiry is wall-clock time, the cache clock may not be
+            ttl = max(0.0, min(ttl, expires_at - time.time()))
+        with self._lock:
+            self._data[code] = (url, self._clock() + ttl)
+            self._data.move_to_end(code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, code):
+        with self._lock:
+            self._data.pop(code, None)
+
+    def invalidate_many(self, codes):
+        with self._lock:
+            for code in codes:
+                self._data.pop(code, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+# Write-behind click recording. The redirect handler only does a put_nowait on
+# an asyncio queue; a background task aggregates events and flushes them in
+# one transaction per batch: raw events into `clicks`, increments into
+# urls.clicks. A flush happens every `flush_interval` seconds, or as soon as
+# `high_water` events are buffered. When the queue itself is full, clicks are
+# folded into an overflow counter instead of blocking the redirect.
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clicks (
+            short_code TEXT NOT NULL,
+            clicked_at INTEGER NOT NULL
+        )
+    """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(urls)")}
+    if "clicks" not in columns:
+        conn.execute("ALTER TABLE urls ADD COLUMN clicks INTEGER NOT NULL DEFAULT 0")
+
+
+def write_clicks(conn, events, counts):
+    conn.executemany("INSERT INTO clicks (short_code, clicked_at) VALUES (?, ?)", events)
+    conn.executemany(
+        "UPDATE urls SET clicks = clicks + ? WHERE short_code = ?",
+        ((n, code) for code, n in counts.items()),
+    )
+    conn.commit()
+
+
+class ClickRecorder:
+    def __init__(self, storage, flush_interval=1.0, high_water=5000, max_queue=100000, on_flush=None):
+        self.storage = storage
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.max_queue = max_queue
+        self._queue = None
+        self._overflow = Counter()
+        self._carry = []
+        self._task = None
+        self._stopping = False
+        self.recorded = 0
+        self.overflowed = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Drain everything buffered, flush it and stop the background task."""
+        if self._task is None:
+            return
+        self._stopping = True
+        try:
+            # Wakes a consumer blocked on get(); a full queue means it is not blocked
+            self._queue.put_nowait(_STOP)
+        except asyncio.QueueFull:
+            pass
+        await self._task
+        self._task = None
+
+    def record(self, short_code):
+        self.recorded += 1
+        if self._queue is None:
+            self._overflow[short_code] += 1
+            return
+        try:
+            self._queue.put_nowait((short_code, int(time.time())))
+        except asyncio.QueueFull:
+            self._overflow[short_code] += 1
+            self.overflowed += 1
+
+    def pending(self):
+        return (self._queue.qsize() if self._queue else 0) + sum(self._overflow.values()) + len(self._carry)
+
+    def _drain(self, events):
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if event is not _STOP:
+                events.append(event)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        events = []
+        deadline = loop.time() + self.flush_interval
+        while not self._stopping:
+            timeout = deadline - loop.time()
+            if timeout > 0 and len(events) < self.high_water and not self._queue.full():
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                if event is not _STOP:
+                    events.append(event)
+                self._drain(events)
+                continue
+            self._drain(events)
+            await self._flush(events)
+            events = []
+            deadline = loop.time() + self.flush_interval
+        self._drain(events)
+        await self._flush(events)
+
+    async def _flush(self, events):
+        events = self._carry + events
+        self._carry = []
+        if self._overflow:
+            now = int(time.time())
+            overflow, self._overflow = self._overflow, Counter()
+            for code, n in overflow.items():
+                events.extend([(code, now)] * n)
+        if not events:
+            return
+        counts = Counter(code for code, _ in events)
+        try:
+            await self.storage.record_clicks(events, counts)
+        except Exception:
+            # Keep the batch and retry on the next flush rather than lose counts
+            self.flush_errors += 1
+            self._carry = events
+            logger.exception("click flush failed; %d events carried over", len(events))
+            return
+        self.flushed += len(events)
+        self.flushes += 1
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "overflowed": self.overflowed,
+            "flush_errors": self.flush_errors,
+            "pending": self.pending(),
+        }
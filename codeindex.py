@@ -0,0 +1,403 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from hashlib import blake2b
+
+# Membership index over every short code: a Bloom filter that answers
+# "definitely not taken" without touching SQLite, so 404s for unknown codes
+# and checks of free custom codes never reach the database. A "maybe" still
+# goes to the database, which stays the source of truth.
+#
+# The filter is built in the background from a rowid-ordered scan of urls
+# (per shard), updated in process on every insert, and snapshotted to disk
+# with the rowid watermark it covers, so a restart loads the snapshot and only
+# scans rows added since. Until the filter is ready every lookup is a "maybe".
+#
+# Rowids only grow, except that SQLite reuses the rowids of rows deleted from
+# the top of the table. A trigger counts such deletes (the epoch); when the
+# epoch moved, rows below the watermark may be unseen and the filter is rebuilt.
+# With several workers, each catches up on the others' inserts every
+# ``sync_interval`` seconds, and a "definitely not" is only trusted after a
+# catch-up that started once the question was asked (see confirm_absent).
+#
+# Archived links (see archive.py) keep their codes, so a build also scans
+# urls_archive. Links only get there from urls, whose codes the filter already
+# has, and a restored link is a new urls row, so catching up never needs it.
+
+logger = logging.getLogger(__name__)
+
+SCAN_CHUNK = 50000
+MAGIC = b"CODEIDX1"
+HEADER = struct.Struct("<8sI")
+MASK64 = (1 << 64) - 1
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS code_index_epoch (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        epoch INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO code_index_epoch (id, epoch) VALUES (1, 0)",
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_delete_epoch AFTER DELETE ON urls
+    WHEN OLD.rowid > (SELECT IFNULL(MAX(rowid), 0) FROM urls) BEGIN
+        UPDATE code_index_epoch SET epoch = epoch + 1 WHERE id = 1;
+    END
+    """,
+]
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def read_position(conn):
+    """(epoch, max rowid) of one database."""
+    epoch = conn.execute("SELECT epoch FROM code_index_epoch WHERE id = 1").fetchone()
+    top = conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM urls").fetchone()[0]
+    return (epoch[0] if epoch else 0), top
+
+
+def scan_chunk(conn, bloom, after, limit=SCAN_CHUNK):
+    """Add the codes of up to ``limit`` rows past rowid ``after``; returns (watermark, rows)."""
+    rows = conn.execute(
+        "SELECT rowid, short_code FROM urls WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, limit)
+    ).fetchall()
+    if rows:
+        bloom.add_many([row[1] for row in rows])
+        after = rows[-1][0]
+    return after, len(rows)
+
+
+def scan_archive_chunk(conn, bloom, after, limit=SCAN_CHUNK):
+    """Add the codes of up to ``limit`` archived links past code ``after``; returns (last code, rows)."""
+    rows = conn.execute(
+        "SELECT short_code FROM urls_archive WHERE short_code > ? ORDER BY short_code LIMIT ?", (after, limit)
+    ).fetchall()
+    if rows:
+        bloom.add_many([row[0] for row in rows])
+        after = rows[-1][0]
+    return after, len(rows)
+
+
+class BloomFilter:
+    """Bloom filter sized for ``capacity`` codes at ``error_rate`` false positives.
+
+    Positions come from one blake2b digest by double hashing. Adds take a lock
+    (they run on the event loop and on scan threads); lookups do not, since
+    bits are only ever set.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, bits=None, count=0):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8) if bits is None else bytearray(bits)
+        if len(self.bits) != (self.size + 7) // 8:
+            raise ValueError("bit array does not match capacity and error rate")
+        # Adds, not distinct codes: re-adding a code counts again
+        self.count = count
+        self._lock = threading.Lock()
+
+    def add_many(self, codes):
+        bits, size, hashes = self.bits, self.size, self.hashes
+        codes = list(codes)
+        # The lock is taken per slice so a scan thread never holds up the event loop for long
+        for start in range(0, len(codes), 1024):
+            with self._lock:
+                for code in codes[start:start + 1024]:
+                    h = int.from_bytes(blake2b(code.encode(), digest_size=16).digest(), "little")
+                    h1, h2 = h & MASK64, (h >> 64) | 1
+                    for _ in range(hashes):
+                        p = h1 % size
+                        bits[p >> 3] |= 1 << (p & 7)
+                        h1 += h2
+                self.count += len(codes[start:start + 1024])
+
+    def __contains__(self, code):
+        # Most unknown codes fail on the first probe or two, so positions are computed lazily
+        bits, size = self.bits, self.size
+        h = int.from_bytes(blake2b(code.encode(), digest_size=16).digest(), "little")
+        h1, h2 = h & MASK64, (h >> 64) | 1
+        for _ in range(self.hashes):
+            p = h1 % size
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+            h1 += h2
+        return True
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+    def estimated_error_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def snapshot(self):
+        """Parameters and a copy of the bits, consistent with each other."""
+        with self._lock:
+            return {"capacity": self.capacity, "error_rate": self.error_rate, "count": self.count}, bytes(self.bits)
+
+
+def write_snapshot(path, meta, bits):
+    head = json.dumps(meta).encode("utf-8")
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(head)))
+        f.write(head)
+        f.write(bits)
+    # Workers may snapshot concurrently; each file is complete, the last one wins
+    os.replace(tmp, path)
+
+
+def read_snapshot(path):
+    """(BloomFilter, meta) from a snapshot file; raises ValueError if it is not one."""
+    with open(path, "rb") as f:
+        magic, length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("not a code index snapshot")
+        meta = json.loads(f.read(length))
+        bloom = BloomFilter(meta["capacity"], meta["error_rate"], f.read(), meta["count"])
+    return bloom, meta
+
+
+def default_snapshot_path(storage):
+    # Next to the data it describes; the memory engine has nothing to come back to
+    if storage.engine == "memory":
+        return None
+    if storage.engine == "sharded":
+        return os.path.join(storage.directory, "codes.bloom")
+    return storage.db.path + ".codes"
+
+
+class CodeIndex:
+    def __init__(self, storage, error_rate=0.01, min_capacity=1000000, snapshot_path=None,
+                 sync_interval=0.0, snapshot_interval=300.0, chunk=SCAN_CHUNK):
+        self.storage = storage
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.snapshot_path = snapshot_path
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        self.chunk = chunk
+        self.filter = None
+        # Filter being built or loaded; it receives inserts until it replaces self.filter
+        self._next = None
+        # Per storage partition: [watermark rowid, epoch] covered by self.filter
+        self._marks = None
+        self._task = None
+        # confirm_absent tickets: asked so far, and covered by a finished catch-up
+        self._sync_lock = asyncio.Lock()
+        self._asked = 0
+        self._synced = 0
+        self.confirmations = 0
+        self.lookups = 0
+        self.skipped = 0
+        self.maybe_misses = 0
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.loaded_snapshot = False
+        self.snapshots = 0
+
+    @property
+    def ready(self):
+        return self.filter is not None
+
+    def might_contain(self, code):
+        bloom = self.filter
+        if bloom is None:
+            return True
+        self.lookups += 1
+        if code in bloom:
+            return True
+        self.skipped += 1
+        return False
+
+    async def confirm_absent(self, code):
+        """True if ``code`` is still not in the filter after catching up.
+
+        Only needed with several workers (``sync_interval`` set): a code another
+        worker inserted since the last catch-up is not in this filter yet.
+        Concurrent callers share one catch-up, as long as it started after
+        they asked.
+        """
+        if not self.sync_interval:
+            return True
+        self._asked += 1
+        ticket = self._asked
+        async with self._sync_lock:
+            if self._synced < ticket:
+                await self._sync()
+        bloom = self.filter
+        self.confirmations += 1
+        return bloom is not None and code not in bloom
+
+    async def _sync(self):
+        # Called with _sync_lock held; covers every ticket handed out before it starts
+        covered = self._asked
+        if self.filter is not None and not await self._catch_up():
+            self.filter = None
+        self._synced = covered
+
+    def maybe_missed(self):
+        # The filter said "maybe" and the database had nothing: a false positive or a deleted code
+        if self.filter is not None:
+            self.maybe_misses += 1
+
+    def add_many(self, codes):
+        codes = list(codes)
+        for bloom in (self.filter, self._next):
+            if bloom is not None:
+                bloom.add_many(codes)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._next = None
+        try:
+            await self.snapshot()
+        except Exception:
+            logger.exception("code index snapshot failed")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        tick = self.sync_interval or 5.0
+        last_snapshot = loop.time()
+        while True:
+            try:
+                if self.filter is None:
+                    if not await self._load():
+                        await self._build()
+                elif self.filter.count > self.filter.capacity:
+                    # Past capacity the error rate climbs; keep serving the old filter meanwhile
+                    await self._build()
+                elif self.sync_interval:
+                    async with self._sync_lock:
+                        await self._sync()
+                    if self.filter is None:
+                        continue
+                if self.snapshot_interval and loop.time() - last_snapshot >= self.snapshot_interval:
+                    last_snapshot = loop.time()
+                    await self.snapshot()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("code index update failed")
+            await asyncio.sleep(tick)
+
+    async def _scan(self, bloom, n, after, scan=scan_chunk):
+        while True:
+            after, rows = await self.storage.on_partition(n, scan, bloom, after, self.chunk)
+            if rows < self.chunk:
+                return after
+
+    async def _build(self):
+        start = time.perf_counter()
+        positions = [await self.storage.on_partition(n, read_position) for n in range(self.storage.partitions)]
+        # Max rowid approximates the row count; leave room to grow
+        rows = sum(top for _, top in positions)
+        if self.filter is not None:
+            rows = max(rows, self.filter.count)
+        bloom = self._next = BloomFilter(max(self.min_capacity, 2 * rows), self.error_rate)
+        try:
+            marks = []
+            for n, (epoch, _) in enumerate(positions):
+                marks.append([await self._scan(bloom, n, 0), epoch])
+                await self._scan(bloom, n, "", scan_archive_chunk)
+            self.filter, self._marks = bloom, marks
+        finally:
+            self._next = None
+        self.builds += 1
+        self.build_seconds = time.perf_counter() - start
+        logger.info("code index built: %d codes in %.1fs", bloom.count, self.build_seconds)
+
+    async def _catch_up(self, bloom=None, marks=None):
+        """Scan rows added past each watermark; False if the filter may be missing older rows."""
+        bloom = bloom or self.filter
+        marks = marks or self._marks
+        for n, mark in enumerate(marks):
+            epoch, top = await self.storage.on_partition(n, read_position)
+            if epoch != mark[1] or top < mark[0]:
+                return False
+            mark[0] = await self._scan(bloom, n, mark[0])
+        return True
+
+    async def _load(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        loop = asyncio.get_running_loop()
+        try:
+            bloom, meta = await loop.run_in_executor(None, read_snapshot, self.snapshot_path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning("ignoring code index snapshot %s: %s", self.snapshot_path, e)
+            return False
+        marks = meta.get("marks")
+        if bloom.error_rate != self.error_rate or not marks or len(marks) != self.storage.partitions:
+            return False
+        self._next = bloom
+        try:
+            if not await self._catch_up(bloom, marks):
+                logger.info("code index snapshot is stale; rebuilding")
+                return False
+            self.filter, self._marks = bloom, marks
+        finally:
+            self._next = None
+        self.loaded_snapshot = True
+        return True
+
+    async def snapshot(self):
+        """Write the filter and its watermarks to ``snapshot_path``; False if there is nothing to write."""
+        if self.filter is None or not self.snapshot_path:
+            return False
+        if not await self._catch_up():
+            self.filter = None
+            return False
+        meta, bits = self.filter.snapshot()
+        meta["marks"] = [list(mark) for mark in self._marks]
+        meta["written_at"] = int(time.time())
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.snapshot_path, meta, bits)
+        self.snapshots += 1
+        return True
+
+    def stats(self):
+        bloom = self.filter
+        stats = {
+            "ready": bloom is not None,
+            "building": self._next is not None,
+            "lookups": self.lookups,
+            "skipped": self.skipped,
+            "maybe_misses": self.maybe_misses,
+            "confirmations": self.confirmations,
+            "builds": self.builds,
+            "build_seconds": round(self.build_seconds, 3),
+            "loaded_snapshot": self.loaded_snapshot,
+            "snapshots": self.snapshots,
+        }
+        if bloom is not None:
+            stats.update({
+                "codes": bloom.count,
+                "capacity": bloom.capacity,
+                "error_rate": bloom.error_rate,
+                "estimated_error_rate": round(bloom.estimated_error_rate(), 6),
+                "hashes": bloom.hashes,
+                "memory_bytes": bloom.memory_bytes,
+            })
+        return stats
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from metrics import Counter, Histogram
+
+# Database access layer: a bounded pool of SQLite connections plus a dedicated
+# executor so blocking SQLite calls never run on the event loop. The executor
+# has as many threads as the pool has connections, so a worker thread never
+# waits for a connection.
+
+DB_PATH = os.environ.get("DATABASE_PATH", "url_shortener.db")
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+STATEMENT_CACHE_SIZE = 256
+
+DB_CONNECTS = Counter("db_connections_opened_total", "SQLite connections opened by the pools.")
+DB_CONNECT_SECONDS = Histogram("db_connect_duration_seconds", "Time to open and configure a connection.")
+DB_SECONDS = Histogram("db_operation_duration_seconds", "Time spent in one DB operation, by function.", ("operation",))
+DB_WAIT_SECONDS = Histogram("db_queue_wait_seconds", "Time a DB operation waited for an executor thread.")
+
+
+def connect(path=DB_PATH):
+    conn = sqlite3.connect(
+        path,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = self._created < self.size
+            if grow:
+                self._created += 1
+        if grow:
+            try:
+                start = time.perf_counter()
+                conn = connect(self.path)
+                DB_CONNECT_SECONDS.observe(time.perf_counter() - start)
+                DB_CONNECTS.inc()
+                return conn
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Database:
+    """Connection pool + executor, opened at app startup and closed at shutdown."""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.pool = None
+        self._executor = None
+
+    def open(self):
+        self.pool = ConnectionPool(self.path, self.size)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="sqlite")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _call(self, fn, args, queued):
+        start = time.perf_counter()
+        DB_WAIT_SECONDS.observe(start - queued)
+        try:
+            with self.pool.connection() as conn:
+                return fn(conn, *args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, getattr(fn, "__name__", "other"))
+
+    async def run(self, fn, *args):
+        """Run ``fn(conn, *args)`` on a pooled connection off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args, time.perf_counter())
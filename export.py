@@ -0,0 +1,271 @@
+import argparse
+import csv
+import heapq
+import io
+import sys
+from itertools import groupby
+
+import analytics
+from db import connect
+from serialize import dumps
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional; only the parquet format needs it
+    pyarrow = None
+
+# Streaming exports of links, campaigns and click rollups as CSV, NDJSON or
+# Parquet. Rows come from a cursor on a connection of the export's own (one
+# per database, each in a read transaction, so the export is one consistent
+# snapshot without holding a pooled connection) and are fetched and encoded
+# CHUNK rows at a time, so memory does not grow with the table.
+#
+# With sharded storage, links and per-link rollups are read shard after
+# shard; campaign datasets are read in key order from every shard at once and
+# summed, since each shard holds a part of every campaign.
+#
+#   python export.py links --format csv --out links.csv
+
+CHUNK = 10000
+PARQUET_ROW_GROUP = 100000
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+LINK_COLUMNS = "short_code, original_url, created_at, clicks, custom_name, campaign, expires_at"
+
+
+def query(dataset, campaign=None, granularity="day", since=None, until=None, base_url=None):
+    """(columns, column types, SQL, params, merge) for a dataset; merge is the
+    number of leading key columns to sum rows from several databases by (0: concatenate).
+
+    Raises KeyError for an unknown dataset and ValueError for a bad filter.
+    """
+    if dataset == "links":
+        columns = ["short_code", "original_url", "created_at", "clicks", "custom_name", "campaign", "expires_at",
+                   "archived"]
+        types = ["string", "string", "string", "int64", "string", "string", "int64", "int64"]
+        where, params = "", []
+        if campaign:
+            where = " WHERE campaign = ?"
+            params = [campaign]
+        select = LINK_COLUMNS
+        if base_url is not None:
+            # Prepended in SQL, where it costs nothing per row on the Python side
+            columns.insert(1, "short_url")
+            types.insert(1, "string")
+            select = "short_code, ? || short_code, " + LINK_COLUMNS.split(", ", 1)[1]
+            params = [base_url] + params
+        sql = "SELECT %s, 0 FROM urls%s UNION ALL SELECT %s, 1 FROM urls_archive%s" % (select, where, select, where)
+        return columns, types, sql, params * 2, 0
+    if dataset == "campaigns":
+        columns, types = ["campaign", "urls", "clicks"], ["string", "int64", "int64"]
+        where, params = "urls > 0", []
+        if campaign:
+            where += " AND campaign = ?"
+            params.append(campaign)
+        return columns, types, "SELECT campaign, urls, clicks FROM campaign_stats WHERE %s ORDER BY campaign" % where, \
+            params, 1
+
+    if dataset not in ("clicks", "campaign_clicks"):
+        raise KeyError(dataset)
+    if granularity not in analytics.GRANULARITIES:
+        raise ValueError("unknown granularity")
+    where = ["granularity = ?"]
+    params = [analytics.GRANULARITIES[granularity]]
+    if since is not None:
+        where.append("bucket >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("bucket < ?")
+        params.append(until)
+    if dataset == "clicks":
+        columns, types = ["short_code", "bucket", "clicks"], ["string", "int64", "int64"]
+        sql = "SELECT short_code, bucket, clicks FROM click_rollups WHERE %s" % " AND ".join(where)
+        return columns, types, sql, params, 0
+    if campaign:
+        where.append("campaign = ?")
+        params.append(campaign)
+    columns, types = ["campaign", "bucket", "clicks"], ["string", "int64", "int64"]
+    sql = "SELECT campaign, bucket, clicks FROM campaign_rollups WHERE %s ORDER BY campaign, bucket" % \
+        " AND ".join(where)
+    return columns, types, sql, params, 2
+
+
+def _merged(cursors, keys, size):
+    # Rows arrive in key order from every database; equal keys are summed
+    rows = heapq.merge(*cursors, key=lambda row: row[:keys])
+    chunk = []
+    for key, group in groupby(rows, key=lambda row: row[:keys]):
+        group = list(group)
+        chunk.append(key + tuple(sum(values) for values in zip(*(row[keys:] for row in group))))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_chunks(conns, sql, params, merge=0, size=CHUNK):
+    """Lists of up to ``size`` row tuples from ``sql`` run on every connection."""
+    if merge and len(conns) > 1:
+        yield from _merged([conn.execute(sql, params) for conn in conns], merge, size)
+        return
+    for conn in conns:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+
+
+def write_csv(columns, types, chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def write_ndjson(columns, types, chunks):
+    for rows in chunks:
+        yield b"".join([dumps(dict(zip(columns, row))) + b"\n" for row in rows])
+
+
+class _Sink:
+    """Write-only file object the Parquet writer streams into."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def write_parquet(columns, types, chunks):
+    if pyarrow is None:
+        raise RuntimeError("parquet export needs pyarrow")
+    schema = pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in zip(columns, types)])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    pending, count = [], 0
+    for rows in chunks:
+        pending.append(rows)
+        count += len(rows)
+        if count < PARQUET_ROW_GROUP:
+            continue
+        writer.write_table(_table(schema, pending))
+        pending, count = [], 0
+        yield sink.take()
+    if pending:
+        writer.write_table(_table(schema, pending))
+    writer.close()
+    yield sink.take()
+
+
+def _table(schema, chunks):
+    values = [[] for _ in schema.names]
+    for rows in chunks:
+        for column, part in zip(values, zip(*rows)):
+            column.extend(part)
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(column, type=field.type) for column, field in zip(values, schema)], schema=schema,
+    )
+
+
+WRITERS = {"csv": write_csv, "ndjson": write_ndjson, "parquet": write_parquet}
+
+
+def export_stream(paths, dataset, fmt, size=CHUNK, **filters):
+    """Encoded chunks (bytes) of ``dataset`` from the databases at ``paths``.
+
+    The query is checked before the first chunk is asked for; connections are
+    closed when the generator finishes or is closed.
+    """
+    columns, types, sql, params, merge = query(dataset, **filters)
+    if fmt not in WRITERS:
+        raise ValueError("unknown format")
+    if fmt == "parquet" and pyarrow is None:
+        raise ValueError("parquet export needs pyarrow")
+    return _stream(paths, columns, types, sql, params, merge, WRITERS[fmt], size)
+
+
+def _stream(paths, columns, types, sql, params, merge, writer, size):
+    conns = []
+    try:
+        for path in paths:
+            conn = connect(path)
+            conn.row_factory = None
+            conns.append(conn)
+            # The read snapshot starts at the first read, so take it now on
+            # every shard rather than when a shard's turn comes
+            conn.execute("BEGIN")
+            conn.execute("SELECT 1 FROM urls LIMIT 1").fetchall()
+        yield from writer(columns, types, iter_chunks(conns, sql, params, merge, size))
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def main():
+    from storage import read_only_storage
+    from urlmap import database_paths
+
+    parser = argparse.ArgumentParser(description="Stream links, campaigns or click rollups out of the database.")
+    parser.add_argument("dataset", choices=["links", "campaigns", "clicks", "campaign_clicks"])
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    parser.add_argument("--out", help="default: stdout")
+    parser.add_argument("--campaign")
+    parser.add_argument("--granularity", choices=sorted(analytics.GRANULARITIES), default="day")
+    parser.add_argument("--since", type=int, help="unix seconds")
+    parser.add_argument("--until", type=int, help="unix seconds")
+    parser.add_argument("--base-url", help="add a short_url column to links")
+    args = parser.parse_args()
+
+    storage = read_only_storage()
+    paths = database_paths(storage)
+    if not paths:
+        raise SystemExit("the %s storage engine has nothing to export" % storage.engine)
+    filters = {"campaign": args.campaign}
+    if args.dataset in ("clicks", "campaign_clicks"):
+        filters.update(granularity=args.granularity, since=args.since, until=args.until)
+    if args.dataset == "links" and args.base_url:
+        filters["base_url"] = args.base_url.rstrip("/") + "/"
+    try:
+        chunks = export_stream(paths, args.dataset, args.format, **filters)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        for data in chunks:
+            out.write(data)
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
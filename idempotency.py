@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+from metrics import Counter
+
+# Idempotency-Key support for the bulk endpoints. The finished response of a
+# keyed request (status, media type, body bytes) is stored in the
+# idempotency_keys table and in a bounded in-process LRU/TTL cache; a retry
+# with the same key gets those bytes back without running the request again.
+#
+# A key is claimed in the database before the request runs: the row is
+# inserted with no response and a lease. Requests with the same key in the
+# same process wait on the first one's future; in another worker they find the
+# claimed row and poll it until the response is saved. If the claim holder
+# fails the row is deleted, so the retry runs; if it dies the lease runs out
+# and the next request takes the key over. The key is scoped by client and
+# endpoint, and reusing it with different parameters is rejected.
+
+logger = logging.getLogger(__name__)
+
+TTL = 86400
+LEASE = 300
+POLL_INTERVAL = 0.1
+PRUNE_INTERVAL = 60
+MAX_KEY_LENGTH = 255
+
+REPLAYS = Counter("idempotent_replays_total", "Keyed requests answered with a stored response, by source.",
+                  ("source",))
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        status INTEGER,
+        media_type TEXT,
+        body BLOB,
+        lease_until INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)",
+]
+
+
+class KeyReused(Exception):
+    """The key was used before for a request with different parameters."""
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def upload_fingerprint(fileobj, *parts):
+    # Blocking reads of a spooled upload: run it in the threadpool
+    digest = hashlib.sha256(fingerprint(*parts).encode())
+    while True:
+        data = fileobj.read(2 ** 20)
+        if not data:
+            break
+        digest.update(data)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def claim(conn, key, fingerprint, now, lease=LEASE):
+    """("claimed", None), ("done", (status, media_type, body)) or ("running", None).
+
+    Raises KeyReused when the key is stored with another fingerprint.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT fingerprint, status, media_type, body, lease_until FROM idempotency_keys WHERE key = ?", (key,),
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO idempotency_keys (key, fingerprint, lease_until, created_at) VALUES (?, ?, ?, ?)",
+                (key, fingerprint, now + lease, now),
+            )
+            result = "claimed", None
+        elif row[0] != fingerprint:
+            raise KeyReused(key)
+        elif row[1] is not None:
+            result = "done", (row[1], row[2], bytes(row[3]))
+        elif row[4] <= now:
+            # The holder died before saving a response: take the key over
+            conn.execute("UPDATE idempotency_keys SET lease_until = ? WHERE key = ?", (now + lease, key))
+            result = "claimed", None
+        else:
+            result = "running", None
+        conn.commit()
+        return result
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def finish(conn, key, response):
+    status, media_type, body = response
+    conn.execute(
+        "UPDATE idempotency_keys SET status = ?, media_type = ?, body = ? WHERE key = ?",
+        (status, media_type, body, key),
+    )
+    conn.commit()
+
+
+def release(conn, key):
+    conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", (key,))
+    conn.commit()
+
+
+def prune(conn, before):
+    deleted = conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (before,)).rowcount
+    conn.commit()
+    return deleted
+
+
+class IdempotencyCache:
+    def __init__(self, storage, maxsize=1000, max_bytes=64 * 2 ** 20, ttl=TTL, lease=LEASE,
+                 poll_interval=POLL_INTERVAL, clock=time.time):
+        self.storage = storage
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._clock = clock
+        # key -> (fingerprint, response, expires)
+        self._done = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._next_prune = 0
+        self.executions = 0
+        self.replays = 0
+        self.joined = 0
+        self.evictions = 0
+
+    async def run(self, key, fingerprint, execute):
+        """``(status, media_type, body)`` for the request, and whether it was replayed.
+
+        ``await execute()`` runs at most once per key across all workers while
+        the stored response lives; it must return such a tuple, and raising
+        releases the key.
+        """
+        entry = self._get(key)
+        if entry is not None:
+            if entry[0] != fingerprint:
+                raise KeyReused(key)
+            REPLAYS.inc("memory")
+            self.replays += 1
+            return entry[1], True
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            if inflight[0] != fingerprint:
+                raise KeyReused(key)
+            self.joined += 1
+            REPLAYS.inc("inflight")
+            return await asyncio.shield(inflight[1]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        try:
+            response, replayed = await self._claim_and_run(key, fingerprint, execute)
+            future.set_result(response)
+            return response, replayed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved: there may be no one waiting
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _claim_and_run(self, key, fingerprint, execute):
+        await self._maybe_prune()
+        while True:
+            state, response = await self.storage.control(claim, key, fingerprint, int(self._clock()), self.lease)
+            if state == "done":
+                REPLAYS.inc("db")
+                self.replays += 1
+                self._put(key, fingerprint, response)
+                return response, True
+            if state == "claimed":
+                break
+            # Another worker holds the key
+            await asyncio.sleep(self.poll_interval)
+
+        self.executions += 1
+        try:
+            response = await execute()
+        except BaseException:
+            try:
+                await self.storage.control(release, key)
+            except Exception:
+                logger.exception("could not release idempotency key")
+            raise
+        await self.storage.control(finish, key, response)
+        self._put(key, fingerprint, response)
+        return response, False
+
+    async def _maybe_prune(self):
+        now = self._clock()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_INTERVAL
+        try:
+            await self.storage.control(prune, int(now - self.ttl))
+        except Exception:
+            logger.exception("idempotency key pruning failed")
+
+    def _get(self, key):
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        if entry[2] < self._clock():
+            self._drop(key)
+            return None
+        self._done.move_to_end(key)
+        return entry
+
+    def _put(self, key, fingerprint, response):
+        size = len(response[2])
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self._done[key] = (fingerprint, response, self._clock() + self.ttl)
+        self._bytes += size
+        while len(self._done) > self.maxsize or self._bytes > self.max_bytes:
+            _, (_, evicted, _) = self._done.popitem(last=False)
+            self._bytes -= len(evicted[2])
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._done.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1][2])
+
+    def stats(self):
+        return {
+            "size": len(self._done),
+            "maxsize": self.maxsize,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+            "executions": self.executions,
+            "replays": self.replays,
+            "joined": self.joined,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+
+# Cross-worker redirect cache invalidation. Each worker process keeps its own
+# RedirectCache; when a link is updated or deleted the worker that served the
+# write appends the code to `cache_invalidations`, and every worker polls the
+# table past its own watermark and drops those codes locally. Rows are pruned
+# after RETENTION seconds; a worker that falls further behind than that clears
+# its whole cache instead. Ids are AUTOINCREMENT so they are never reused.
+
+logger = logging.getLogger(__name__)
+
+RETENTION = 300
+FETCH_LIMIT = 10000
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            short_code TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+
+def publish(conn, codes):
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO cache_invalidations (short_code, created_at) VALUES (?, ?)",
+        ((code, now) for code in codes),
+    )
+    conn.commit()
+
+
+def fetch(conn, after, limit=FETCH_LIMIT):
+    """Return (watermark, codes, gap); ``after=None`` only reads the current watermark.
+
+    ``gap`` is True when rows past ``after`` were already pruned.
+    """
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cache_invalidations'").fetchone()
+    latest = row[0] if row else 0
+    if after is None:
+        return latest, [], False
+    if latest <= after:
+        return after, [], False
+    first = conn.execute("SELECT MIN(id) FROM cache_invalidations").fetchone()[0]
+    rows = conn.execute(
+        "SELECT id, short_code FROM cache_invalidations WHERE id > ? ORDER BY id LIMIT ?",
+        (after, limit),
+    ).fetchall()
+    gap = first is None or first > after + 1
+    return (rows[-1][0] if rows else latest), [row[1] for row in rows], gap
+
+
+def prune(conn, retention=RETENTION):
+    deleted = conn.execute(
+        "DELETE FROM cache_invalidations WHERE created_at < ?", (int(time.time()) - retention,)
+    ).rowcount
+    conn.commit()
+    return deleted
+
+
+class InvalidationListener:
+    """Polls the invalidation log and applies it to this worker's redirect cache."""
+
+    def __init__(self, storage, cache, interval=0.5, prune_every=120):
+        self.storage = storage
+        self.cache = cache
+        self.interval = interval
+        self.prune_every = prune_every
+        self._watermark = None
+        self._task = None
+        self.applied = 0
+        self.resets = 0
+
+    async def start(self):
+        self._watermark, _, _ = await self.storage.poll_invalidations(None)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def poll(self):
+        while True:
+            self._watermark, codes, gap = await self.storage.poll_invalidations(self._watermark)
+            if gap:
+                self.cache.clear()
+                self.resets += 1
+            self.cache.invalidate_many(codes)
+            self.applied += len(codes)
+            if len(codes) < FETCH_LIMIT:
+                return
+
+    async def _run(self):
+        polls = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+                polls += 1
+                if polls % self.prune_every == 0:
+                    await self.storage.prune_invalidations()
+            except Exception:
+                logger.exception("cache invalidation poll failed")
+
+    def stats(self):
+        return {"watermark": self._watermark, "applied": self.applied, "resets": self.resets}
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+# Background bulk jobs. A submitted upload is stored row by row in
+# bulk_job_items and the job is queued; JobRunner tasks claim queued jobs and
+# insert them chunk by chunk, writing each chunk's results and the job's
+# progress in one transaction. A claim is a lease that the runner renews every
+# third of it while it holds the job, rate-limit waits included, so a job
+# whose worker died (crash, restart, another process) is picked up again once
+# its lease runs out and resumes after the last saved chunk. A chunk that
+# was inserted but whose results were not saved yet is inserted again.
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+LEASE = 60
+RETENTION = 7 * 86400
+MAX_PAGE_SIZE = 5000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS bulk_jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        dedupe INTEGER NOT NULL,
+        client TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        processed INTEGER NOT NULL DEFAULT 0,
+        created INTEGER NOT NULL DEFAULT 0,
+        reused INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        lease_until INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status ON bulk_jobs(status, created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS bulk_job_items (
+        job_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        result TEXT,
+        PRIMARY KEY (job_id, seq)
+    ) WITHOUT ROWID
+    """,
+]
+
+JOB_COLUMNS = "id, status, dedupe, client, total, processed, created, reused, failed, error, created_at, updated_at"
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def create_job(conn, job_id, dedupe, client=None):
+    # "receiving" until the whole upload is stored, so no runner sees half of it
+    now = int(time.time())
+    conn.execute(
+        "INSERT INTO bulk_jobs (id, status, dedupe, client, created_at, updated_at) VALUES (?, 'receiving', ?, ?, ?, ?)",
+        (job_id, int(dedupe), client, now, now),
+    )
+    conn.commit()
+
+
+def add_items(conn, job_id, start, items):
+    conn.executemany(
+        "INSERT INTO bulk_job_items (job_id, seq, item) VALUES (?, ?, ?)",
+        ((job_id, start + n, json.dumps(item, ensure_ascii=False)) for n, item in enumerate(items)),
+    )
+    conn.commit()
+    return start + len(items)
+
+
+def queue_job(conn, job_id, total):
+    conn.execute(
+        "UPDATE bulk_jobs SET status = 'queued', total = ?, updated_at = ? WHERE id = ?",
+        (total, int(time.time()), job_id),
+    )
+    conn.commit()
+
+
+def claim_job(conn, lease=LEASE):
+    """Lease the oldest queued (or abandoned) job; returns its row as a dict, or None."""
+    now = int(time.time())
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("""
+            SELECT %s FROM bulk_jobs
+            WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+            ORDER BY created_at LIMIT 1
+        """ % JOB_COLUMNS, (now,)).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        conn.execute(
+            "UPDATE bulk_jobs SET status = 'running', lease_until = ?, updated_at = ? WHERE id = ?",
+            (now + lease, now, row["id"]),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return dict(row, status="running")
+
+
+def next_chunk(conn, job_id, start, size=CHUNK_SIZE):
+    return conn.execute(
+        "SELECT seq, item FROM bulk_job_items WHERE job_id = ? AND seq >= ? ORDER BY seq LIMIT ?",
+        (job_id, start, size),
+    ).fetchall()
+
+
+def save_chunk(conn, job_id, seqs, results, lease=LEASE):
+    now = int(time.time())
+    conn.executemany(
+        "UPDATE bulk_job_items SET result = ? WHERE job_id = ? AND seq = ?",
+        ((json.dumps(row, ensure_ascii=False), job_id, seq) for seq, row in zip(seqs, results)),
+    )
+    reused = sum(1 for row in results if row.get("reused"))
+    failed = sum(1 for row in results if not row["success"])
+    conn.execute("""
+        UPDATE bulk_jobs SET processed = ?, created = created + ?, reused = reused + ?,
+            failed = failed + ?, lease_until = ?, updated_at = ?
+        WHERE id = ?
+    """, (seqs[-1] + 1, len(results) - reused - failed, reused, failed, now + lease, now, job_id))
+    conn.commit()
+
+
+def renew_lease(conn, job_id, lease=LEASE):
+    now = int(time.time())
+    conn.execute(
+        "UPDATE bulk_jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+        (now + lease, now, job_id),
+    )
+    conn.commit()
+
+
+def finish_job(conn, job_id, status, error=None):
+    conn.execute(
+        "UPDATE bulk_jobs SET status = ?, error = ?, lease_until = 0, updated_at = ? WHERE id = ?",
+        (status, error, int(time.time()), job_id),
+    )
+    conn.commit()
+
+
+def release_jobs(conn, job_ids):
+    # Graceful shutdown: hand running jobs back without waiting for the lease
+    conn.executemany(
+        "UPDATE bulk_jobs SET status = 'queued', lease_until = 0 WHERE id = ? AND status = 'running'",
+        ((job_id,) for job_id in job_ids),
+    )
+    conn.commit()
+
+
+def get_job(conn, job_id):
+    row = conn.execute("SELECT %s FROM bulk_jobs WHERE id = ?" % JOB_COLUMNS, (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def job_results(conn, job_id, offset=0, limit=1000):
+    """Results of rows ``offset``.. that are already processed, as decoded dicts."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = conn.execute("""
+        SELECT result FROM bulk_job_items
+        WHERE job_id = ? AND seq >= ? AND result IS NOT NULL
+        ORDER BY seq LIMIT ?
+    """, (job_id, offset, limit)).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def prune_jobs(conn, retention=RETENTION):
+    before = int(time.time()) - retention
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM bulk_jobs WHERE status != 'running' AND updated_at < ?", (before,)
+    )]
+    for job_id in ids:
+        conn.execute("DELETE FROM bulk_job_items WHERE job_id = ?", (job_id,))
+        conn.execute("DELETE FROM bulk_jobs WHERE id = ?", (job_id,))
+    conn.commit()
+    return len(ids)
+
+
+class JobRunner:
+    """``workers`` asyncio tasks that claim and process queued bulk jobs."""
+
+    def __init__(self, storage, workers=2, chunk_size=CHUNK_SIZE, poll_interval=1.0,
+                 lease=LEASE, limiter=None, on_rows=None):
+        self.storage = storage
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.limiter = limiter
+        self.on_rows = on_rows
+        self._tasks = []
+        self._active = set()
+        self._stopping = False
+        self.completed = 0
+        self.failed = 0
+        self.rows = 0
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        # Let chunks in flight finish (a cancelled chunk would be inserted
+        # twice), then cancel whatever is still sleeping or stuck
+        self._stopping = True
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            for task in pending:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._tasks = []
+        if self._active:
+            await self.storage.control(release_jobs, list(self._active))
+            self._active.clear()
+
+    async def _run(self):
+        polls = 0
+        while not self._stopping:
+            try:
+                job = await self.storage.control(claim_job, self.lease)
+                if job is None:
+                    polls += 1
+                    if polls % 3600 == 0:
+                        await self.storage.control(prune_jobs)
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self.process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("bulk job runner failed")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _keep_lease(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.storage.control(renew_lease, job_id, self.lease)
+            except Exception:
+                logger.exception("could not renew the lease of bulk job %s", job_id)
+
+    async def process(self, job):
+        job_id = job["id"]
+        self._active.add(job_id)
+        # A rate-limit wait or a slow chunk can outlast the lease; another
+        # runner would then take the job and insert the chunk again
+        keeper = asyncio.create_task(self._keep_lease(job_id))
+        try:
+            start = job["processed"]
+            while not self._stopping:
+                chunk = await self.storage.control(next_chunk, job_id, start, self.chunk_size)
+                if not chunk:
+                    break
+                items = [json.loads(row[1]) for row in chunk]
+                if self.limiter is not None and job["client"]:
+                    wait = self.limiter.reserve(job["client"], len(items))
+                    if wait:
+                        await asyncio.sleep(wait)
+                rows = await self.storage.insert_urls(items, bool(job["dedupe"]))
+                if self.on_rows is not None:
+                    self.on_rows(rows)
+                await self.storage.control(save_chunk, job_id, [row[0] for row in chunk], rows, self.lease)
+                self.rows += len(rows)
+                start = chunk[-1][0] + 1
+            else:
+                # Stopping: stays in _active and is released by stop()
+                return
+            await self.storage.control(finish_job, job_id, "done")
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("bulk job %s failed", job_id)
+            await self.storage.control(finish_job, job_id, "failed", str(e))
+            self.failed += 1
+        finally:
+            keeper.cancel()
+        self._active.discard(job_id)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "active": len(self._active),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rows": self.rows,
+        }
@@ -1,35 +1,231 @@
-from fastapi import FastAPI, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
-import string
-import random
-import sqlite3
-from datetime import datetime
-
-app = FastAPI()
-
-# Database and utility functions (minimal required)
-def get_db_connection():
-    conn = sqlite3.connect("url_shortener.db")
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def generate_short_code(length=6):
-    chars = string.ascii_letters + string.digits
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    for _ in range(50):
-        code = ''.join(random.choices(chars, k=length))
-        cursor.execute("SELECT 1 FROM urls WHERE short_code = ?", (code,))
-        if not cursor.fetchone():
-            conn.close()
-            return code
-    
-    conn.close()
-    raise HTTPException(status_code=500, detail="短縮コード生成に失敗しました")
-
-def validate_url(url):
-    return url.startswith(('http://', 'https://'))
+from fastapi import FastAPI, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+
+from allocator import make_allocator
+from storage import STORAGE_ENGINE, make_storage
+from cache import MISS, RedirectCache
+from clicks import ClickRecorder
+from codeindex import CodeIndex, default_snapshot_path
+from invalidations import InvalidationListener
+from ratelimit import RateLimiter, retry_after
+from serialize import BulkEncoder, dumps
+from urlcheck import check_url
+from pages import FragmentCache, StaticPage, not_modified
+from urlmap import UrlMap, database_paths, default_map_path
+import admin
+import analytics
+import archive
+import export
+import idempotency
+import jobs
+import metrics
+from bulk import (
+    ERRORS, dedupe_summary, detect_format, iter_batches, iter_upload_rows, STREAM_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for `python main.py`. Every worker leases its own blocks of
+# code ids from the database and keeps its own redirect cache; updates and
+# deletes reach the other workers' caches through the invalidation log.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+
+# Public origin for short links, resolved once at startup; bulk results are
+# encoded from templates built around it
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "https://url-shortener-mvp.onrender.com").rstrip("/") + "/"
+bulk_encoder = BulkEncoder(PUBLIC_BASE_URL)
+
+# Short-code engine: "counter" (block-reserved, scrambled ids) or "random".
+# SHORT_CODE_KEY is the secret the counter engine's permutation is keyed with;
+# without it codes follow the public default key and can be enumerated.
+SHORT_CODE_ENGINE = os.environ.get("SHORT_CODE_ENGINE", "counter")
+allocator_options = {}
+if SHORT_CODE_ENGINE == "counter":
+    if os.environ.get("SHORT_CODE_KEY"):
+        allocator_options["key"] = os.environ["SHORT_CODE_KEY"]
+    else:
+        logger.warning("SHORT_CODE_KEY is not set: short codes use the public default key")
+code_allocator = make_allocator(SHORT_CODE_ENGINE, **allocator_options)
+
+# Storage engine ("sqlite", "sharded" or "memory"); all SQLite work runs on
+# pooled executors, off the event loop
+storage = make_storage(STORAGE_ENGINE, code_allocator)
+
+# Bloom filter over all short codes: definite misses (404s, free custom codes)
+# skip the database. Built in the background and snapshotted to disk.
+CODE_INDEX_ENABLED = os.environ.get("CODE_INDEX", "1") != "0"
+code_index = CodeIndex(
+    storage,
+    error_rate=float(os.environ.get("CODE_INDEX_ERROR_RATE", "0.01")),
+    min_capacity=int(os.environ.get("CODE_INDEX_MIN_CAPACITY", "1000000")),
+    snapshot_path=os.environ.get("CODE_INDEX_SNAPSHOT") or default_snapshot_path(storage),
+    sync_interval=float(os.environ.get("CODE_INDEX_SYNC_INTERVAL", "0.5")) if WORKERS > 1 else 0.0,
+    snapshot_interval=float(os.environ.get("CODE_INDEX_SNAPSHOT_INTERVAL", "300")),
+)
+if CODE_INDEX_ENABLED:
+    storage.might_exist = code_index.might_contain
+
+# Memory-mapped code -> URL snapshot written by `python urlmap.py export`;
+# redirects read it before the database, so a fresh worker starts warm
+URL_MAP_ENABLED = os.environ.get("URL_MAP", "1") != "0"
+url_map = UrlMap(
+    storage,
+    os.environ.get("URL_MAP_PATH") or default_map_path(storage),
+    sync_interval=float(os.environ.get("URL_MAP_SYNC_INTERVAL", "1.0")),
+)
+
+# Redirect hot path cache (short_code -> original_url, with negative entries)
+redirect_cache = RedirectCache(
+    maxsize=int(os.environ.get("REDIRECT_CACHE_SIZE", "100000")),
+    ttl=float(os.environ.get("REDIRECT_CACHE_TTL", "300")),
+    negative_ttl=float(os.environ.get("REDIRECT_CACHE_NEGATIVE_TTL", "30")),
+)
+
+# Encoded /api/admin/* responses; cleared whenever links or clicks change here,
+# and expired after ADMIN_CACHE_TTL for changes made by other workers
+admin_cache = FragmentCache(
+    maxsize=int(os.environ.get("ADMIN_CACHE_SIZE", "256")),
+    ttl=float(os.environ.get("ADMIN_CACHE_TTL", "5")),
+)
+
+# Write-behind click counting; redirects never wait on this
+click_recorder = ClickRecorder(
+    storage,
+    flush_interval=float(os.environ.get("CLICK_FLUSH_INTERVAL", "1.0")),
+    high_water=int(os.environ.get("CLICK_HIGH_WATER", "5000")),
+    max_queue=int(os.environ.get("CLICK_QUEUE_SIZE", "100000")),
+    on_flush=admin_cache.clear,
+)
+
+# Write-path rate limits per client (X-API-Key header when it is one of the
+# comma-separated API_KEYS, else client IP): one bucket for requests, one for
+# the number of URLs submitted to bulk endpoints. A rate of 0 disables a limiter.
+API_KEYS = frozenset(key.strip() for key in os.environ.get("API_KEYS", "").split(",") if key.strip())
+RATE_LIMIT_CLIENTS = int(os.environ.get("RATE_LIMIT_CLIENTS", "100000"))
+request_limiter = RateLimiter(
+    rate=float(os.environ.get("RATE_LIMIT_RPS", "5")),
+    burst=float(os.environ.get("RATE_LIMIT_BURST", "20")),
+    maxsize=RATE_LIMIT_CLIENTS,
+)
+bulk_row_limiter = RateLimiter(
+    rate=float(os.environ.get("BULK_ROWS_PER_SECOND", "2000")),
+    burst=float(os.environ.get("BULK_ROWS_BURST", "100000")),
+    maxsize=RATE_LIMIT_CLIENTS,
+)
+
+# Background bulk jobs: uploads are stored in the DB and inserted in chunks
+job_runner = jobs.JobRunner(
+    storage,
+    workers=int(os.environ.get("BULK_JOB_WORKERS", "2")),
+    chunk_size=int(os.environ.get("BULK_JOB_CHUNK_SIZE", "1000")),
+    limiter=bulk_row_limiter,
+    on_rows=lambda rows: forget_negatives(rows),
+)
+
+# Responses of bulk requests sent with an Idempotency-Key, kept in the database
+# for IDEMPOTENCY_TTL seconds and the most recent ones in memory as well
+idempotency_cache = idempotency.IdempotencyCache(
+    storage,
+    maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "1000")),
+    max_bytes=int(os.environ.get("IDEMPOTENCY_CACHE_BYTES", str(64 * 2 ** 20))),
+    ttl=float(os.environ.get("IDEMPOTENCY_TTL", "86400")),
+    lease=int(os.environ.get("IDEMPOTENCY_LEASE", "300")),
+)
+
+invalidation_listener = InvalidationListener(
+    storage, redirect_cache, interval=float(os.environ.get("CACHE_INVALIDATION_INTERVAL", "0.5")),
+)
+
+# Folds raw click events into minute/hour/day rollups
+rollup_worker = analytics.RollupWorker(storage, interval=float(os.environ.get("ROLLUP_INTERVAL", "60")))
+
+async def forget_archived(codes):
+    # A cached redirect would skip the restore, and its click would update no row
+    redirect_cache.invalidate_many(codes)
+    admin_cache.clear()
+    if WORKERS > 1:
+        await storage.publish_invalidations(codes)
+
+# Moves expired links, and links without clicks for ARCHIVE_COLD_DAYS (0: only
+# expired ones), out of the hot urls table; ARCHIVE_INTERVAL=0 turns it off
+archive_worker = archive.ArchiveWorker(
+    storage,
+    interval=float(os.environ.get("ARCHIVE_INTERVAL", "3600")),
+    cold_after=float(os.environ.get("ARCHIVE_COLD_DAYS", "30")) * 86400,
+    on_archive=forget_archived,
+)
+
+@asynccontextmanager
+async def lifespan(app):
+    if WORKERS > 1 and storage.engine == "memory":
+        raise RuntimeError("memory storage cannot be shared between workers")
+    storage.open()
+    await storage.migrate()
+    if CODE_INDEX_ENABLED:
+        code_index.start()
+    if URL_MAP_ENABLED:
+        await url_map.start()
+    if WORKERS > 1:
+        await invalidation_listener.start()
+    click_recorder.start()
+    rollup_worker.start()
+    if archive_worker.interval:
+        archive_worker.start()
+    job_runner.start()
+    yield
+    await job_runner.stop()
+    await archive_worker.stop()
+    await invalidation_listener.stop()
+    await rollup_worker.stop()
+    await click_recorder.stop()
+    await rollup_worker.run_once()
+    if CODE_INDEX_ENABLED:
+        await code_index.stop()
+    await url_map.stop()
+    await storage.close()
+
+app = FastAPI(lifespan=lifespan)
+# Request count/latency per route; METRICS_SAMPLE_RATE < 1 times only that share of requests
+app.add_middleware(metrics.MetricsMiddleware, sample_rate=float(os.environ.get("METRICS_SAMPLE_RATE", "1.0")))
+
+# Read from the live objects at scrape time
+metrics.Callback(
+    "redirect_cache_lookups_total", "Redirect cache lookups by result.",
+    lambda: {("hit",): redirect_cache.hits, ("negative_hit",): redirect_cache.negative_hits,
+             ("miss",): redirect_cache.misses},
+    kind="counter", labels=("result",),
+)
+metrics.Callback("redirect_cache_hit_ratio", "Share of redirect lookups answered by the cache.",
+                 lambda: redirect_cache.stats()["hit_ratio"])
+metrics.Callback("redirect_cache_entries", "Entries in the redirect cache.", lambda: redirect_cache.stats()["size"])
+metrics.Callback("clicks_pending", "Clicks buffered and not yet flushed.", lambda: click_recorder.pending())
+metrics.Callback("clicks_flushed_total", "Clicks written to the database.", lambda: click_recorder.flushed, kind="counter")
+metrics.Callback(
+    "rate_limit_rejections_total", "Requests rejected by the rate limiters.",
+    lambda: {("requests",): request_limiter.rejected, ("bulk_rows",): bulk_row_limiter.rejected},
+    kind="counter", labels=("limiter",),
+)
+metrics.Callback(
+    "code_index_lookups_total", "Code index lookups by result.",
+    lambda: {("skipped",): code_index.skipped, ("maybe",): code_index.lookups - code_index.skipped,
+             ("maybe_miss",): code_index.maybe_misses},
+    kind="counter", labels=("result",),
+)
+metrics.Callback("code_index_bytes", "Memory held by the code index filter.",
+                 lambda: code_index.stats().get("memory_bytes", 0))
+metrics.Callback("bulk_jobs_active", "Bulk jobs being processed by this worker.", lambda: job_runner.stats()["active"])
+templates = Jinja2Templates(directory="templates")
 
 # Enhanced Bulk Generation HTML with Green Table Design
 BULK_HTML = """
@@ -314,6 +510,7 @@ BULK_HTML = """
                     <li><strong>E列（キャンペーン名）</strong>: マーケティングキャンペーンのグループ名を入力</li>
                     <li><strong>F列（生成数量）</strong>: 同じURLから複数の短縮リンクを生成する場合の数量</li>
                     <li><strong>「🚀 一括生成開始」</strong>ボタンをクリックして処理を実行</li>
+                    <li>大量のURLは<strong>CSV / NDJSONファイル</strong>をアップロードすると、結果が順次表示されます</li>
                 </ol>
             </div>
 
@@ -370,6 +567,13 @@ BULK_HTML = """
                 <button class="btn btn-primary" onclick="window.location.href='/admin'">📊 管理画面へ</button>
             </div>
 
+            <div class="action-buttons">
+                <input type="file" id="uploadFile" accept=".csv,.ndjson,.jsonl,.txt" />
+                <button class="btn btn-secondary" id="uploadBtn">📁 ファイルから一括生成（CSV / NDJSON）</button>
+                <label><input type="checkbox" id="dedupeToggle" /> 同じURLは既存の短縮コードを再利用</label>
+                <label><input type="checkbox" id="jobToggle" /> バックグラウンドで処理（大量データ向け）</label>
+            </div>
+
             <div class="results-section" id="resultsSection" style="display: none;">
                 <h2>📈 生成結果</h2>
                 <div id="resultsContent"></div>
@@ -470,8 +674,9 @@ BULK_HTML = """
                         
                         data.push({
                             url: originalUrl,
+                            custom_code: finalCustomSlug || null,
                             custom_name: finalCustomName || null,
-                            campaign_name: campaignName || null
+                            campaign: campaignName || null
                         });
                     }
                 }
@@ -494,93 +699,194 @@ BULK_HTML = """
         }
         
         async function generateLinks(data) {
-            const btn = document.getElementById('generateBtn');
-            const btn2 = document.getElementById('generateBtn2');
+            const body = data.map(item => JSON.stringify(item)).join('\\n');
+            await submitBulk(new Blob([body], { type: 'application/x-ndjson' }), 'bulk.ndjson');
+        }
+        
+        async function uploadFile() {
+            const input = document.getElementById('uploadFile');
+            if (!input.files.length) {
+                alert('CSVまたはNDJSONファイルを選択してください');
+                return;
+            }
+            await submitBulk(input.files[0], input.files[0].name);
+        }
+        
+        async function submitBulk(file, filename) {
+            const buttons = ['generateBtn', 'generateBtn2', 'uploadBtn'].map(id => document.getElementById(id));
             const resultsSection = document.getElementById('resultsSection');
-            const resultsContent = document.getElementById('resultsContent');
             
-            [btn, btn2].forEach(button => {
+            buttons.forEach(button => {
                 button.disabled = true;
+                button.dataset.label = button.innerHTML;
                 button.innerHTML = '⏳ 生成中...';
             });
             
             resultsSection.style.display = 'block';
-            resultsContent.innerHTML = '<div class="loading"><div class="spinner"></div><p>リンクを生成しています...</p></div>';
+            const view = startResults();
             
             try {
                 const formData = new FormData();
-                const urlList = data.map(item => item.url).join('\\n');
-                formData.append('urls', urlList);
-                
-                const response = await fetch('/api/bulk-process', {
-                    method: 'POST',
-                    body: formData
-                });
+                formData.append('file', file, filename);
                 
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
+                const dedupe = document.getElementById('dedupeToggle').checked;
+                // One key per submission: a resend after a dropped connection
+                // gets the first result back instead of a second set of links
+                const key = newIdempotencyKey();
+                if (document.getElementById('jobToggle').checked) {
+                    await runJob(view, formData, dedupe, key);
+                } else {
+                    await readStream(view, formData, dedupe, key);
                 }
-                
-                const result = await response.json();
-                displayResults(result);
+                view.status.textContent = '✅ 完了';
                 
             } catch (error) {
-                resultsContent.innerHTML = `<div class="error-item">エラー: ${error.message}</div>`;
+                view.errors.insertAdjacentHTML('beforeend', `<div class="error-item">エラー: ${error.message}</div>`);
+                view.status.textContent = '❌ 中断';
             } finally {
-                [btn, btn2].forEach(button => {
+                buttons.forEach(button => {
                     button.disabled = false;
-                    button.innerHTML = '🚀 一括生成開始';
+                    button.innerHTML = button.dataset.label;
                 });
             }
         }
         
-        function displayResults(result) {
-            const resultsContent = document.getElementById('resultsContent');
-            
-            let successCount = 0;
-            let errorCount = 0;
+        function newIdempotencyKey() {
+            if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+            return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+        }
+        
+        async function postOnce(url, formData, key) {
+            // fetch only throws when no response arrived; resend with the same key
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    return await fetch(url, {
+                        method: 'POST',
+                        body: formData,
+                        headers: { 'Idempotency-Key': key }
+                    });
+                } catch (error) {
+                    if (attempt >= 3) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+                }
+            }
+        }
+        
+        async function readStream(view, formData, dedupe, key) {
+            const response = await postOnce('/api/bulk-stream?dedupe=' + dedupe, formData, key);
             
-            if (result.results) {
-                result.results.forEach(item => {
-                    if (item.success) successCount++;
-                    else errorCount++;
-                });
+            if (!response.ok) {
+                throw new Error(await errorMessage(response));
             }
             
-            let html = `
+            // Results arrive as NDJSON, one batch at a time
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                const lines = buffer.split('\\n');
+                buffer = lines.pop();
+                appendResults(view, lines.filter(line => line.trim()).map(line => JSON.parse(line)));
+                if (done) break;
+            }
+            if (buffer.trim()) appendResults(view, [JSON.parse(buffer)]);
+        }
+        
+        async function runJob(view, formData, dedupe, key) {
+            // The server stores the upload and answers with a job id; results
+            // are then fetched page by page while the job runs
+            const response = await postOnce('/api/bulk-jobs?dedupe=' + dedupe, formData, key);
+            if (!response.ok) {
+                throw new Error(await errorMessage(response));
+            }
+            const job = await response.json();
+            let offset = 0;
+            while (true) {
+                const poll = await fetch(`/api/bulk-jobs/${job.job_id}?offset=${offset}`);
+                if (!poll.ok) {
+                    throw new Error(await errorMessage(poll));
+                }
+                const state = await poll.json();
+                appendResults(view, state.results);
+                offset = state.next_offset;
+                view.status.textContent = `⏳ 処理中... ${state.processed} / ${state.total}`;
+                if (state.status === 'failed') {
+                    throw new Error(state.error || 'ジョブが失敗しました');
+                }
+                if (state.status === 'done' && offset >= state.total) break;
+                if (!state.results.length) {
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                }
+            }
+        }
+        
+        async function errorMessage(response) {
+            let detail = `HTTP error! status: ${response.status}`;
+            try {
+                detail = (await response.json()).detail || detail;
+            } catch (e) {}
+            const retry = response.headers.get('Retry-After');
+            return retry ? `${detail}（${retry}秒後に再試行してください）` : detail;
+        }
+        
+        function startResults() {
+            const resultsContent = document.getElementById('resultsContent');
+            resultsContent.innerHTML = `
                 <div style="background: linear-gradient(135deg, #e3f2fd 0%, #e8eaf6 100%); padding: 20px; border-radius: 10px; margin-bottom: 25px; border-left: 5px solid #1976d2;">
-                    <h3>📊 生成サマリー</h3>
-                    <p style="font-size: 1.1em; margin-top: 10px;">成功: <strong style="color: #28a745;">${successCount}</strong> | エラー: <strong style="color: #dc3545;">${errorCount}</strong> | 総生成数: <strong>${successCount + errorCount}</strong></p>
+                    <h3>📊 生成サマリー <span id="resultStatus" style="font-size: 0.8em;">⏳ 処理中...</span></h3>
+                    <p style="font-size: 1.1em; margin-top: 10px;">成功: <strong id="successCount" style="color: #28a745;">0</strong>（再利用: <strong id="reusedCount">0</strong>） | エラー: <strong id="errorCount" style="color: #dc3545;">0</strong> | 総生成数: <strong id="totalCount">0</strong></p>
                 </div>
+                <h3 style="color: #28a745; margin-bottom: 20px;">✅ 生成成功</h3>
+                <div id="successList"></div>
+                <h3 id="errorHeading" style="color: #dc3545; margin: 30px 0 20px; display: none;">❌ エラー</h3>
+                <div id="errorList"></div>
             `;
+            return {
+                status: document.getElementById('resultStatus'),
+                success: document.getElementById('successList'),
+                errors: document.getElementById('errorList'),
+                successCount: 0,
+                reusedCount: 0,
+                errorCount: 0
+            };
+        }
+        
+        function appendResults(view, items) {
+            if (!items.length) return;
+            let successHtml = '';
+            let errorHtml = '';
             
-            if (result.results && result.results.length > 0) {
-                html += '<h3 style="color: #28a745; margin-bottom: 20px;">✅ 生成成功</h3>';
-                result.results.forEach((item, index) => {
-                    if (item.success) {
-                        html += `
-                            <div class="result-item">
-                                <p><strong>${index + 1}. 元URL:</strong> <a href="${item.url}" target="_blank">${item.url}</a></p>
-                                <p><strong>短縮URL:</strong> 
-                                    <a href="${item.short_url}" target="_blank" style="color: #1976d2; font-weight: bold;">${item.short_url}</a>
-                                    <button class="copy-btn" onclick="copyToClipboard('${item.short_url}')">📋 コピー</button>
-                                    <a href="/analytics/${item.short_url.split('/').pop()}" target="_blank" class="stats-link">📈 分析</a>
-                                </p>
-                            </div>
-                        `;
-                    }
-                });
-                
-                const errors = result.results.filter(item => !item.success);
-                if (errors.length > 0) {
-                    html += '<h3 style="color: #dc3545; margin: 30px 0 20px;">❌ エラー</h3>';
-                    errors.forEach(item => {
-                        html += `<div class="error-item"><strong>URL:</strong> ${item.url}<br><strong>エラー:</strong> ${item.error}</div>`;
-                    });
+            items.forEach(item => {
+                if (item.success) {
+                    view.successCount++;
+                    if (item.reused) view.reusedCount++;
+                    successHtml += `
+                        <div class="result-item">
+                            <p><strong>${view.successCount}. 元URL:</strong> <a href="${item.url}" target="_blank">${item.url}</a></p>
+                            <p><strong>短縮URL:</strong> 
+                                <a href="${item.short_url}" target="_blank" style="color: #1976d2; font-weight: bold;">${item.short_url}</a>
+                                <button class="copy-btn" onclick="copyToClipboard('${item.short_url}')">📋 コピー</button>
+                                <a href="/analytics/${item.short_url.split('/').pop()}" target="_blank" class="stats-link">📈 分析</a>
+                            </p>
+                        </div>
+                    `;
+                } else {
+                    view.errorCount++;
+                    errorHtml += `<div class="error-item"><strong>URL:</strong> ${item.url}<br><strong>エラー:</strong> ${item.error}</div>`;
                 }
-            }
+            });
             
-            resultsContent.innerHTML = html;
+            view.success.insertAdjacentHTML('beforeend', successHtml);
+            if (errorHtml) {
+                document.getElementById('errorHeading').style.display = 'block';
+                view.errors.insertAdjacentHTML('beforeend', errorHtml);
+            }
+            document.getElementById('successCount').textContent = view.successCount;
+            document.getElementById('reusedCount').textContent = view.reusedCount;
+            document.getElementById('errorCount').textContent = view.errorCount;
+            document.getElementById('totalCount').textContent = view.successCount + view.errorCount;
         }
         
         function copyToClipboard(text) {
@@ -602,6 +908,7 @@ BULK_HTML = """
             document.getElementById('add10RowsBtn2').addEventListener('click', () => addMultipleRows(10));
             document.getElementById('clearAllBtn2').addEventListener('click', clearAll);
             document.getElementById('generateBtn2').addEventListener('click', validateAndGenerate);
+            document.getElementById('uploadBtn').addEventListener('click', uploadFile);
             
             // Initialize with additional rows
             addMultipleRows(3);
@@ -611,44 +918,405 @@ BULK_HTML = """
 </html>
 """
 
+# Page shells are rendered and compressed once; see pages.py
+bulk_shell = StaticPage(BULK_HTML)
+admin_shell = StaticPage(templates.get_template("admin.html").render(page_size=admin.DEFAULT_PAGE_SIZE))
+
 @app.get("/bulk", response_class=HTMLResponse)
-async def bulk_page():
-    return HTMLResponse(content=BULK_HTML)
+async def bulk_page(request: Request):
+    return static_response(bulk_shell, request)
+
+class BulkRow(BaseModel):
+    url: str
+    custom_code: Optional[str] = None
+    custom_name: Optional[str] = None
+    campaign: Optional[str] = None
+    # ISO 8601 date/time or unix seconds
+    expires_at: Optional[str] = None
+
+class BulkRowsRequest(BaseModel):
+    rows: List[BulkRow]
+    dedupe: bool = False
+
+def client_key(request):
+    # Only a configured API key gets a bucket of its own; anything else would
+    # let a client pick a fresh bucket per request
+    api_key = request.headers.get("x-api-key")
+    if api_key and api_key in API_KEYS:
+        # Hashed: the key is stored with bulk jobs
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:24]
+    return "ip:" + (request.client.host if request.client else "-")
+
+def limit_request(request, rows=0):
+    """Charge one request (and ``rows`` bulk URLs) to the client; raises 429/413."""
+    key = client_key(request)
+    wait = request_limiter.take(key)
+    if wait:
+        raise HTTPException(status_code=429, detail="リクエストが多すぎます", headers={"Retry-After": retry_after(wait)})
+    if rows:
+        wait = bulk_row_limiter.take(key, rows)
+        if wait == math.inf:
+            raise HTTPException(status_code=413, detail="一度に送信できるURLは最大%d件です" % bulk_row_limiter.burst)
+        if wait:
+            raise HTTPException(status_code=429, detail="URLの送信上限を超えました", headers={"Retry-After": retry_after(wait)})
+    return key
+
+async def invalidate(short_code):
+    redirect_cache.invalidate(short_code)
+    url_map.forget(short_code)
+    admin_cache.clear()
+    if WORKERS > 1:
+        await storage.publish_invalidations([short_code])
+
+def forget_negatives(rows):
+    # Newly minted codes may have been probed (and cached as missing) before
+    redirect_cache.invalidate_many(row["short_code"] for row in rows if row["success"])
+    code_index.add_many(row["short_code"] for row in rows if row["success"] and not row.get("reused"))
+    admin_cache.clear()
+
+def static_response(page, request):
+    status, body, headers = page.select(request.headers.get("accept-encoding"), request.headers.get("if-none-match"))
+    return Response(body, status_code=status, headers=headers, media_type=page.media_type if status == 200 else None)
+
+async def cached_json(request, key, fetch):
+    """``await fetch()`` as JSON, served from admin_cache with an ETag (304 when unchanged)."""
+    entry = admin_cache.get(key)
+    if entry is None:
+        generation = admin_cache.generation
+        entry = admin_cache.put(key, dumps(await fetch()), generation)
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def bulk_result(rows, dedupe):
+    extra = {"dedupe": dedupe_summary(rows)} if dedupe else None
+    return 200, "application/json", bulk_encoder.body(rows, extra)
+
+def idempotency_key(request):
+    """The Idempotency-Key header scoped to the client and endpoint, or None."""
+    key = request.headers.get("idempotency-key")
+    if not key:
+        return None
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Keyが長すぎます")
+    return "%s %s %s" % (client_key(request), request.url.path, key)
+
+async def idempotent(key, fingerprint, execute):
+    """Response for ``await execute()`` (status, media type, body), run once per key.
+
+    Without a key it simply runs. A retry gets the stored response back with
+    Idempotent-Replayed set, and rate limits are charged inside ``execute`` so
+    a replay is not charged again.
+    """
+    if key is None:
+        status, media_type, body = await execute()
+        return Response(body, status_code=status, media_type=media_type)
+    try:
+        (status, media_type, body), replayed = await idempotency_cache.run(key, fingerprint, execute)
+    except idempotency.KeyReused:
+        raise HTTPException(status_code=422, detail="このIdempotency-Keyは別のリクエストで使用されています")
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(body, status_code=status, media_type=media_type, headers=headers)
 
 @app.post("/api/bulk-process")
-async def bulk_process(urls: str = Form(...)):
+async def bulk_process(request: Request, urls: str = Form(...), dedupe: bool = Form(False)):
+    url_list = [url.strip() for url in urls.split('\n') if url.strip()]
+    key = idempotency_key(request)
+
+    async def execute():
+        limit_request(request, len(url_list))
+        try:
+            rows = await storage.insert_urls(url_list, dedupe)
+            forget_negatives(rows)
+            return bulk_result(rows, dedupe)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    fingerprint = idempotency.fingerprint("\n".join(url_list), dedupe) if key else None
+    return await idempotent(key, fingerprint, execute)
+
+@app.post("/api/bulk-rows")
+async def bulk_rows(request: Request, body: BulkRowsRequest):
+    # Structured rows: custom code, name and campaign are persisted with the link
+    items = [row.dict() for row in body.rows]
+    key = idempotency_key(request)
+
+    async def execute():
+        limit_request(request, len(items))
+        try:
+            rows = await storage.insert_urls(items, body.dedupe)
+            forget_negatives(rows)
+            return bulk_result(rows, body.dedupe)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    fingerprint = idempotency.fingerprint(dumps(items), body.dedupe) if key else None
+    return await idempotent(key, fingerprint, execute)
+
+async def stream_upload(client, batches, dedupe):
+    while True:
+        # Reading the spooled upload blocks, so it runs in the threadpool
+        batch = await run_in_threadpool(next, batches, None)
+        if batch is None:
+            break
+        wait = bulk_row_limiter.reserve(client, len(batch))
+        if wait:
+            await asyncio.sleep(wait)
+        rows = await storage.insert_urls(batch, dedupe)
+        forget_negatives(rows)
+        yield bulk_encoder.ndjson(rows)
+
+@app.post("/api/bulk-stream")
+async def bulk_stream(request: Request, file: UploadFile = File(...), dedupe: bool = False):
+    # CSV (header with url[, custom_code, custom_name, campaign] or one URL per
+    # line) or NDJSON (one {"url": ..., "custom_code": ...} object per line).
+    # Rows are inserted STREAM_BATCH_SIZE at a time and each batch's results
+    # are flushed to the client as NDJSON before the next batch is read.
+    # The row count is unknown up front: the request is admitted, then each
+    # batch is charged to the row budget and paced rather than rejected
+    fmt = detect_format(file.filename, file.content_type)
+    batches = iter_batches(iter_upload_rows(file.file, fmt), STREAM_BATCH_SIZE)
+    key = idempotency_key(request)
+    if key is None:
+        client = limit_request(request)
+        return StreamingResponse(stream_upload(client, batches, dedupe), media_type="application/x-ndjson")
+
+    # With a key the whole result is collected first, so the response that is
+    # stored (and replayed) is the complete one
+    async def execute():
+        client = limit_request(request)
+        chunks = [chunk async for chunk in stream_upload(client, batches, dedupe)]
+        return 200, "application/x-ndjson", b"".join(chunks)
+
+    fingerprint = await run_in_threadpool(idempotency.upload_fingerprint, file.file, file.filename, dedupe)
+    return await idempotent(key, fingerprint, execute)
+
+@app.post("/api/bulk-jobs", status_code=202)
+async def create_bulk_job(request: Request, file: UploadFile = File(...), dedupe: bool = False):
+    # Same upload formats as /api/bulk-stream. The rows are stored with the
+    # job and the response returns before any link is created; progress and
+    # results come from GET /api/bulk-jobs/{job_id}. A retry with the same
+    # Idempotency-Key gets the first job back instead of a second one.
+    key = idempotency_key(request)
+
+    async def execute():
+        client = limit_request(request)
+        fmt = detect_format(file.filename, file.content_type)
+        batches = iter_batches(iter_upload_rows(file.file, fmt), STREAM_BATCH_SIZE)
+        job_id = jobs.new_job_id()
+        await storage.control(jobs.create_job, job_id, dedupe, client)
+        total = 0
+        try:
+            while True:
+                batch = await run_in_threadpool(next, batches, None)
+                if batch is None:
+                    break
+                total = await storage.control(jobs.add_items, job_id, total, batch)
+        except Exception as e:
+            await storage.control(jobs.finish_job, job_id, "failed", str(e))
+            raise HTTPException(status_code=500, detail=str(e))
+        await storage.control(jobs.queue_job, job_id, total)
+        return 202, "application/json", dumps({"job_id": job_id, "status": "queued", "total": total})
+
+    fingerprint = None
+    if key:
+        fingerprint = await run_in_threadpool(idempotency.upload_fingerprint, file.file, file.filename, dedupe)
+    return await idempotent(key, fingerprint, execute)
+
+@app.get("/api/bulk-jobs/{job_id}")
+async def bulk_job_status(job_id: str, offset: int = 0, limit: int = 1000):
+    job = await storage.control(jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    rows = await storage.control(jobs.job_results, job_id, offset, limit)
+    del job["client"]
+    job["dedupe"] = bool(job["dedupe"])
+    job["next_offset"] = offset + len(rows)
+    return Response(bulk_encoder.body(rows, job), media_type="application/json")
+
+@app.get("/api/export/{dataset}")
+async def export_dataset(request: Request, dataset: str, format: str = "csv", campaign: Optional[str] = None,
+                         granularity: str = "day", since: Optional[int] = None, until: Optional[int] = None):
+    # links, campaigns, clicks (per-link rollups) or campaign_clicks, streamed
+    # from the export's own read connections a chunk at a time
+    limit_request(request)
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail="無効な形式です")
+    if format == "parquet" and export.pyarrow is None:
+        raise HTTPException(status_code=400, detail="Parquet形式はサーバーで利用できません")
+    paths = database_paths(storage)
+    if not paths:
+        raise HTTPException(status_code=400, detail="このストレージではエクスポートできません")
+    filters = {"campaign": campaign}
+    if dataset in ("clicks", "campaign_clicks"):
+        filters.update(granularity=granularity, since=since, until=until)
+    if dataset == "links":
+        filters["base_url"] = PUBLIC_BASE_URL
     try:
-        url_list = [url.strip() for url in urls.split('\n') if url.strip()]
-        results = []
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        for url in url_list:
-            if validate_url(url):
-                short_code = generate_short_code()
-                
-                cursor.execute("""
-                    INSERT INTO urls (short_code, original_url, created_at)
-                    VALUES (?, ?, ?)
-                """, (short_code, url, datetime.now().isoformat()))
-                
-                results.append({
-                    "url": url,
-                    "short_url": f"https://url-shortener-mvp.onrender.com/{short_code}",
-                    "success": True
-                })
-            else:
-                results.append({"url": url, "success": False, "error": "無効なURL"})
-        
-        conn.commit()
-        conn.close()
-        
-        return JSONResponse({"results": results})
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        chunks = export.export_stream(paths, dataset, format, **filters)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="エクスポート対象が見つかりません")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なパラメータです")
+    media_type, extension = export.FORMATS[format]
+
+    async def generate():
+        try:
+            while True:
+                # Cursor reads and encoding block, so they run in the threadpool
+                data = await run_in_threadpool(next, chunks, None)
+                if data is None:
+                    break
+                yield data
+        finally:
+            chunks.close()
+
+    headers = {"Content-Disposition": 'attachment; filename="%s.%s"' % (dataset, extension)}
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+@app.get("/admin", response_class=HTMLResponse)
+async def admin_page(request: Request):
+    return static_response(admin_shell, request)
+
+@app.get("/api/admin/urls")
+async def admin_urls(request: Request, limit: int = admin.DEFAULT_PAGE_SIZE, cursor: str = None, campaign: str = None):
+    try:
+        return await cached_json(request, ("urls", limit, cursor, campaign),
+                                 lambda: storage.list_urls(limit, cursor, campaign))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なカーソル")
+
+@app.get("/api/admin/summary")
+async def admin_summary(request: Request):
+    return await cached_json(request, ("summary",), storage.summary)
+
+@app.get("/api/page-cache-stats")
+async def page_cache_stats():
+    # Per worker process
+    return {"admin": admin_cache.stats(), "pages": {"bulk": bulk_shell.stats(), "admin": admin_shell.stats()}}
+
+@app.get("/analytics/{short_code}", response_class=HTMLResponse)
+async def analytics_page(request: Request, short_code: str):
+    link = await storage.get_link(short_code)
+    if link is None:
+        raise HTTPException(status_code=404, detail="短縮URLが見つかりません")
+    return templates.TemplateResponse("analytics.html", {"request": request, "link": link})
+
+def analytics_range(days, granularity):
+    # ``days`` is bounded by the routes: day buckets cap a range at MAX_POINTS days
+    until = int(time.time())
+    since = until - days * 86400
+    granularity = granularity or analytics.pick_granularity(until - since)
+    if granularity not in analytics.GRANULARITIES:
+        raise HTTPException(status_code=400, detail="無効な集計単位")
+    return granularity, since, until
+
+@app.get("/api/analytics/{short_code}")
+async def link_analytics(short_code: str, days: int = Query(90, ge=1, le=analytics.MAX_POINTS),
+                         granularity: str = None):
+    granularity, since, until = analytics_range(days, granularity)
+    try:
+        return await storage.link_series(short_code, granularity, since, until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="期間が長すぎます")
+
+@app.get("/api/analytics/campaign/{campaign}")
+async def campaign_analytics(campaign: str, days: int = Query(90, ge=1, le=analytics.MAX_POINTS),
+                             granularity: str = None):
+    granularity, since, until = analytics_range(days, granularity)
+    try:
+        return await storage.campaign_series(campaign, granularity, since, until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="期間が長すぎます")
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    # Per worker process
+    return dict(redirect_cache.stats(), pid=os.getpid(), invalidations=invalidation_listener.stats())
+
+@app.get("/api/rate-limit-stats")
+async def rate_limit_stats():
+    return {"requests": request_limiter.stats(), "bulk_rows": bulk_row_limiter.stats()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Per worker process, like the other stats endpoints
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/job-stats")
+async def job_stats():
+    return job_runner.stats()
+
+@app.get("/api/code-index-stats")
+async def code_index_stats():
+    # Per worker process
+    return code_index.stats()
+
+@app.get("/api/archive-stats")
+async def archive_stats():
+    return archive_worker.stats()
+
+@app.get("/api/idempotency-stats")
+async def idempotency_stats():
+    # Per worker process
+    return idempotency_cache.stats()
+
+@app.get("/api/url-map-stats")
+async def url_map_stats():
+    # Per worker process
+    return url_map.stats()
+
+@app.get("/api/click-stats")
+async def click_stats():
+    return click_recorder.stats()
+
+@app.put("/api/urls/{short_code}")
+async def update_url(request: Request, short_code: str, original_url: str = Form(...)):
+    limit_request(request)
+    original_url, error = check_url(original_url.strip())
+    if error:
+        raise HTTPException(status_code=400, detail=ERRORS[error])
+    if not await storage.update_url(short_code, original_url):
+        raise HTTPException(status_code=404, detail="短縮URLが見つかりません")
+    await invalidate(short_code)
+    return {"short_code": short_code, "original_url": original_url, "success": True}
+
+@app.delete("/api/urls/{short_code}")
+async def remove_url(request: Request, short_code: str):
+    limit_request(request)
+    if not await storage.delete_url(short_code):
+        raise HTTPException(status_code=404, detail="短縮URLが見つかりません")
+    await invalidate(short_code)
+    return {"short_code": short_code, "success": True}
+
+# Catch-all redirect; must stay the last GET route so it does not shadow /bulk etc.
+@app.get("/{short_code}")
+async def redirect(short_code: str):
+    url = redirect_cache.get(short_code)
+    if url is MISS:
+        link = url_map.get(short_code)
+        if link is MISS:
+            if not code_index.might_contain(short_code) and await code_index.confirm_absent(short_code):
+                # Definitely unknown: no query, and no negative entry crowding the cache. With
+                # several workers the filter first catches up on the others' inserts.
+                raise HTTPException(status_code=404, detail="短縮URLが見つかりません")
+            link = await storage.get_url(short_code)
+            if link is None:
+                code_index.maybe_missed()
+        # (url, expires_at) or None; an entry never outlives the link
+        url, expires_at = link or (None, None)
+        redirect_cache.put(short_code, url, expires_at)
+    if url is None:
+        raise HTTPException(status_code=404, detail="短縮URLが見つかりません")
+    click_recorder.record(short_code)
+    return RedirectResponse(url, status_code=302)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKERS > 1:
+        # uvicorn forks the workers itself and needs an import string for that
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
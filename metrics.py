@@ -0,0 +1,157 @@
+import bisect
+import threading
+import time
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4). Metrics
+# are module-level objects registered in REGISTRY; updates are a dict lookup
+# and an add under a per-metric lock (DB metrics are updated from executor
+# threads). MetricsMiddleware can sample requests to keep the hot path cheap.
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, labels, "", value) for labels, value in values]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per-bucket counts (+Inf last), sum, count
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self._values.items()]
+        samples = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                samples.append((self.name + "_bucket", labels, 'le="%s"' % _format_value(bound), cumulative))
+            samples.append((self.name + "_sum", labels, "", total))
+            samples.append((self.name + "_count", labels, "", count))
+        return samples
+
+
+class Callback:
+    """A counter or gauge read at scrape time: ``fn()`` returns a value or {label tuple: value}."""
+
+    def __init__(self, name, help, fn, kind="gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def samples(self):
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return [(self.name, labels, "", v) for labels, v in items]
+
+
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.append("# HELP %s %s" % (metric.name, metric.help))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for name, labels, extra, value in metric.samples():
+            lines.append("%s%s %s" % (name, _format_labels(metric.labels, labels, extra), _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ("route", "status"))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency.", ("route",))
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording request count and latency per route.
+
+    With ``sample_rate`` < 1 only every ``round(1 / sample_rate)``-th request
+    is recorded, and it counts for that many requests, so request totals become
+    estimates while the other requests pass straight through at the cost of a
+    decrement. The route label is the endpoint function name, which the router
+    stores in the scope, so label cardinality is bounded by the number of routes.
+    """
+
+    def __init__(self, app, sample_rate=1.0):
+        self.app = app
+        self.every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self._countdown = self.every
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.every:
+            await self.app(scope, receive, send)
+            return
+        self._countdown -= 1
+        if self._countdown:
+            await self.app(scope, receive, send)
+            return
+        self._countdown = self.every
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            REQUESTS.inc(route, status[0], amount=self.every)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route)
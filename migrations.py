@@ -0,0 +1,95 @@
+import logging
+import time
+
+import admin
+import analytics
+import archive
+import bulk
+import clicks
+import codeindex
+import idempotency
+import invalidations
+import jobs
+from allocator import ensure_schema as ensure_allocator_schema
+
+# Versioned schema migrations, run once at startup (see lifespan in main.py).
+# The applied version lives in PRAGMA user_version, so a warm start costs a
+# single pragma read. Each step runs in its own BEGIN IMMEDIATE transaction and
+# re-checks the version under the write lock, so concurrently starting workers
+# never apply a step twice. Steps are idempotent and also upgrade databases
+# created before versioning, whose urls table was never declared here.
+
+logger = logging.getLogger(__name__)
+
+
+def create_urls(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS urls (
+            short_code TEXT NOT NULL,
+            original_url TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    ensure_allocator_schema(conn)
+
+
+def create_url_changes(conn):
+    # Imported here: urlmap imports db, which reads DATABASE_PATH at import
+    # time, and importing migrations must not fix it (benchmarks/suite.py sets
+    # it later)
+    import urlmap
+    urlmap.ensure_schema(conn)
+
+
+MIGRATIONS = [
+    (1, "urls table, UNIQUE short_code, code allocator", create_urls),
+    (2, "click events and urls.clicks counter", clicks.ensure_schema),
+    (3, "admin listing indexes and maintained totals", admin.ensure_schema),
+    (4, "normalized URL hash index", bulk.ensure_schema),
+    (5, "click rollups", analytics.ensure_schema),
+    (6, "cross-worker cache invalidation log", invalidations.ensure_schema),
+    (7, "background bulk jobs", jobs.ensure_schema),
+    (8, "code index epoch for deletes at the top of urls", codeindex.ensure_schema),
+    (9, "link expiry and the cold link archive", archive.ensure_schema),
+    (10, "url change log for the URL map", create_url_changes),
+    (11, "idempotency keys and stored responses", idempotency.ensure_schema),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply pending migrations; returns the list of versions applied."""
+    if current_version(conn) >= LATEST_VERSION:
+        return []
+    start = time.perf_counter()
+    applied = []
+    for version, description, step in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute("PRAGMA user_version = %d" % version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info("applied migration %d: %s", version, description)
+        applied.append(version)
+    if applied:
+        # Fresh statistics for the planner after indexes were created
+        conn.execute("ANALYZE")
+        conn.commit()
+        logger.info("schema at version %d (%.1f ms)", LATEST_VERSION, (time.perf_counter() - start) * 1000)
+    return applied
+
+
+def optimize(conn):
+    # Recommended by SQLite before closing long-lived connections
+    conn.execute("PRAGMA optimize")
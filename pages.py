@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import time
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # optional; without it pages are served gzip or uncompressed
+    brotli = None
+
+# Page shells (/bulk, /admin) never change while the process runs, so they are
+# rendered and compressed once at import and kept as bytes, one variant per
+# content coding, each with its own strong ETag. Serving a view is picking a
+# variant from Accept-Encoding; a revalidation with a matching If-None-Match is
+# a bodyless 304. The dynamic admin data is cached separately in
+# FragmentCache, which is cleared whenever links or clicks change.
+
+PREFERENCE = ("br", "gzip")
+
+
+def etag_for(body):
+    return '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def accepted_encodings(header):
+    """Content codings from an Accept-Encoding header with q > 0."""
+    accepted = {}
+    wildcard = False
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name == "*":
+            wildcard = q > 0
+        else:
+            accepted[name] = q
+    return {coding for coding in PREFERENCE if accepted.get(coding, 1.0 if wildcard else 0.0) > 0}
+
+
+def not_modified(if_none_match, etag):
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+
+class StaticPage:
+    def __init__(self, body, media_type="text/html; charset=utf-8"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.media_type = media_type
+        tag = etag_for(body)
+        self.variants = {None: (body, tag)}
+        compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body, quality=11)
+        for coding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[coding] = (data, tag[:-1] + "-" + coding + '"')
+
+    def select(self, accept_encoding, if_none_match=None):
+        """``(status, body, headers)`` for a GET with the given request headers."""
+        accepted = accepted_encodings(accept_encoding)
+        coding = next((c for c in PREFERENCE if c in accepted and c in self.variants), None)
+        body, etag = self.variants[coding]
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if not_modified(if_none_match, etag):
+            return 304, b"", headers
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        return 200, body, headers
+
+    def stats(self):
+        return {coding or "identity": len(body) for coding, (body, _) in self.variants.items()}
+
+
+class FragmentCache:
+    """Encoded response bodies keyed by request parameters.
+
+    ``clear()`` drops everything and bumps ``generation``; a fill computed
+    from data read before a clear is discarded. Changes made by other worker
+    processes are not seen here, so entries also expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize=256, ttl=5.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+
+    def get(self, key):
+        """``(body, etag)`` or None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[2] <= self._clock():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key, body, generation):
+        """Store ``body`` computed when ``generation`` was current; returns ``(body, etag)``."""
+        etag = etag_for(body)
+        if generation == self.generation and self.ttl > 0:
+            self._entries[key] = (body, etag, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def clear(self):
+        self.generation += 1
+        if self._entries:
+            self._entries.clear()
+            self.clears += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "clears": self.clears,
+        }
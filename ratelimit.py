@@ -0,0 +1,83 @@
+import math
+import time
+from collections import OrderedDict
+
+# In-process token buckets keyed by client (API key or IP). A bucket is just
+# [tokens, last_refill] in an OrderedDict kept in LRU order, so a decision is a
+# dict lookup plus a little arithmetic. At most ``maxsize`` buckets are kept;
+# the least recently used one is dropped first, which is harmless for idle
+# clients because their bucket would have refilled anyway. Only used from the
+# event loop, so there is no lock.
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, maxsize=100000, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _refill(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            bucket[0] = tokens if tokens < self.burst else self.burst
+            bucket[1] = now
+        return bucket
+
+    def take(self, key, cost=1):
+        """Spend ``cost`` tokens; returns 0.0 if allowed, else seconds until it would be."""
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._refill(key, self._clock())
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            self.allowed += 1
+            return 0.0
+        self.rejected += 1
+        if cost > self.burst:
+            return math.inf
+        return (cost - bucket[0]) / self.rate
+
+    def reserve(self, key, cost):
+        """Spend ``cost`` tokens unconditionally (the bucket may go negative).
+
+        Returns how long the caller should wait before proceeding; used to pace
+        work that has already been accepted, such as the batches of an upload.
+        """
+        if not self.enabled:
+            return 0.0
+        bucket = self._refill(key, self._clock())
+        bucket[0] -= cost
+        self.allowed += 1
+        return max(0.0, -bucket[0] / self.rate)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self._buckets),
+            "maxsize": self.maxsize,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+        }
+
+
+def retry_after(seconds):
+    # Retry-After takes whole seconds
+    return str(max(1, math.ceil(seconds)))
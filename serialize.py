@@ -0,0 +1,55 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder produces the same JSON, slower
+    orjson = None
+
+# Bulk result encoding. A bulk response can hold 100k rows, so rows are never
+# turned into response dicts: each row is written straight to bytes from a
+# template whose constant parts (the public base URL, the keys, the error
+# messages) are encoded once. Only the submitted URL is escaped per row.
+
+
+if orjson is not None:
+    dumps = orjson.dumps
+else:
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class BulkEncoder:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # Short codes are [A-Za-z0-9_-], so they are spliced in unescaped
+        base = dumps(base_url)[1:-1].replace(b"%", b"%%")
+        self._created = b'{"url":%b,"short_url":"' + base + b'%b","success":true}'
+        self._reused = b'{"url":%b,"short_url":"' + base + b'%b","success":true,"reused":true}'
+        self._failed = b'{"url":%b,"success":false,%b}'
+        self._errors = {}
+
+    def row(self, row):
+        if row["success"]:
+            template = self._reused if row.get("reused") else self._created
+            return template % (dumps(row["url"]), row["short_code"].encode())
+        key = (row["error"], row.get("error_code"))
+        error = self._errors.get(key)
+        if error is None:
+            error = b'"error":' + dumps(key[0])
+            if key[1] is not None:
+                error += b',"error_code":' + dumps(key[1])
+            self._errors[key] = error
+        return self._failed % (dumps(row["url"]), error)
+
+    def ndjson(self, rows):
+        row = self.row
+        return b"".join([row(r) + b"\n" for r in rows])
+
+    def body(self, rows, extra=None):
+        """``{"results": [...]}`` plus any ``extra`` top-level keys, as bytes."""
+        row = self.row
+        parts = [b'{"results":[', b",".join([row(r) for r in rows]), b"]"]
+        for key, value in (extra or {}).items():
+            parts.append(b"," + dumps(key) + b":" + dumps(value))
+        parts.append(b"}")
+        return b"".join(parts)
@@ -0,0 +1,394 @@
+import asyncio
+import heapq
+import os
+import zlib
+from collections import Counter, defaultdict
+
+import admin
+import analytics
+import archive
+import invalidations
+import migrations
+from allocator import CodeSpaceExhausted
+from bulk import (
+    apply_reuse, bulk_insert, dedupe_keys, failure, find_existing, normalize_row, plan_reuse, url_hash,
+    validate_rows,
+)
+from clicks import write_clicks
+from db import DB_PATH, POOL_SIZE, Database
+
+# Storage engines behind the URL, code and click operations. Handlers only
+# await methods on the engine; each engine runs the SQL from the feature
+# modules on its own Database executor(s).
+#
+#   sqlite   one database file (the default)
+#   sharded  N files, picked by crc32(short_code) % N; a redirect or update
+#            touches exactly one shard, bulk inserts fan out in parallel and
+#            admin/campaign reads merge per-shard results
+#   memory   a private in-memory SQLite database, for tests and benchmarks
+#
+# Tables that are not keyed by short code (bulk jobs, the invalidation log)
+# are reached through ``control`` and are never sharded.
+
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "sqlite")
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "4"))
+
+
+def get_original_url(conn, short_code):
+    """``(url, expires_at)`` of a live link, or None (unknown or expired)."""
+    row = conn.execute("SELECT original_url, expires_at FROM urls WHERE short_code = ?", (short_code,)).fetchone()
+    if row is None:
+        # Cold links fault back in from the archive
+        return archive.restore(conn, short_code)
+    return None if archive.expired(row[1]) else (row[0], row[1])
+
+
+def update_original_url(conn, short_code, original_url):
+    params = (original_url, url_hash(original_url), short_code)
+    updated = conn.execute("UPDATE urls SET original_url = ?, url_hash = ? WHERE short_code = ?", params).rowcount
+    if not updated:
+        updated = conn.execute(
+            "UPDATE urls_archive SET original_url = ?, url_hash = ? WHERE short_code = ?", params,
+        ).rowcount
+    conn.commit()
+    return updated > 0
+
+
+def delete_url(conn, short_code):
+    deleted = conn.execute("DELETE FROM urls WHERE short_code = ?", (short_code,)).rowcount
+    if not deleted:
+        deleted = conn.execute("DELETE FROM urls_archive WHERE short_code = ?", (short_code,)).rowcount
+    conn.commit()
+    return deleted > 0
+
+
+def prepare_rows(items, dedupe):
+    """Normalize and validate bulk rows; returns (items, results, pending, hashes, dedupe keys).
+
+    ``hashes`` holds the URL hash of each pending row without a custom code
+    when ``dedupe`` is set. URL checks may wait on the checker's process pool,
+    so this runs in a worker thread.
+    """
+    items = [normalize_row(item) for item in items]
+    results, pending, _ = validate_rows(items)
+    hashes = {}
+    if dedupe:
+        hashes = {i: url_hash(items[i]["target"]) for i in pending if items[i]["custom_code"] is None}
+    return items, results, pending, hashes, dedupe_keys(items, hashes)
+
+
+def fold_rollups(conn):
+    return analytics.fold_all(conn), analytics.compact(conn)
+
+
+class SQLiteStorage:
+    engine = "sqlite"
+    partitions = 1
+    # Set to CodeIndex.might_contain by the app: custom codes it rules out skip the lookup
+    might_exist = None
+
+    def __init__(self, allocator, path=DB_PATH, pool_size=POOL_SIZE):
+        self.allocator = allocator
+        self.db = Database(path, pool_size)
+
+    def open(self):
+        self.db.open()
+
+    async def migrate(self):
+        return await self.db.run(migrations.migrate)
+
+    async def close(self):
+        await self.db.run(migrations.optimize)
+        self.db.close()
+
+    async def insert_urls(self, items, dedupe=False):
+        return await self.db.run(bulk_insert, self.allocator, items, dedupe, self.might_exist)
+
+    async def get_url(self, short_code):
+        return await self.db.run(get_original_url, short_code)
+
+    async def get_link(self, short_code):
+        return await self.db.run(analytics.link_info, short_code)
+
+    async def update_url(self, short_code, original_url):
+        return await self.db.run(update_original_url, short_code, original_url)
+
+    async def delete_url(self, short_code):
+        return await self.db.run(delete_url, short_code)
+
+    async def record_clicks(self, events, counts):
+        await self.db.run(write_clicks, events, counts)
+
+    async def list_urls(self, limit=admin.DEFAULT_PAGE_SIZE, cursor=None, campaign=None):
+        return await self.db.run(admin.list_urls, limit, cursor, campaign)
+
+    async def summary(self, campaign_limit=100):
+        return await self.db.run(admin.summary, campaign_limit)
+
+    async def link_series(self, short_code, granularity, since, until):
+        return await self.db.run(analytics.link_series, short_code, granularity, since, until)
+
+    async def campaign_series(self, campaign, granularity, since, until):
+        return await self.db.run(analytics.campaign_series, campaign, granularity, since, until)
+
+    async def fold_rollups(self):
+        """Fold new click events and compact old ones; returns (folded, compacted)."""
+        return await self.db.run(fold_rollups)
+
+    async def archive_links(self, cold_after=archive.COLD_AFTER):
+        """Move expired and cold links to the archive; returns the moved codes as (expired, cold)."""
+        return await self.db.run(archive.archive_links, None, cold_after)
+
+    async def control(self, fn, *args):
+        """Run ``fn(conn, *args)`` against the unsharded tables (jobs, invalidation log)."""
+        return await self.db.run(fn, *args)
+
+    async def on_partition(self, n, fn, *args):
+        """Run ``fn(conn, *args)`` on the ``n``-th database holding urls."""
+        return await self.db.run(fn, *args)
+
+    async def publish_invalidations(self, codes):
+        await self.db.run(invalidations.publish, codes)
+
+    async def poll_invalidations(self, after):
+        return await self.db.run(invalidations.fetch, after)
+
+    async def prune_invalidations(self):
+        return await self.db.run(invalidations.prune)
+
+
+class MemoryStorage(SQLiteStorage):
+    # One connection: a plain :memory: database lives and dies with it
+    engine = "memory"
+
+    def __init__(self, allocator):
+        super().__init__(allocator, ":memory:", 1)
+
+
+class _ShardAllocator:
+    """Hands one shard the codes minted for it up front; replacements stay on that shard."""
+
+    def __init__(self, storage, index, codes):
+        self.storage = storage
+        self.index = index
+        self.codes = codes
+
+    def allocate(self, conn, n):
+        codes, self.codes = self.codes[:n], self.codes[n:]
+        return codes + [self.next_code(conn) for _ in range(n - len(codes))]
+
+    def next_code(self, conn):
+        while True:
+            code = self.storage.mint(1)[0]
+            if self.storage.shard_of(code) == self.index:
+                return code
+
+
+class ShardedStorage:
+    engine = "sharded"
+    might_exist = None
+
+    def __init__(self, allocator, directory=SHARD_DIR, shards=SHARD_COUNT, pool_size=POOL_SIZE):
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+        self.allocator = allocator
+        self.directory = directory
+        self.shards = [
+            SQLiteStorage(allocator, os.path.join(directory, "shard-%02d.db" % n), pool_size)
+            for n in range(shards)
+        ]
+        # The code sequence lives apart from the data, so reserving a block
+        # never waits on (or deadlocks with) a shard's write transaction
+        self.meta = Database(os.path.join(directory, "meta.db"), 1)
+        self.partitions = shards
+
+    def shard_of(self, short_code):
+        return zlib.crc32(short_code.encode("utf-8")) % len(self.shards)
+
+    def shard(self, short_code):
+        return self.shards[self.shard_of(short_code)]
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.meta.open()
+        for shard in self.shards:
+            shard.open()
+
+    async def migrate(self):
+        await self.meta.run(migrations.migrate)
+        applied = await asyncio.gather(*(shard.migrate() for shard in self.shards))
+        return sorted(set().union(*applied))
+
+    async def close(self):
+        await asyncio.gather(*(shard.close() for shard in self.shards))
+        self.meta.close()
+
+    def _mint(self, conn, n):
+        codes = self.allocator.allocate(conn, n)
+        conn.commit()
+        return codes
+
+    def mint(self, n):
+        # Called from shard executor threads when a minted code collides
+        with self.meta.pool.connection() as conn:
+            return self._mint(conn, n)
+
+    def _assign(self, conn, items, results, pending, hashes, existing):
+        # Reuse plan, code minting and the split by shard, off the event loop
+        reuse = plan_reuse(items, pending, hashes, existing) if hashes else {}
+        pending = [i for i in pending if i not in reuse]
+        auto = [i for i in pending if items[i]["custom_code"] is None]
+        codes = {}
+        if auto:
+            try:
+                codes = dict(zip(auto, self._mint(conn, len(auto))))
+            except CodeSpaceExhausted as e:
+                for i in auto:
+                    results[i] = failure(items[i]["url"], "code_space_exhausted", str(e))
+                pending = [i for i in pending if results[i] is None]
+
+        groups, minted = defaultdict(list), defaultdict(list)
+        for i in pending:
+            code = items[i]["custom_code"]
+            if code is None:
+                code = codes[i]
+                minted[self.shard_of(code)].append(code)
+            groups[self.shard_of(code)].append(i)
+        return reuse, groups, minted
+
+    async def insert_urls(self, items, dedupe=False):
+        # In-batch custom code duplicates are caught here; taken ones by each shard
+        items, results, pending, hashes, keys = await asyncio.get_running_loop().run_in_executor(
+            None, prepare_rows, items, dedupe,
+        )
+        existing = {}
+        if keys:
+            for found in await asyncio.gather(*(shard.db.run(find_existing, keys) for shard in self.shards)):
+                existing.update(found)
+        reuse, groups, minted = await self.meta.run(self._assign, items, results, pending, hashes, existing)
+
+        async def insert_shard(n, indices):
+            allocator = _ShardAllocator(self, n, minted[n])
+            # The rows were validated above; the shard only checks taken codes
+            rows = await self.shards[n].db.run(
+                bulk_insert, allocator, [items[i] for i in indices], False, self.might_exist, True,
+            )
+            for i, row in zip(indices, rows):
+                results[i] = row
+
+        await asyncio.gather(*(insert_shard(n, indices) for n, indices in groups.items()))
+        apply_reuse(results, items, reuse)
+        return results
+
+    async def get_url(self, short_code):
+        return await self.shard(short_code).get_url(short_code)
+
+    async def get_link(self, short_code):
+        return await self.shard(short_code).get_link(short_code)
+
+    async def update_url(self, short_code, original_url):
+        return await self.shard(short_code).update_url(short_code, original_url)
+
+    async def delete_url(self, short_code):
+        return await self.shard(short_code).delete_url(short_code)
+
+    async def record_clicks(self, events, counts):
+        split = defaultdict(list)
+        for event in events:
+            split[self.shard_of(event[0])].append(event)
+        await asyncio.gather(*(
+            self.shards[n].record_clicks(part, Counter({code: counts[code] for code, _ in part}))
+            for n, part in split.items()
+        ))
+
+    async def list_urls(self, limit=admin.DEFAULT_PAGE_SIZE, cursor=None, campaign=None):
+        # Every shard returns its own next page; the merged page is the top ``limit`` of those
+        limit = max(1, min(limit, admin.MAX_PAGE_SIZE))
+        pages = await asyncio.gather(*(shard.list_urls(limit, cursor, campaign) for shard in self.shards))
+        rows = list(heapq.merge(
+            *(page["items"] for page in pages),
+            key=lambda row: (row["created_at"], row["short_code"]),
+            reverse=True,
+        ))
+        next_cursor = None
+        if len(rows) > limit or any(page["next_cursor"] for page in pages):
+            rows = rows[:limit]
+            next_cursor = admin.encode_cursor(rows[-1]["created_at"], rows[-1]["short_code"])
+        return {"items": rows, "next_cursor": next_cursor}
+
+    async def summary(self, campaign_limit=100):
+        # -1: no LIMIT, every shard's campaigns are needed to merge them
+        parts = await asyncio.gather(*(shard.summary(-1) for shard in self.shards))
+        campaigns = {}
+        for part in parts:
+            for row in part["campaigns"]:
+                merged = campaigns.setdefault(row["campaign"], {"campaign": row["campaign"], "urls": 0, "clicks": 0})
+                merged["urls"] += row["urls"]
+                merged["clicks"] += row["clicks"]
+        ranked = sorted(campaigns.values(), key=lambda row: row["clicks"], reverse=True)
+        return {
+            "total_urls": sum(part["total_urls"] for part in parts),
+            "total_clicks": sum(part["total_clicks"] for part in parts),
+            "campaign_count": len(campaigns),
+            "campaigns": ranked[:campaign_limit] if campaign_limit >= 0 else ranked,
+        }
+
+    async def link_series(self, short_code, granularity, since, until):
+        return await self.shard(short_code).link_series(short_code, granularity, since, until)
+
+    async def campaign_series(self, campaign, granularity, since, until):
+        parts = await asyncio.gather(*(
+            shard.campaign_series(campaign, granularity, since, until) for shard in self.shards
+        ))
+        series = parts[0]
+        for part in parts[1:]:
+            series["total"] += part["total"]
+            for point, other in zip(series["points"], part["points"]):
+                point[1] += other[1]
+        return series
+
+    async def fold_rollups(self):
+        parts = await asyncio.gather(*(shard.fold_rollups() for shard in self.shards))
+        return sum(part[0] for part in parts), sum(part[1] for part in parts)
+
+    async def archive_links(self, cold_after=archive.COLD_AFTER):
+        parts = await asyncio.gather(*(shard.archive_links(cold_after) for shard in self.shards))
+        return [code for part in parts for code in part[0]], [code for part in parts for code in part[1]]
+
+    # Global tables (invalidation log, bulk jobs) live next to the code sequence
+    async def control(self, fn, *args):
+        return await self.meta.run(fn, *args)
+
+    async def on_partition(self, n, fn, *args):
+        return await self.shards[n].db.run(fn, *args)
+
+    async def publish_invalidations(self, codes):
+        await self.meta.run(invalidations.publish, codes)
+
+    async def poll_invalidations(self, after):
+        return await self.meta.run(invalidations.fetch, after)
+
+    async def prune_invalidations(self):
+        return await self.meta.run(invalidations.prune)
+
+
+ENGINES = {
+    "sqlite": SQLiteStorage,
+    "sharded": ShardedStorage,
+    "memory": MemoryStorage,
+}
+
+
+def make_storage(engine, allocator, **options):
+    try:
+        cls = ENGINES[engine]
+    except KeyError:
+        raise ValueError("unknown storage engine: %r" % engine)
+    return cls(allocator, **options)
+
+
+def read_only_storage(engine=STORAGE_ENGINE):
+    """The configured engine for command-line readers. It has no allocator, so
+    it cannot insert, and it is never opened: readers use its database paths."""
+    return make_storage(engine, None)
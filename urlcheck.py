@@ -0,0 +1,235 @@
+import ipaddress
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+# Strict validation of link targets, a batch at a time. Every URL must be
+# http(s) with a real host: DNS labels (internationalized names are
+# IDNA-encoded), an IPv4 address or a bracketed IPv6 address. Whitespace,
+# control characters, credentials and bad ports are rejected. The result for
+# each URL is (normalized URL, None) or (None, error code); normalizing
+# lower-cases the scheme and host and drops a trailing dot, so what is stored
+# is what the redirect will send.
+#
+# Most URLs are plain ASCII and are split by one precompiled regex; only the
+# rest are taken apart with urlsplit. Each distinct host in a batch is checked
+# once, including the blocklist lookup: a trie of domain labels from the TLD
+# down, so a lookup costs one dict step per label whatever the list size.
+# Very large batches can be fanned out to worker processes
+# (URL_CHECK_PROCESSES): the checks are pure Python, so threads would only
+# take turns on the GIL.
+
+MAX_URL_LENGTH = 2048
+MAX_HOST_LENGTH = 253
+FANOUT_MIN_ROWS = 20000
+FANOUT_CHUNK = 10000
+
+MESSAGES = {
+    "empty": "URLが空です",
+    "too_long": "URLが長すぎます",
+    "invalid_characters": "URLに使用できない文字が含まれています",
+    "invalid_scheme": "http または https のURLのみ使用できます",
+    "credentials": "認証情報を含むURLは使用できません",
+    "invalid_host": "無効なホスト名",
+    "invalid_port": "無効なポート番号",
+    "invalid_idna": "国際化ドメイン名を変換できません",
+    "blocked_domain": "このドメインは使用できません",
+}
+
+_LABEL = r"[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?"
+# scheme://host[:port][rest] with an ASCII host and printable ASCII after it;
+# the host itself is checked separately. Anything else takes the slow path.
+FAST_RE = re.compile(r"(https?|HTTPS?)://([A-Za-z0-9.-]{1,254})(?::(\d{1,5}))?([/?#][\x21-\x7e]*)?")
+HOST_RE = re.compile(r"(?:%s\.)+%s" % (_LABEL, _LABEL))
+# Controls, any Unicode whitespace, and the invisible zero-width and bidi marks used for spoofing
+BAD_CHARS_RE = re.compile(r"[\x00-\x20\x7f\s\u200b-\u200f\u202a-\u202e\u2066-\u2069\ufeff]")
+
+
+class DomainTrie:
+    """Blocked domains, matching the domain itself and every subdomain."""
+
+    def __init__(self, domains=()):
+        self.root = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        domain = domain.split("#", 1)[0].strip().lower().rstrip(".")
+        if not domain:
+            return
+        try:
+            domain = domain.encode("idna").decode("ascii")
+        except UnicodeError:
+            return
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        # "" is never a label, so it marks the end of a blocked domain
+        if "" not in node:
+            node[""] = True
+            self.size += 1
+
+    def blocks(self, host):
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if "" in node:
+                return True
+        return False
+
+    def __len__(self):
+        return self.size
+
+
+def load_blocklist(path):
+    """DomainTrie from a file with one domain per line (``#`` starts a comment)."""
+    if not path:
+        return DomainTrie()
+    with open(path, encoding="utf-8") as f:
+        return DomainTrie(f)
+
+
+BLOCKLIST = load_blocklist(os.environ.get("URL_BLOCKLIST"))
+PROCESSES = int(os.environ.get("URL_CHECK_PROCESSES", "0"))
+_pool = None
+
+
+def _ipv4(host):
+    try:
+        ipaddress.IPv4Address(host)
+        return True
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=65536)
+def _idna(host):
+    # The stdlib codec costs tens of microseconds, and bulk uploads repeat hosts
+    try:
+        return host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+
+
+def _check_host(host):
+    """(ASCII host, None) or (None, error code) for a host without port or brackets."""
+    if host.endswith("."):
+        host = host[:-1]
+    if not host.isascii():
+        host = _idna(host)
+        if host is None:
+            return None, "invalid_idna"
+    host = host.lower()
+    if len(host) > MAX_HOST_LENGTH or not HOST_RE.fullmatch(host):
+        return None, "invalid_host"
+    # A numeric last label is only valid as a whole IPv4 address
+    if host.rpartition(".")[2].isdigit() and not _ipv4(host):
+        return None, "invalid_host"
+    return host, None
+
+
+def _check_slow(url):
+    """(normalized URL, error code, host) for anything the fast regex did not accept."""
+    if BAD_CHARS_RE.search(url):
+        return None, "invalid_characters", None
+    scheme, sep, _ = url.partition("://")
+    if not sep or scheme.lower() not in ("http", "https"):
+        return None, "invalid_scheme", None
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError as e:
+        return None, ("invalid_port" if "port" in str(e).lower() else "invalid_host"), None
+    if parts.username is not None or parts.password is not None:
+        return None, "credentials", None
+    if "\\" in parts.netloc:
+        return None, "invalid_host", None
+    if port == 0 or (port is None and parts.netloc.endswith(":")):
+        return None, "invalid_port", None
+    host = parts.hostname
+    if not host:
+        return None, "invalid_host", None
+    if parts.netloc.startswith("["):
+        try:
+            netloc = "[%s]" % ipaddress.IPv6Address(host).compressed
+        except ValueError:
+            return None, "invalid_host", None
+    else:
+        host, error = _check_host(host)
+        if error:
+            return None, error, None
+        netloc = host
+    if port is not None:
+        netloc += ":%d" % port
+    normalized = urlunsplit((parts.scheme.lower(), netloc, parts.path, parts.query, parts.fragment))
+    # urlunsplit drops an empty "?" or "#"; keep the URL as submitted
+    if url.endswith(("?", "#")) and not normalized.endswith(url[-1]):
+        normalized += url[-1]
+    return normalized, None, host
+
+
+def _check_batch(urls, blocklist):
+    fast = FAST_RE.fullmatch
+    blocks = blocklist.blocks if blocklist else None
+    # host as written -> (ASCII host, error code), including the blocklist verdict
+    hosts = {}
+    results = []
+    append = results.append
+    for url in urls:
+        if not url:
+            append((None, "empty"))
+            continue
+        if len(url) > MAX_URL_LENGTH:
+            append((None, "too_long"))
+            continue
+        m = fast(url)
+        if m is None:
+            url, error, host = _check_slow(url)
+            if error is None and blocks is not None and blocks(host):
+                error = "blocked_domain"
+            append((None, error) if error else (url, None))
+            continue
+        scheme, host, port, rest = m.groups()
+        checked = hosts.get(host)
+        if checked is None:
+            checked = _check_host(host)
+            if checked[1] is None and blocks is not None and blocks(checked[0]):
+                checked = (None, "blocked_domain")
+            hosts[host] = checked
+        normalized, error = checked
+        if error is None and port is not None and not 0 < int(port) < 65536:
+            error = "invalid_port"
+        if error:
+            append((None, error))
+            continue
+        if normalized != host or scheme[0] == "H":
+            url = "%s://%s%s%s" % (scheme.lower(), normalized, ":" + port if port else "", rest or "")
+        append((url, None))
+    return results
+
+
+def _check_chunk(urls):
+    # Runs in a worker process, against that process's BLOCKLIST
+    return _check_batch(urls, BLOCKLIST)
+
+
+def check_urls(urls, blocklist=None):
+    """``[(normalized URL or None, error code or None)]``, one per URL."""
+    global _pool
+    if blocklist is None and PROCESSES > 1 and len(urls) >= FANOUT_MIN_ROWS:
+        if _pool is None:
+            # spawn: the app process has executor threads, which fork does not copy safely
+            _pool = ProcessPoolExecutor(PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        chunks = [urls[i:i + FANOUT_CHUNK] for i in range(0, len(urls), FANOUT_CHUNK)]
+        return [result for chunk in _pool.map(_check_chunk, chunks) for result in chunk]
+    return _check_batch(urls, BLOCKLIST if blocklist is None else blocklist)
+
+
+def check_url(url, blocklist=None):
+    return check_urls([url], blocklist)[0]
@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from cache import MISS
+from db import connect
+
+# Read-only, memory-mapped snapshot of short_code -> original_url for warm
+# starts. ``python urlmap.py export`` writes every live link, sorted by code:
+#
+#   header   magic, code width W, meta length, entry count N
+#   meta     JSON: per database, the url_changes id the snapshot is current to
+#   codes    N codes, NUL-padded to W bytes, in byte order
+#   offsets  N + 1 little-endian uint64 offsets into the blob
+#   expiry   N little-endian int64 expires_at (0: never)
+#   blob     the URLs, UTF-8, back to back
+#
+# Sections start at 8-byte boundaries. Workers mmap the file and search the
+# codes section in place: a bisect over every FENCE-th code (copied at load,
+# a few MB at 10M links) picks a block, and one find() in that block does the
+# rest. Nothing else is read up front, and the pages are the OS page cache,
+# shared by every process mapping the file.
+#
+# Codes created after the export are not in the file and go to the database.
+# Updates and deletes (archiving included) are logged in url_changes by
+# triggers; a worker reads the log past the snapshot's watermark at load time
+# and then every ``sync_interval`` seconds, and sends those codes to the
+# database too. Codes longer than MAX_WIDTH bytes are left out. A newer file
+# at the same path is picked up on the next sync.
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"URLMAP01"
+HEADER = struct.Struct("<8sIIQ")
+OFFSET = struct.Struct("<Q")
+SPAN = struct.Struct("<QQ")
+EXPIRY = struct.Struct("<q")
+MAX_WIDTH = 16
+FENCE = 256
+RETENTION = 7 * 86400
+FETCH_LIMIT = 10000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS url_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        short_code TEXT NOT NULL,
+        changed_at INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_update_changes
+    AFTER UPDATE OF original_url, expires_at ON urls BEGIN
+        INSERT INTO url_changes (short_code, changed_at) VALUES (OLD.short_code, CAST(strftime('%s', 'now') AS INTEGER));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_urls_delete_changes AFTER DELETE ON urls BEGIN
+        INSERT INTO url_changes (short_code, changed_at) VALUES (OLD.short_code, CAST(strftime('%s', 'now') AS INTEGER));
+    END
+    """,
+]
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def change_watermark(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'url_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def fetch_changes(conn, after, limit=FETCH_LIMIT):
+    """(watermark, codes, gap) for changes past ``after``; ``gap`` when some were pruned."""
+    latest = change_watermark(conn)
+    if latest <= after:
+        return after, [], latest < after
+    first = conn.execute("SELECT MIN(id) FROM url_changes").fetchone()[0]
+    rows = conn.execute(
+        "SELECT id, short_code FROM url_changes WHERE id > ? ORDER BY id LIMIT ?", (after, limit),
+    ).fetchall()
+    gap = first is None or first > after + 1
+    return (rows[-1][0] if rows else latest), [row[1] for row in rows], gap
+
+
+def prune_changes(conn, retention=RETENTION):
+    deleted = conn.execute(
+        "DELETE FROM url_changes WHERE changed_at < ?", (int(time.time()) - retention,)
+    ).rowcount
+    conn.commit()
+    return deleted
+
+
+def database_paths(storage):
+    if storage.engine == "memory":
+        return []
+    if storage.engine == "sharded":
+        return [shard.db.path for shard in storage.shards]
+    return [storage.db.path]
+
+
+def default_map_path(storage):
+    if storage.engine == "memory":
+        return None
+    if storage.engine == "sharded":
+        return os.path.join(storage.directory, "urls.map")
+    return storage.db.path + ".map"
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _layout(width, meta_len, count):
+    codes_at = _align(HEADER.size + meta_len)
+    offsets_at = _align(codes_at + count * width)
+    expiry_at = offsets_at + (count + 1) * OFFSET.size
+    blob_at = expiry_at + count * EXPIRY.size
+    return codes_at, offsets_at, expiry_at, blob_at
+
+
+def _rows(conn, width, now):
+    # BINARY collation compares UTF-8 bytes, the same order as the padded codes
+    cursor = conn.execute("""
+        SELECT short_code, original_url, expires_at FROM urls
+        WHERE length(CAST(short_code AS BLOB)) <= ? AND (expires_at IS NULL OR expires_at > ?)
+        ORDER BY short_code
+    """, (width, now))
+    for code, url, expires_at in cursor:
+        yield code.encode("utf-8"), url.encode("utf-8"), expires_at or 0
+
+
+def export_map(paths, out, max_width=MAX_WIDTH, now=None):
+    """Write a snapshot of the databases at ``paths`` to ``out``; returns the entry count."""
+    now = int(now if now is not None else time.time())
+    conns = [connect(path) for path in paths]
+    try:
+        marks, width = [], 1
+        for conn in conns:
+            # One read transaction per database: the watermark and the rows agree
+            conn.execute("BEGIN")
+            marks.append(change_watermark(conn))
+            longest = conn.execute(
+                "SELECT MAX(length(CAST(short_code AS BLOB))) FROM urls WHERE length(CAST(short_code AS BLOB)) <= ?",
+                (max_width,),
+            ).fetchone()[0]
+            width = max(width, longest or 0)
+        meta = json.dumps({"marks": marks, "written_at": now}).encode("utf-8")
+
+        directory = os.path.dirname(os.path.abspath(out))
+        with tempfile.TemporaryFile(dir=directory) as codes, tempfile.TemporaryFile(dir=directory) as offsets, \
+                tempfile.TemporaryFile(dir=directory) as expiry, tempfile.TemporaryFile(dir=directory) as blob:
+            count = position = 0
+            offsets.write(OFFSET.pack(0))
+            for code, url, expires_at in heapq.merge(*(_rows(conn, width, now) for conn in conns)):
+                codes.write(code.ljust(width, b"\0"))
+                blob.write(url)
+                position += len(url)
+                offsets.write(OFFSET.pack(position))
+                expiry.write(EXPIRY.pack(expires_at))
+                count += 1
+
+            codes_at, offsets_at, _, _ = _layout(width, len(meta), count)
+            tmp = "%s.%d.tmp" % (out, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(HEADER.pack(MAGIC, width, len(meta), count))
+                f.write(meta)
+                for section, start in ((codes, codes_at), (offsets, offsets_at), (expiry, None), (blob, None)):
+                    if start is not None:
+                        f.write(b"\0" * (start - f.tell()))
+                    section.seek(0)
+                    shutil.copyfileobj(section, f, 1 << 20)
+            os.replace(tmp, out)
+    finally:
+        for conn in conns:
+            conn.close()
+    return count
+
+
+class MapFile:
+    """One mapped snapshot; ``find`` binary-searches it without reading anything else."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size < HEADER.size:
+                raise ValueError("not a URL map")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.width, meta_len, self.count = HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                raise ValueError("not a URL map")
+            self.meta = json.loads(self._mm[HEADER.size:HEADER.size + meta_len])
+            self.codes_at, self.offsets_at, self.expiry_at, self.blob_at = _layout(self.width, meta_len, self.count)
+            if self.blob_at > len(self._mm):
+                raise ValueError("truncated URL map")
+            width, base = self.width, self.codes_at
+            self._fences = [self._mm[base + i * width:base + (i + 1) * width] for i in range(0, self.count, FENCE)]
+        except Exception:
+            self._mm.close()
+            raise
+
+    def find(self, code):
+        """(URL, expires_at or None) for ``code``, or None if it is not in the file."""
+        key = code.encode("utf-8")
+        width = self.width
+        if len(key) > width:
+            return None
+        key = key.ljust(width, b"\0")
+        block = bisect.bisect_right(self._fences, key) - 1
+        if block < 0:
+            return None
+        first = block * FENCE
+        start = self.codes_at + first * width
+        mm = self._mm
+        chunk = mm[start:start + min(FENCE, self.count - first) * width]
+        pos = chunk.find(key)
+        # Only matches on an entry boundary count
+        while pos > 0 and pos % width:
+            pos = chunk.find(key, pos + 1)
+        if pos < 0:
+            return None
+        i = first + pos // width
+        begin, end = SPAN.unpack_from(mm, self.offsets_at + i * OFFSET.size)
+        expires_at = EXPIRY.unpack_from(mm, self.expiry_at + i * EXPIRY.size)[0]
+        return mm[self.blob_at + begin:self.blob_at + end].decode("utf-8"), expires_at or None
+
+    @property
+    def size(self):
+        return len(self._mm)
+
+    def close(self):
+        self._mm.close()
+
+
+class UrlMap:
+    """The current MapFile of a worker plus the codes changed since it was written."""
+
+    def __init__(self, storage, path, sync_interval=1.0, prune_every=600):
+        self.storage = storage
+        self.path = path
+        self.sync_interval = sync_interval
+        self.prune_every = prune_every
+        self.file = None
+        # Per storage partition: url_changes id applied to ``changed``
+        self._marks = None
+        self.changed = set()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def get(self, code):
+        """``(url, expires_at)``, None for an expired link, or MISS when the database has to answer."""
+        snapshot = self.file
+        if snapshot is None or code in self.changed:
+            return MISS
+        found = snapshot.find(code)
+        if found is None:
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        url, expires_at = found
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return url, expires_at
+
+    def forget(self, code):
+        # This worker changed the link; do not wait for the next sync
+        if self.file is not None:
+            self.changed.add(code)
+
+    async def start(self):
+        if not self.path:
+            return
+        try:
+            await self._load()
+        except Exception:
+            logger.exception("loading URL map %s failed", self.path)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def _load(self):
+        start = time.perf_counter()
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, MapFile, self.path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("ignoring URL map %s: %s", self.path, e)
+            return False
+        marks = list(snapshot.meta.get("marks") or [])
+        changed = set()
+        if len(marks) != self.storage.partitions or not await self._catch_up(marks, changed):
+            logger.warning("URL map %s does not match the database; ignoring it", self.path)
+            snapshot.close()
+            return False
+        old, self.file, self._marks, self.changed = self.file, snapshot, marks, changed
+        if old is not None:
+            old.close()
+        self.loads += 1
+        self.load_seconds = time.perf_counter() - start
+        logger.info("URL map loaded: %d links, %d changed since (%.1f ms)",
+                    snapshot.count, len(changed), self.load_seconds * 1000)
+        return True
+
+    async def _catch_up(self, marks, changed):
+        """Collect codes changed past each mark; False if the log no longer reaches back."""
+        for n in range(len(marks)):
+            while True:
+                marks[n], codes, gap = await self.storage.on_partition(n, fetch_changes, marks[n])
+                if gap:
+                    return False
+                changed.update(codes)
+                if len(codes) < FETCH_LIMIT:
+                    break
+        return True
+
+    def _replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return self.file is None or (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.file.identity
+
+    async def _run(self):
+        polls = 0
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if self._replaced():
+                    await self._load()
+                elif self.file is not None and not await self._catch_up(self._marks, self.changed):
+                    logger.warning("URL map %s fell behind the change log; dropping it", self.path)
+                    self.file.close()
+                    self.file = None
+                polls += 1
+                if polls % self.prune_every == 0:
+                    for n in range(self.storage.partitions):
+                        await self.storage.on_partition(n, prune_changes)
+            except Exception:
+                logger.exception("URL map sync failed")
+
+    def stats(self):
+        snapshot = self.file
+        stats = {
+            "path": self.path,
+            "loaded": snapshot is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "changed": len(self.changed),
+            "loads": self.loads,
+            "load_ms": round(self.load_seconds * 1000, 3),
+        }
+        if snapshot is not None:
+            stats.update({
+                "links": snapshot.count,
+                "code_width": snapshot.width,
+                "bytes": snapshot.size,
+                "written_at": snapshot.meta.get("written_at"),
+            })
+        return stats
+
+
+def main():
+    from storage import read_only_storage
+
+    parser = argparse.ArgumentParser(description="Write the memory-mapped short code -> URL snapshot.")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--out", help="default: URL_MAP_PATH, else next to the database")
+    parser.add_argument("--max-width", type=int, default=MAX_WIDTH, help="longer codes are left out")
+    args = parser.parse_args()
+
+    storage = read_only_storage()
+    out = args.out or os.environ.get("URL_MAP_PATH") or default_map_path(storage)
+    if not out:
+        raise SystemExit("the %s storage engine has nothing to export" % storage.engine)
+    start = time.perf_counter()
+    count = export_map(database_paths(storage), out, args.max_width)
+    print("wrote %d links to %s (%.1f MiB) in %.1fs" % (
+        count, out, os.path.getsize(out) / 2 ** 20, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()